@@ -1,36 +1,243 @@
 $(function() {
     success_alert = $('#importsuccessalert');
+    validated_alert = $('#importvalidatedalert');
     error_alert = $('#importerroralert');
+    progress = $('#importprogress');
+    progress_bar = $('#importprogressbar');
+    progress_phase = $('#importphase');
 
-    $("#import-chall-button").click(function (e) {
-        var form = $("#import-form")[0];
-        var formData = new FormData(form);
-    
-        $.ajax({
-            url: '/admin/yaml',
-            data: formData,
-            type: 'POST',
-            cache: false,
-            contentType: false,
-            processData: false,
-            success: function (resp) {
-                if (resp.success) {
-                    form.reset();
-                    success_alert.show();
+    var PHASES = {
+        upload: "Uploading the archive",
+        verify: "Checking the archive",
+        queued: "Waiting for other imports to finish",
+        running: "Starting the import",
+        lock: "Waiting for another import",
+        extract: "Reading the archive",
+        validate: "Validating the challenges",
+        db: "Importing the challenges",
+        files: "Uploading the attachments"
+    };
+
+    function show_errors(errors) {
+        error_alert.empty();
+        $.each(errors, function (i, error) {
+            error_alert.append($("<div>").text(error));
+        });
+        error_alert.show();
+    }
+
+    function show_progress(job) {
+        var phase = job.phase || job.status;
+        var text = PHASES[phase] || phase;
+        var width = 100;
+        if (job.total) {
+            text += " (" + job.processed + "/" + job.total + ")";
+            width = Math.round(100 * job.processed / job.total);
+        }
+        progress_phase.text(text);
+        progress_bar.css("width", width + "%");
+        progress.show();
+    }
+
+    function poll_job(job_id, dry_run) {
+        $.get('/admin/yaml/jobs/' + job_id, function (job) {
+            if (job.status === "succeeded") {
+                progress.hide();
+                if (dry_run) {
+                    validated_alert.show();
                 } else {
-                    error_alert.html(resp.errors);
-                    error_alert.show();
+                    $("#import-form")[0].reset();
+                    success_alert.show();
                 }
-            },
-            error: function (resp) {
+            } else if (job.status === "failed") {
+                progress.hide();
+                show_errors(job.errors);
+            } else {
+                show_progress(job);
+                setTimeout(function () {
+                    poll_job(job_id, dry_run);
+                }, 1000);
+            }
+        }).fail(function () {
+            progress.hide();
+            error_alert.html("Oops, something went wrong! The import status is not available.");
+            error_alert.show();
+        });
+    }
+
+    // Chunks uploaded at the same time, and attempts per chunk
+    var PARALLEL_CHUNKS = 4;
+    var CHUNK_ATTEMPTS = 3;
+
+    function nonce() {
+        return $("#import-form input[name=nonce]").val();
+    }
+
+    function post_json(url, data) {
+        return $.ajax({
+            url: url,
+            type: 'POST',
+            data: JSON.stringify(data),
+            contentType: 'application/json',
+            headers: {"CSRF-Token": nonce()}
+        });
+    }
+
+    function read_chunk(blob) {
+        return new Promise(function (resolve, reject) {
+            var reader = new FileReader();
+            reader.onload = function () { resolve(reader.result); };
+            reader.onerror = function () { reject(reader.error); };
+            reader.readAsArrayBuffer(blob);
+        });
+    }
+
+    function to_hex(buffer) {
+        return Array.prototype.map.call(new Uint8Array(buffer), function (byte) {
+            return ("0" + byte.toString(16)).slice(-2);
+        }).join("");
+    }
+
+    // Checksums need WebCrypto, which browsers only provide to https pages
+    function sha256(buffer) {
+        if (!window.crypto || !window.crypto.subtle) {
+            return Promise.resolve(null);
+        }
+        return window.crypto.subtle.digest("SHA-256", buffer);
+    }
+
+    // Reuse the unfinished upload of the same file, if any
+    function start_upload(file) {
+        var key = "portable-upload:" + [file.name, file.size, file.lastModified].join(":");
+        var upload_id = window.localStorage.getItem(key);
+        var started = upload_id ? $.get('/admin/yaml/uploads/' + upload_id) : $.Deferred().reject();
+        return started.then(function (status) {
+            return {id: upload_id, chunk_size: status.chunk_size, received: status.received, key: key};
+        }, function () {
+            return post_json('/admin/yaml/uploads', {size: file.size}).then(function (resp) {
+                window.localStorage.setItem(key, resp.upload);
+                return {id: resp.upload, chunk_size: resp.chunk_size, received: {}, key: key};
+            });
+        });
+    }
+
+    function upload_chunk(upload, file, index, digests) {
+        var offset = index * upload.chunk_size;
+        return read_chunk(file.slice(offset, offset + upload.chunk_size)).then(function (data) {
+            return sha256(data).then(function (digest) {
+                digests[index] = digest;
+                var hex = digest ? to_hex(digest) : null;
+                // Chunks received before the upload was interrupted are kept
+                if (hex && upload.received[index] === hex) {
+                    return;
+                }
+                var headers = {"CSRF-Token": nonce()};
+                if (hex) {
+                    headers["X-Chunk-Sha256"] = hex;
+                }
+                var attempt = function (attempts) {
+                    return Promise.resolve($.ajax({
+                        url: '/admin/yaml/uploads/' + upload.id + '?offset=' + offset,
+                        type: 'PUT',
+                        data: data,
+                        contentType: 'application/octet-stream',
+                        processData: false,
+                        headers: headers
+                    })).catch(function (err) {
+                        if (attempts > 1 && err.status !== 404) {
+                            return attempt(attempts - 1);
+                        }
+                        throw err;
+                    });
+                };
+                return attempt(CHUNK_ATTEMPTS);
+            });
+        });
+    }
+
+    function upload_chunks(upload, file) {
+        var chunks = Math.ceil(file.size / upload.chunk_size);
+        var digests = new Array(chunks);
+        var next = 0;
+        var done = 0;
+        var worker = function () {
+            if (next >= chunks) {
+                return Promise.resolve();
+            }
+            var index = next++;
+            return upload_chunk(upload, file, index, digests).then(function () {
+                done++;
+                show_progress({phase: "upload", processed: done, total: chunks});
+                return worker();
+            });
+        };
+        var workers = [];
+        for (var i = 0; i < Math.min(PARALLEL_CHUNKS, chunks); i++) {
+            workers.push(worker());
+        }
+        return Promise.all(workers).then(function () {
+            if (digests.indexOf(null) !== -1) {
+                return null;
+            }
+            var all = new Uint8Array(32 * chunks);
+            digests.forEach(function (digest, index) {
+                all.set(new Uint8Array(digest), 32 * index);
+            });
+            return sha256(all.buffer).then(to_hex);
+        });
+    }
+
+    function submit_import(dry_run) {
+        var file = $("#tarfile")[0].files[0];
+        success_alert.hide();
+        validated_alert.hide();
+        error_alert.hide();
+        if (!file) {
+            return;
+        }
+
+        // Archives are sent in chunks, so that an interrupted upload can be
+        // resumed, and checked once whole before they are imported
+        show_progress({phase: "upload", processed: 0, total: 1});
+        Promise.resolve(start_upload(file)).then(function (upload) {
+            return upload_chunks(upload, file).then(function (checksum) {
+                return post_json(
+                    '/admin/yaml/uploads/' + upload.id + '/finalize' + (dry_run ? '?dry_run' : ''),
+                    {sha256: checksum}
+                );
+            }).then(function (resp) {
+                window.localStorage.removeItem(upload.key);
+                return resp;
+            });
+        }).then(function (resp) {
+            show_progress({status: "queued"});
+            poll_job(resp.job, resp.dry_run);
+        }, function (err) {
+            progress.hide();
+            var resp = null;
+            try {
+                resp = JSON.parse(err.responseText);
+            } catch (e) {}
+            if (resp && resp.errors) {
+                show_errors(resp.errors);
+            } else {
                 error_alert.html("Oops, something went wrong! Challenges cannot be automatically imported.");
                 error_alert.show();
             }
         });
+    }
+
+    $("#import-chall-button").click(function (e) {
+        submit_import(false);
+    });
+
+    $("#validate-chall-button").click(function (e) {
+        submit_import(true);
     });
 
     $("#tarfile").click(function (e) {
         success_alert.hide();
+        validated_alert.hide();
         error_alert.hide();
     });
 });
@@ -0,0 +1,148 @@
+"""
+Bulk storage of imported attachments through the uploader of CTFd. Files
+are stored on a pool of threads, which the filesystem uploader writes in
+parallel with and the S3 uploader sends concurrent requests over its
+connection pool with, while the challenges are still being imported. The
+rows of the stored files are then inserted all at once by the importer.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+import hashlib
+
+from flask import current_app, has_app_context
+
+
+DEFAULT_WORKERS = 4
+# Attachments of sources which can not be read concurrently, e.g. a tar
+# archive, are read by the importing thread and handed to the pool in
+# memory up to this size, larger ones are stored by the importing thread
+INLINE_SIZE = 8 * 1024 * 1024
+
+
+def _pool_connections(uploader, workers):
+    """
+    Make the connection pool of an S3 uploader large enough for workers
+    concurrent requests. boto3 clients can be shared between threads, but
+    only keep 10 connections open by default.
+    """
+    client = getattr(uploader, "s3", None)
+    config = getattr(getattr(client, "meta", None), "config", None)
+    if config is None or (config.max_pool_connections or 0) >= workers:
+        return
+    try:
+        import boto3
+        from botocore.client import Config
+    except ImportError:
+        return
+
+    app_config = current_app.config
+    uploader.s3 = boto3.client(
+        "s3",
+        config=config.merge(Config(max_pool_connections=workers)),
+        aws_access_key_id=app_config.get("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=app_config.get("AWS_SECRET_ACCESS_KEY"),
+        endpoint_url=app_config.get("AWS_S3_ENDPOINT_URL"),
+    )
+
+
+class _HashingReader(object):
+    """Reads f, computing the sha256 and the size of what was read"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+class BulkUploader(object):
+    """
+    Stores attachments with uploader on workers threads. At most twice as
+    many attachments as workers are stored at the same time, adding more
+    waits for the oldest ones. The attachments are hashed as they are
+    stored.
+    """
+
+    def __init__(self, uploader, workers=DEFAULT_WORKERS):
+        self.uploader = uploader
+        self.workers = workers
+        self.app = current_app._get_current_object()
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.pending = deque()
+        self.futures = []
+        # sha256 and size of the stored attachments, by location
+        self.digests = {}
+        _pool_connections(uploader, workers)
+
+    def _store(self, open_file, filename):
+        with open_file() as f:
+            reader = _HashingReader(f)
+            location = self.uploader.upload(file_obj=reader, filename=filename)
+        self.digests[location] = (reader.sha256.hexdigest(), reader.size)
+        return location
+
+    def _in_context(self, func, *args):
+        # Uploaders may read the config of the app. The context is not pushed
+        # again on the importing thread, since popping it would also end the
+        # session of the import.
+        if has_app_context():
+            return func(*args)
+        with self.app.app_context():
+            return func(*args)
+
+    def _upload(self, open_file, filename):
+        return self._in_context(self._store, open_file, filename)
+
+    def add(self, open_file, filename, size, concurrent=True):
+        """
+        Store the attachment of size bytes opened by open_file as filename,
+        and return the Future of its location. Unless concurrent is set,
+        open_file is only called by the calling thread.
+        """
+        if self.executor is None or (not concurrent and size > INLINE_SIZE):
+            future = Future()
+            future.set_result(self._upload(open_file, filename))
+        elif concurrent:
+            future = self.executor.submit(self._upload, open_file, filename)
+        else:
+            with open_file() as f:
+                data = f.read()
+            future = self.executor.submit(self._upload, lambda: BytesIO(data), filename)
+
+        self.futures.append(future)
+        self.pending.append(future)
+        while len(self.pending) > 2 * self.workers:
+            self.pending.popleft().result()
+        return future
+
+    def stored(self):
+        """Locations of all the attachments stored, once they are done"""
+        locations = []
+        for future in self.futures:
+            try:
+                locations.append(future.result())
+            except Exception:
+                pass
+        return locations
+
+    def delete(self, locations):
+        """Delete stored attachments, in parallel"""
+        if self.executor is None:
+            for location in locations:
+                self.uploader.delete(location)
+        else:
+            for _ in self.executor.map(
+                partial(self._in_context, self.uploader.delete), locations
+            ):
+                pass
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
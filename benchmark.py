@@ -0,0 +1,667 @@
+"""
+Benchmarks for the import and export pipelines of the plugin.
+
+Run with `python benchmark.py <benchmark> -h` for the options of each
+benchmark. The pipeline benchmark runs the plugin on top of the CTFd
+stand-in of the benchmark_stub directory, so it needs no CTFd installation.
+"""
+from contextlib import redirect_stdout
+from functools import partial
+from io import BytesIO, StringIO
+from tarfile import TarFile, TarInfo
+import argparse
+import importlib
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import compression
+import exporter
+import formats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of the portable challenges plugin"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    copy_parser = subparsers.add_parser(
+        "copy", help="copy and tar attachments with a varying number of workers"
+    )
+    copy_parser.add_argument(
+        "--files",
+        dest="files",
+        type=int,
+        help="number of attachments (default: 200)",
+        default=200,
+    )
+    copy_parser.add_argument(
+        "--size",
+        dest="size",
+        type=int,
+        help="size of each attachment in KiB (default: 1024)",
+        default=1024,
+    )
+    copy_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        nargs="+",
+        help="worker counts to compare (default: 1 4 8)",
+        default=[1, 4, 8],
+    )
+    copy_parser.add_argument(
+        "--dir",
+        dest="directory",
+        type=str,
+        help="directory to run the benchmark in, e.g. on the upload volume "
+        "(default: system temporary directory)",
+        default=None,
+    )
+
+    compress_parser = subparsers.add_parser(
+        "compress", help="compare the size and time of the archive compressions"
+    )
+    compress_parser.add_argument(
+        "--challenges",
+        dest="challenges",
+        type=int,
+        help="number of challenges in the synthetic bundle (default: 100)",
+        default=100,
+    )
+    compress_parser.add_argument(
+        "--size",
+        dest="size",
+        type=int,
+        help="size of the attachments of each challenge in KiB, half text and "
+        "half random data (default: 512)",
+        default=512,
+    )
+    compress_parser.add_argument(
+        "--codecs",
+        dest="codecs",
+        nargs="+",
+        choices=sorted(compression.CODECS),
+        help="compressions to compare (default: all available)",
+        default=sorted(compression.CODECS),
+    )
+    compress_parser.add_argument(
+        "--levels",
+        dest="levels",
+        type=int,
+        nargs="+",
+        help="compression levels to compare (default: the default level of each compression)",
+        default=[None],
+    )
+    compress_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="number of threads of the parallel compressions (default: %d)"
+        % exporter.DEFAULT_WORKERS,
+        default=exporter.DEFAULT_WORKERS,
+    )
+
+    formats_parser = subparsers.add_parser(
+        "formats", help="compare the parse and emit time of the spec formats"
+    )
+    formats_parser.add_argument(
+        "--challenges",
+        dest="challenges",
+        type=int,
+        help="number of challenges in the spec (default: 10000)",
+        default=10000,
+    )
+    formats_parser.add_argument(
+        "--flags",
+        dest="flags",
+        type=int,
+        help="number of flags of each challenge (default: 2)",
+        default=2,
+    )
+    formats_parser.add_argument(
+        "--tags",
+        dest="tags",
+        type=int,
+        help="number of tags of each challenge (default: 2)",
+        default=2,
+    )
+    formats_parser.add_argument(
+        "--hints",
+        dest="hints",
+        type=int,
+        help="number of hints of each challenge (default: 1)",
+        default=1,
+    )
+    formats_parser.add_argument(
+        "--prerequisites",
+        dest="prerequisites",
+        type=int,
+        help="number of prerequisites of each challenge, among the previous "
+        "ones (default: 1)",
+        default=1,
+    )
+    formats_parser.add_argument(
+        "--formats",
+        dest="formats",
+        nargs="+",
+        choices=sorted(formats.FORMATS),
+        help="formats to compare (default: all)",
+        default=sorted(formats.FORMATS),
+    )
+    formats_parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        type=int,
+        help="number of runs of each measure, the fastest of which is "
+        "reported (default: 3)",
+        default=3,
+    )
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline",
+        help="import, re-import and export synthetic challenges with the CLI "
+        "functions and through /admin/yaml",
+    )
+    pipeline_parser.add_argument(
+        "--challenges",
+        dest="challenges",
+        type=int,
+        help="number of challenges (default: 500)",
+        default=500,
+    )
+    pipeline_parser.add_argument(
+        "--flags",
+        dest="flags",
+        type=int,
+        help="number of flags of each challenge (default: 2)",
+        default=2,
+    )
+    pipeline_parser.add_argument(
+        "--tags",
+        dest="tags",
+        type=int,
+        help="number of tags of each challenge (default: 2)",
+        default=2,
+    )
+    pipeline_parser.add_argument(
+        "--hints",
+        dest="hints",
+        type=int,
+        help="number of hints of each challenge (default: 1)",
+        default=1,
+    )
+    pipeline_parser.add_argument(
+        "--files",
+        dest="files",
+        type=int,
+        help="number of attachments of each challenge (default: 1)",
+        default=1,
+    )
+    pipeline_parser.add_argument(
+        "--size",
+        dest="size",
+        type=int,
+        help="size of each attachment in KiB (default: 64)",
+        default=64,
+    )
+    pipeline_parser.add_argument(
+        "--prerequisites",
+        dest="prerequisites",
+        type=int,
+        help="number of prerequisites of each challenge, among the previous "
+        "ones (default: 1)",
+        default=1,
+    )
+    pipeline_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="number of attachments stored in parallel by the imports "
+        "(default: 4)",
+        default=4,
+    )
+    pipeline_parser.add_argument(
+        "--upload-provider",
+        dest="upload_provider",
+        choices=["filesystem", "s3"],
+        help="uploader storing the imported attachments: the filesystem one, "
+        "or a local stand-in of an S3 bucket (default: filesystem)",
+        default="filesystem",
+    )
+    pipeline_parser.add_argument(
+        "--upload-latency",
+        dest="upload_latency",
+        type=float,
+        help="latency of every request to the S3 stand-in in milliseconds "
+        "(default: 5)",
+        default=5.0,
+    )
+    pipeline_parser.add_argument(
+        "--db",
+        dest="db_uri",
+        type=str,
+        help="URI of an empty database to run the benchmark on (default: a "
+        "new SQLite database)",
+        default=None,
+    )
+    pipeline_parser.add_argument(
+        "--dir",
+        dest="directory",
+        type=str,
+        help="directory to run the benchmark in (default: system temporary "
+        "directory)",
+        default=None,
+    )
+    pipeline_parser.add_argument(
+        "--json",
+        dest="json",
+        type=str,
+        help="also write the results to this JSON file, e.g. to compare "
+        "plugin versions",
+        default=None,
+    )
+    return parser.parse_args()
+
+
+def make_attachments(directory, count, size):
+    """
+    Create count attachments of size bytes in directory, laid out like the
+    CTFd upload folder. Returns the export file map for them.
+    """
+    file_map = {}
+    for i in range(count):
+        src_dir = os.path.join(directory, "uploads", "%032x" % i)
+        os.makedirs(src_dir)
+        src_path = os.path.join(src_dir, "attachment%d.bin" % i)
+        with open(src_path, "wb") as f:
+            f.write(os.urandom(size))
+        file_map[src_path] = os.path.join(directory, "export", "%032x" % i, "attachment%d.bin" % i)
+    return file_map
+
+
+def report(name, seconds, total_bytes):
+    print(
+        "{:<24} {:>8.3f} s {:>10.1f} MiB/s".format(
+            name, seconds, total_bytes / seconds / (1024 * 1024)
+        )
+    )
+
+
+def make_bundle(challenges, size):
+    """
+    Build an uncompressed tar archive of a synthetic challenge bundle: a spec
+    and, for every challenge, a text attachment (e.g. source code) and a
+    random one (e.g. a binary or an image) of size / 2 bytes each.
+    """
+    words = ["flag", "def", "return", "import", "challenge", "0x41", "payload", "{", "}"]
+    rng = random.Random(0)
+    spec = ["challs:"]
+    members = []
+    for i in range(challenges):
+        spec.append("- name: chall%d\n  files: [files/%d/source.c, files/%d/data.bin]" % (i, i, i))
+        text = " ".join(rng.choice(words) for _ in range(size // 10)).encode("utf-8")
+        members.append(("files/%d/source.c" % i, text[: size // 2]))
+        members.append(("files/%d/data.bin" % i, os.urandom(size // 2)))
+    members.insert(0, ("challenges.yaml", "\n".join(spec).encode("utf-8")))
+
+    bundle = BytesIO()
+    with TarFile.open(fileobj=bundle, mode="w") as tarball:
+        for name, data in members:
+            tarinfo = TarInfo(name)
+            tarinfo.size = len(data)
+            tarball.addfile(tarinfo, BytesIO(data))
+    return bundle.getvalue()
+
+
+class _CountingWriter(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def bench_compress(args):
+    bundle = make_bundle(args.challenges, args.size * 1024)
+    print("{:<24} {:>10} {:>12} {:>8}".format("", "time", "throughput", "ratio"))
+    for name in args.codecs:
+        codec = compression.CODECS[name]
+        for level in args.levels:
+            if level is not None and level not in codec.levels:
+                continue
+            sink = _CountingWriter()
+            start = time.perf_counter()
+            writer = codec.writer(sink, level, args.workers)
+            for offset in range(0, len(bundle), 64 * 1024):
+                writer.write(bundle[offset:offset + 64 * 1024])
+            writer.close()
+            seconds = time.perf_counter() - start
+            label = name if level is None else "%s, level %d" % (name, level)
+            print(
+                "{:<24} {:>8.3f} s {:>7.1f} MiB/s {:>8.3f}".format(
+                    label,
+                    seconds,
+                    len(bundle) / seconds / (1024 * 1024),
+                    sink.size / len(bundle),
+                )
+            )
+
+
+def bench_formats(args):
+    chals = [make_challenge(i, args) for i in range(args.challenges)]
+    print("{:<24} {:>10} {:>10} {:>10}".format("", "emit", "parse", "size"))
+    for name in args.formats:
+        spec_format = formats.FORMATS[name]
+        emit = parse = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            text = "".join(spec_format.serialize(chals))
+            emit = min(emit, time.perf_counter() - start)
+            start = time.perf_counter()
+            parsed = list(spec_format.parse(StringIO(text)))
+            parse = min(parse, time.perf_counter() - start)
+        assert parsed == chals, "%s does not round trip" % name
+        print(
+            "{:<24} {:>8.3f} s {:>8.3f} s {:>6.1f} MiB".format(
+                name, emit, parse, len(text.encode("utf-8")) / (1024 * 1024)
+            )
+        )
+
+
+def bench_copy(args):
+    if args.directory:
+        os.makedirs(args.directory, exist_ok=True)
+    workdir = tempfile.mkdtemp(dir=args.directory)
+    try:
+        file_map = make_attachments(workdir, args.files, args.size * 1024)
+        total_bytes = args.files * args.size * 1024
+        export_dir = os.path.join(workdir, "export")
+        tar_path = os.path.join(workdir, "export.tar")
+
+        for workers in args.workers:
+            start = time.perf_counter()
+            exporter.copy_files(file_map, workers)
+            report("copy, %d workers" % workers, time.perf_counter() - start, total_bytes)
+            shutil.rmtree(export_dir)
+
+            start = time.perf_counter()
+            with TarFile.open(tar_path, mode="w") as tarball:
+                exporter.tar_files(file_map, tarball, workers)
+            report("tar, %d workers" % workers, time.perf_counter() - start, total_bytes)
+            os.remove(tar_path)
+    finally:
+        shutil.rmtree(workdir)
+
+
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_stub")
+# Seconds the web import of the pipeline benchmark may take
+IMPORT_TIMEOUT = 600
+
+
+def load_plugin(workdir):
+    """
+    Import the plugin as a package, the way CTFd loads it, on top of the
+    CTFd stand-in
+    """
+    sys.path.insert(0, STUB_PATH)
+    os.symlink(
+        os.path.dirname(os.path.abspath(__file__)),
+        os.path.join(workdir, "portable_plugin"),
+    )
+    sys.path.insert(0, workdir)
+    return importlib.import_module("portable_plugin")
+
+
+def make_app(workdir, db_uri, upload_provider="filesystem", upload_latency=0.0):
+    from flask import Flask
+    from CTFd.models import db
+    import CTFd.plugins.dynamic_challenges  # noqa: F401
+
+    app = Flask(__name__, root_path=workdir)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=db_uri or "sqlite:///" + os.path.join(workdir, "ctfd.db"),
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        UPLOAD_FOLDER="uploads",
+        PORTABLE_EXPORT_CACHE=os.path.join(workdir, "cache"),
+        UPLOAD_PROVIDER=upload_provider,
+        AWS_S3_ENDPOINT_URL=os.path.join(workdir, "bucket"),
+        STUB_S3_LATENCY=upload_latency / 1000,
+    )
+    db.init_app(app)
+    app.db = db
+    return app
+
+
+def make_challenge(i, args):
+    """Synthetic challenge i, every fourth challenge is dynamic"""
+    chal = {
+        "name": "chall%d" % i,
+        "category": "category%d" % (i % 10),
+        "description": "Description of challenge %d" % i,
+        "value": 100 + i % 400,
+        "flags": [{"flag": "flag{%d_%d}" % (i, j)} for j in range(args.flags)],
+    }
+    if i % 4 == 3:
+        chal.update(type="dynamic", minimum=50, decay=20)
+    if args.tags:
+        chal["tags"] = ["tag%d" % ((i + j) % 50) for j in range(args.tags)]
+    if args.hints:
+        chal["hints"] = [
+            {"content": "Hint %d of challenge %d" % (j, i), "cost": 10 * j}
+            for j in range(args.hints)
+        ]
+    if args.prerequisites and i:
+        chal["prerequisites"] = [
+            "chall%d" % (i - 1 - j) for j in range(min(args.prerequisites, i))
+        ]
+    return chal
+
+
+def make_spec(directory, args, dump_challenges):
+    """
+    Write a spec of synthetic challenges and their attachments to directory.
+    Returns the path of the spec.
+    """
+    os.makedirs(directory, exist_ok=True)
+    chals = []
+    for i in range(args.challenges):
+        chal = make_challenge(i, args)
+        if args.files:
+            chal["files"] = []
+            for j in range(args.files):
+                filename = os.path.join("files", str(i), "attachment%d.bin" % j)
+                os.makedirs(os.path.dirname(os.path.join(directory, filename)), exist_ok=True)
+                with open(os.path.join(directory, filename), "wb") as f:
+                    f.write(os.urandom(args.size * 1024))
+                chal["files"].append(filename)
+        chals.append(chal)
+
+    spec_path = os.path.join(directory, "challenges.yaml")
+    with open(spec_path, "w") as f:
+        f.write(dump_challenges(chals))
+    return spec_path
+
+
+def _written_bytes():
+    # Bytes passed to write calls, including the ones served from the cache
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class _Steps(object):
+    """
+    Runs the steps of the pipeline benchmark, measuring their wall time,
+    their database queries, the peak RSS of the process and the bytes
+    written. The plugin output is silenced while a step runs.
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.queries = 0
+        self.results = []
+        event.listen(engine, "before_cursor_execute", self._count_query)
+        print(
+            "{:<24} {:>10} {:>8} {:>14} {:>14}".format(
+                "", "time", "queries", "peak RSS", "written"
+            )
+        )
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def run(self, name, step, *args):
+        queries = self.queries
+        written = _written_bytes()
+        start = time.perf_counter()
+        with redirect_stdout(StringIO()):
+            result = step(*args)
+        seconds = time.perf_counter() - start
+
+        measures = {
+            "step": name,
+            "seconds": seconds,
+            "queries": self.queries - queries,
+            # Kilobytes on Linux
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "written": None if written is None else _written_bytes() - written,
+        }
+        self.results.append(measures)
+        print(
+            "{:<24} {:>8.3f} s {:>8} {:>10.1f} MiB {:>10} MiB".format(
+                name,
+                seconds,
+                measures["queries"],
+                measures["peak_rss"] / (1024 * 1024),
+                "-" if written is None else "%.1f" % (measures["written"] / (1024 * 1024)),
+            )
+        )
+        return result
+
+
+def _web_export(client, query=""):
+    response = client.get("/admin/yaml" + query)
+    if response.status_code != 200:
+        raise RuntimeError("Export failed with status %d" % response.status_code)
+    return response.data, response.headers["ETag"].strip('"')
+
+
+def _change_challenge():
+    from CTFd.models import db, Challenges
+
+    chal = Challenges.query.order_by(Challenges.id).first()
+    chal.description += " (changed)"
+    db.session.commit()
+
+
+def _web_import(client, archive):
+    response = client.post(
+        "/admin/yaml", data={"file": (BytesIO(archive), "export.tar.gz")}
+    )
+    job_id = response.get_json()["job"]
+    deadline = time.time() + IMPORT_TIMEOUT
+    while time.time() < deadline:
+        job = client.get("/admin/yaml/jobs/" + job_id).get_json()
+        if job["status"] == "failed":
+            raise RuntimeError("Import failed: %s" % "; ".join(job["errors"]))
+        if job["status"] == "succeeded":
+            return job
+        time.sleep(0.05)
+    raise RuntimeError("Import job %s did not finish in %d seconds" % (job_id, IMPORT_TIMEOUT))
+
+
+def bench_pipeline(args):
+    if args.directory:
+        os.makedirs(args.directory, exist_ok=True)
+    workdir = tempfile.mkdtemp(dir=args.directory)
+    try:
+        plugin = load_plugin(workdir)
+        app = make_app(workdir, args.db_uri, args.upload_provider, args.upload_latency)
+        spec_dir = os.path.join(workdir, "spec")
+        spec_path = make_spec(spec_dir, args, plugin.exporter.dump_challenges)
+        upload_folder = os.path.join(workdir, "uploads")
+        export_dir = os.path.join(workdir, "export")
+        os.makedirs(export_dir)
+
+        with app.app_context():
+            plugin.load(app)
+            steps = _Steps(app.db.engine)
+
+            def export_tar():
+                with TarFile.open(os.path.join(export_dir, "export.tar"), mode="w") as tarball:
+                    plugin.exporter.export_challenges(
+                        os.path.join(export_dir, "challenges.yaml"),
+                        os.path.join(export_dir, "tar"),
+                        upload_folder,
+                        tarfile=tarball,
+                    )
+                app.db.session.remove()
+
+            def export_dir_copy():
+                plugin.exporter.export_challenges(
+                    os.path.join(export_dir, "challenges.yaml"),
+                    os.path.join(export_dir, "challenges.d"),
+                    upload_folder,
+                )
+                app.db.session.remove()
+
+            import_challenges = partial(
+                plugin.importer.import_challenges, workers=args.workers
+            )
+            steps.run("import", import_challenges, spec_path, upload_folder)
+            steps.run("re-import", import_challenges, spec_path, upload_folder)
+            # Exports read the attachments from the upload folder
+            if args.upload_provider == "filesystem":
+                steps.run("export", export_dir_copy)
+                steps.run("export (tar)", export_tar)
+
+                client = app.test_client()
+                archive, revision = steps.run("web export", _web_export, client)
+                steps.run("web export (cached)", _web_export, client)
+                steps.run("web re-import", _web_import, client, archive)
+                # A single challenge changed since the first export
+                _change_challenge()
+                delta, _ = steps.run(
+                    "web export (delta)", _web_export, client, "?since=" + revision
+                )
+                print(
+                    "Archive sizes: %d bytes, %d bytes as a delta"
+                    % (len(archive), len(delta))
+                )
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"options": vars(args), "steps": steps.results}, f, indent=2)
+    finally:
+        shutil.rmtree(workdir)
+
+
+BENCHMARKS = {
+    "copy": bench_copy,
+    "compress": bench_compress,
+    "formats": bench_formats,
+    "pipeline": bench_pipeline,
+}
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,5 @@
+"""
+Minimal stand-in for CTFd 2.2, used by benchmark.py to run the plugin
+without a CTFd installation. It only provides the models, the filesystem
+uploader and the helpers the plugin imports, with the same schema.
+"""
@@ -0,0 +1,91 @@
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext.hybrid import hybrid_property
+
+db = SQLAlchemy()
+
+
+class Challenges(db.Model):
+    __tablename__ = "challenges"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80))
+    description = db.Column(db.Text)
+    max_attempts = db.Column(db.Integer, default=0)
+    value = db.Column(db.Integer)
+    category = db.Column(db.String(80))
+    type = db.Column(db.String(80))
+    state = db.Column(db.String(80), nullable=False, default="visible")
+    requirements = db.Column(db.JSON)
+    files = db.relationship("ChallengeFiles", backref="challenge")
+    tags = db.relationship("Tags", backref="challenge")
+    hints = db.relationship("Hints", backref="challenge")
+    flags = db.relationship("Flags", backref="challenge")
+    __mapper_args__ = {"polymorphic_identity": "standard", "polymorphic_on": type}
+
+    def __init__(self, *args, **kwargs):
+        super(Challenges, self).__init__(**kwargs)
+
+
+class Hints(db.Model):
+    __tablename__ = "hints"
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(80), default="standard")
+    challenge_id = db.Column(db.Integer, db.ForeignKey("challenges.id"))
+    content = db.Column(db.Text)
+    cost = db.Column(db.Integer, default=0)
+    requirements = db.Column(db.JSON)
+    __mapper_args__ = {"polymorphic_identity": "standard", "polymorphic_on": type}
+
+
+class Files(db.Model):
+    __tablename__ = "files"
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(80), default="standard")
+    location = db.Column(db.Text)
+    __mapper_args__ = {"polymorphic_identity": "standard", "polymorphic_on": type}
+
+
+class ChallengeFiles(Files):
+    __mapper_args__ = {"polymorphic_identity": "challenge"}
+    challenge_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
+
+
+class Tags(db.Model):
+    __tablename__ = "tags"
+    id = db.Column(db.Integer, primary_key=True)
+    challenge_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
+    value = db.Column(db.String(80))
+
+
+class Flags(db.Model):
+    __tablename__ = "flags"
+    id = db.Column(db.Integer, primary_key=True)
+    challenge_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
+    type = db.Column(db.String(80))
+    content = db.Column(db.Text)
+    data = db.Column(db.Text)
+
+
+class Users(db.Model):
+    __tablename__ = "users"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128))
+    hidden = db.Column(db.Boolean, default=False)
+    banned = db.Column(db.Boolean, default=False)
+
+
+class Fails(db.Model):
+    __tablename__ = "fails"
+    id = db.Column(db.Integer, primary_key=True)
+    challenge_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"))
+
+
+class Solves(db.Model):
+    __tablename__ = "solves"
+    id = db.Column(db.Integer, primary_key=True)
+    challenge_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"))
+
+    @hybrid_property
+    def account_id(self):
+        return self.user_id
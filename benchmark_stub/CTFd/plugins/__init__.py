@@ -0,0 +1,7 @@
+def register_plugin_assets_directory(app, base_path, admins_only=False):
+    pass
+
+
+def bypass_csrf_protection(f):
+    f._bypass_csrf = True
+    return f
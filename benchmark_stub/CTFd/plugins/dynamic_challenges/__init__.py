@@ -0,0 +1,43 @@
+from CTFd.models import db, Challenges, Solves
+from CTFd.utils.modes import get_model
+import math
+
+
+class DynamicChallenge(Challenges):
+    __tablename__ = "dynamic_challenge"
+    __mapper_args__ = {"polymorphic_identity": "dynamic"}
+    id = db.Column(None, db.ForeignKey("challenges.id"), primary_key=True)
+    initial = db.Column(db.Integer, default=0)
+    minimum = db.Column(db.Integer, default=0)
+    decay = db.Column(db.Integer, default=0)
+
+    def __init__(self, *args, **kwargs):
+        super(DynamicChallenge, self).__init__(**kwargs)
+        self.initial = kwargs["value"]
+
+
+class DynamicValueChallenge(object):
+    @staticmethod
+    def calculate_value(challenge):
+        Model = get_model()
+        solve_count = (
+            Solves.query.join(Model, Solves.account_id == Model.id)
+            .filter(
+                Solves.challenge_id == challenge.id,
+                Model.hidden == False,  # noqa: E712
+                Model.banned == False,  # noqa: E712
+            )
+            .count()
+        )
+        if solve_count != 0:
+            solve_count -= 1
+        value = (
+            ((challenge.minimum - challenge.initial) / (challenge.decay ** 2))
+            * (solve_count ** 2)
+        ) + challenge.initial
+        value = math.ceil(value)
+        if value < challenge.minimum:
+            value = challenge.minimum
+        challenge.value = value
+        db.session.commit()
+        return challenge
@@ -0,0 +1,4 @@
+def get_model():
+    from CTFd.models import Users
+
+    return Users
@@ -0,0 +1,97 @@
+from flask import current_app
+from shutil import copyfileobj
+from types import SimpleNamespace
+from werkzeug.utils import secure_filename
+import os
+import posixpath
+import threading
+import time
+
+
+class FilesystemUploader(object):
+    def __init__(self, base_path=None):
+        self.base_path = base_path or os.path.join(
+            current_app.root_path, current_app.config["UPLOAD_FOLDER"]
+        )
+
+    def store(self, fileobj, filename):
+        location = os.path.join(self.base_path, filename)
+        directory = os.path.dirname(location)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(location, "wb") as dst:
+            copyfileobj(fileobj, dst, 16384)
+        return filename
+
+    def upload(self, file_obj, filename):
+        if len(filename) == 0:
+            raise Exception("Empty filenames cannot be used")
+        filename = secure_filename(filename)
+        md5hash = os.urandom(16).hex()
+        return self.store(file_obj, posixpath.join(md5hash, filename))
+
+    def delete(self, filename):
+        if os.path.exists(os.path.join(self.base_path, filename)):
+            os.unlink(os.path.join(self.base_path, filename))
+            return True
+        return False
+
+
+class LocalObjectStore(object):
+    """
+    Stand-in of a boto3 S3 client storing the objects in a directory. Every
+    request takes latency seconds and holds one of the max_pool_connections
+    connections of the client meanwhile.
+    """
+
+    def __init__(self, directory, latency, max_pool_connections=10):
+        self.directory = directory
+        self.latency = latency
+        self.meta = SimpleNamespace(
+            config=SimpleNamespace(max_pool_connections=max_pool_connections)
+        )
+        self._connections = threading.BoundedSemaphore(max_pool_connections)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.directory, bucket, key)
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        with self._connections:
+            time.sleep(self.latency)
+            path = self._path(bucket, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as dst:
+                copyfileobj(fileobj, dst)
+
+    def delete_object(self, Bucket, Key):
+        with self._connections:
+            time.sleep(self.latency)
+            if os.path.exists(self._path(Bucket, Key)):
+                os.unlink(self._path(Bucket, Key))
+
+
+class S3Uploader(object):
+    def __init__(self):
+        self.bucket = current_app.config.get("AWS_S3_BUCKET") or "ctfd"
+        self.s3 = LocalObjectStore(
+            current_app.config["AWS_S3_ENDPOINT_URL"],
+            current_app.config.get("STUB_S3_LATENCY", 0.005),
+        )
+
+    def upload(self, file_obj, filename):
+        filename = secure_filename(filename).replace(" ", "_")
+        dst = os.urandom(16).hex() + "/" + filename
+        self.s3.upload_fileobj(file_obj, self.bucket, dst)
+        return dst
+
+    def delete(self, filename):
+        self.s3.delete_object(Bucket=self.bucket, Key=filename)
+        return True
+
+
+UPLOADERS = {"filesystem": FilesystemUploader, "s3": S3Uploader}
+
+
+def get_uploader():
+    return UPLOADERS[current_app.config.get("UPLOAD_PROVIDER") or "filesystem"]()
+
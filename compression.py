@@ -0,0 +1,274 @@
+"""
+Compression codecs of the exported archives. Archives are written as
+uncompressed tar streams through a codec writer, and the codec of an
+uploaded archive is detected from its first bytes rather than its name.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryFile
+import bz2
+import gzip
+import lzma
+import struct
+import tarfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+
+DEFAULT_CODEC = "gzip"
+# Size of the blocks compressed independently by the parallel gzip writer,
+# the one used by pigz
+PGZIP_BLOCK_SIZE = 128 * 1024
+# Window of the previous block used as dictionary of the next one
+PGZIP_DICT_SIZE = 32 * 1024
+MAGIC_SIZE = 6
+COPY_SIZE = 1024 * 1024
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class _PlainWriter(object):
+    """Writer of uncompressed archives, leaving fileobj open when closed"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _deflate_block(data, level, zdict, last):
+    if zdict:
+        compressor = zlib.compressobj(
+            level,
+            zlib.DEFLATED,
+            -zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY,
+            zdict,
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # Blocks end on a byte boundary, so that the raw deflate streams of all
+    # blocks can be concatenated into a single one
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+class ParallelGzipWriter(object):
+    """
+    Gzip writer compressing blocks of the data on several threads, like
+    pigz. Every block is primed with the end of the previous one, so the
+    output is a regular gzip member, nearly as small as a sequential one.
+    zlib releases the GIL while compressing.
+    """
+
+    def __init__(self, fileobj, level=6, workers=4, block_size=PGZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.workers = workers
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.zdict = b""
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        # No name and no modification time, for reproducible archives
+        self.fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+
+    def _submit(self, last=False):
+        block = bytes(self.buffer[:self.block_size])
+        del self.buffer[:self.block_size]
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(
+            self.executor.submit(_deflate_block, block, self.level, self.zdict, last)
+        )
+        self.zdict = block[-PGZIP_DICT_SIZE:]
+        # Bound the memory used by the blocks being compressed
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) > self.block_size:
+            self._submit()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(last=True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(
+                struct.pack("<II", self.crc & 0xFFFFFFFF, self.size & 0xFFFFFFFF)
+            )
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+class Codec(object):
+    """
+    A compression format. tar_mode is the compression of tarfile able to
+    read it with random access, or None if the archive has to be
+    decompressed first. levels are the valid compression levels.
+    """
+
+    def __init__(self, name, extension, mimetype, magic, tar_mode, levels, default_level, writer):
+        self.name = name
+        self.extension = extension
+        self.mimetype = mimetype
+        self.magic = magic
+        self.tar_mode = tar_mode
+        self.levels = levels
+        self.default_level = default_level
+        self._writer = writer
+
+    def writer(self, fileobj, level=None, workers=1):
+        """
+        File object compressing the data written to fileobj. Closing it
+        finishes the compressed stream but leaves fileobj open.
+        """
+        if level is None:
+            level = self.default_level
+        elif level not in self.levels:
+            raise ValueError("Invalid compression level {} for {}.".format(level, self.name))
+        return self._writer(fileobj, level, workers)
+
+
+def _zstd_writer(fileobj, level, workers):
+    compressor = zstandard.ZstdCompressor(level=level, threads=workers)
+    return compressor.stream_writer(fileobj, closefd=False)
+
+
+CODECS = {
+    "tar": Codec(
+        "tar",
+        ".tar",
+        "application/x-tar",
+        None,
+        "",
+        range(0),
+        None,
+        lambda fileobj, level, workers: _PlainWriter(fileobj),
+    ),
+    # Archives of the stdlib gzip writer are unchanged from earlier exports
+    "gzip": Codec(
+        "gzip",
+        ".tar.gz",
+        "application/gzip",
+        b"\x1f\x8b",
+        "gz",
+        range(0, 10),
+        9,
+        lambda fileobj, level, workers: gzip.GzipFile(
+            filename="", mode="wb", compresslevel=level, fileobj=fileobj
+        ),
+    ),
+    "pgzip": Codec(
+        "pgzip",
+        ".tar.gz",
+        "application/gzip",
+        b"\x1f\x8b",
+        "gz",
+        range(0, 10),
+        6,
+        ParallelGzipWriter,
+    ),
+    "bz2": Codec(
+        "bz2",
+        ".tar.bz2",
+        "application/x-bzip2",
+        b"BZh",
+        "bz2",
+        range(1, 10),
+        9,
+        lambda fileobj, level, workers: bz2.BZ2File(
+            fileobj, mode="wb", compresslevel=level
+        ),
+    ),
+    "xz": Codec(
+        "xz",
+        ".tar.xz",
+        "application/x-xz",
+        b"\xfd7zXZ\x00",
+        "xz",
+        range(0, 10),
+        6,
+        lambda fileobj, level, workers: lzma.LZMAFile(fileobj, mode="wb", preset=level),
+    ),
+}
+if zstandard is not None:
+    CODECS["zstd"] = Codec(
+        "zstd",
+        ".tar.zst",
+        "application/zstd",
+        ZSTD_MAGIC,
+        None,
+        range(1, 23),
+        3,
+        _zstd_writer,
+    )
+
+
+def detect_codec(fileobj):
+    """
+    Codec of a compressed stream, detected from its first bytes, which are
+    read and then skipped back. Unknown streams are taken as plain tar.
+    """
+    position = fileobj.tell()
+    magic = fileobj.read(MAGIC_SIZE)
+    fileobj.seek(position)
+    for codec in CODECS.values():
+        if codec.magic and magic.startswith(codec.magic):
+            return codec
+    if magic.startswith(ZSTD_MAGIC):
+        raise ValueError("Invalid archive. zstd archives require the zstandard package.")
+    return CODECS["tar"]
+
+
+def open_tar(path, max_size=None):
+    """
+    Open the tar archive at path for random access, whatever its
+    compression. Formats tarfile can not seek in are decompressed to a
+    temporary file first, of at most max_size bytes if given.
+    """
+    with open(path, "rb") as f:
+        codec = detect_codec(f)
+        if codec.tar_mode is not None:
+            return tarfile.open(path, mode="r:" + codec.tar_mode)
+
+        decompressed = TemporaryFile()
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        copied = 0
+        for data in iter(lambda: reader.read(COPY_SIZE), b""):
+            copied += len(data)
+            if max_size is not None and copied > max_size:
+                decompressed.close()
+                raise ValueError(
+                    "Invalid archive. Larger than {} bytes once decompressed.".format(
+                        max_size
+                    )
+                )
+            decompressed.write(data)
+    decompressed.seek(0)
+    # The temporary file is removed once the archive is not used anymore
+    return tarfile.open(fileobj=decompressed, mode="r:")
@@ -0,0 +1,227 @@
+"""
+Cache of the exported archives. Exports are keyed by a revision fingerprint
+of the challenge set, computed by a single query, which changes whenever a
+challenge or any of its flags, tags, hints or files is added, removed or
+modified. The manifests of the exports are kept as well, longer than the
+archives, so that later exports can be deltas since them.
+"""
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from CTFd.models import db, Challenges, Flags, Tags, Hints, ChallengeFiles
+import hashlib
+import json
+import os
+import re
+import uuid
+
+try:
+    from .manifest import dump_manifest, load_manifest
+except ImportError:  # Running as a script
+    from manifest import dump_manifest, load_manifest
+
+
+# Bump to invalidate the cached archives when the export format changes
+EXPORT_FORMAT = 3
+EXPORT_SUFFIX = ".archive"
+MANIFEST_SUFFIX = ".manifest.json"
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+# Number of manifests kept for delta exports
+DEFAULT_MANIFESTS = 100
+
+_REVISION = re.compile(r"^[0-9a-f]{32}$")
+
+TRACKED_MODELS = (Challenges, Flags, Tags, Hints, ChallengeFiles)
+
+
+class PortableRevision(db.Model):
+    """
+    Single row counter bumped on every change to the exported challenges.
+    Row counts and maximum ids already reveal additions and deletions, the
+    counter covers modifications in place.
+    """
+
+    __tablename__ = "portable_revision"
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer, nullable=False, default=0)
+
+
+def init_revision():
+    if PortableRevision.query.get(1) is None:
+        db.session.add(PortableRevision(id=1, revision=0))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker starting on the same fresh database inserted it
+            db.session.rollback()
+
+
+def bump_revision(connection):
+    """Mark the challenge set as modified, within the transaction of connection"""
+    connection.execute(
+        PortableRevision.__table__.update()
+        .where(PortableRevision.id == 1)
+        .values(revision=PortableRevision.revision + 1)
+    )
+
+
+def _changes_export(obj):
+    # Solves lower the current value of dynamic challenges, which is not
+    # exported since their initial value is
+    if isinstance(obj, Challenges) and obj.type == "dynamic":
+        changed = {attr.key for attr in inspect(obj).attrs if attr.history.has_changes()}
+        return bool(changed - {"value"})
+    return True
+
+
+def _after_flush(session, flush_context):
+    for obj in session.new | session.deleted:
+        if isinstance(obj, TRACKED_MODELS):
+            bump_revision(session.connection())
+            return
+    for obj in session.dirty:
+        if (
+            isinstance(obj, TRACKED_MODELS)
+            and session.is_modified(obj)
+            and _changes_export(obj)
+        ):
+            bump_revision(session.connection())
+            return
+
+
+def track_revisions():
+    """
+    Bump the revision on every flush modifying the exported challenges.
+    Bulk operations skip flush events, and bump the revision themselves.
+    """
+    if not event.contains(Session, "after_flush", _after_flush):
+        event.listen(Session, "after_flush", _after_flush)
+
+
+def export_revision(*scope):
+    """
+    Fingerprint of the exported challenge set. scope holds any other
+    value the export depends on, e.g. the attachments folder. Stored
+    attachments are never modified in place, a changed file gets a new row.
+    """
+    columns = []
+    for model in TRACKED_MODELS:
+        columns.append(db.session.query(db.func.count(model.id)).as_scalar())
+        columns.append(db.session.query(db.func.max(model.id)).as_scalar())
+    columns.append(
+        db.session.query(PortableRevision.revision)
+        .filter(PortableRevision.id == 1)
+        .as_scalar()
+    )
+    row = db.session.query(*columns).one()
+
+    fingerprint = [EXPORT_FORMAT, str(db.engine.url)] + list(scope) + list(row)
+    return hashlib.sha256(json.dumps(fingerprint).encode("utf-8")).hexdigest()[:32]
+
+
+class ExportCache(object):
+    """
+    Finished archives stored in directory as <revision>.archive. The least
+    recently served archives are removed once they take more than max_size
+    bytes, but the most recent one is always kept. The manifests of the
+    max_manifests most recent exports are stored as <revision>.manifest.json.
+    """
+
+    def __init__(
+        self, directory, max_size=DEFAULT_CACHE_SIZE, max_manifests=DEFAULT_MANIFESTS
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_manifests = max_manifests
+
+    def path(self, revision):
+        return os.path.join(self.directory, revision + EXPORT_SUFFIX)
+
+    def open(self, revision):
+        """Open the cached archive of revision, or return None if there is none"""
+        path = self.path(revision)
+        try:
+            archive = open(path, "rb")
+        except (IOError, OSError):
+            return None
+        # Mark as recently used for the eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return archive
+
+    def store(self, revision, chunks):
+        """
+        Pass the chunks of an archive through, storing them as the archive of
+        revision once they have all been generated. Nothing is stored if the
+        generation is interrupted, e.g. when the client disconnects.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, mode=0o700)
+        tmp_path = self.path(revision) + ".{}.tmp".format(uuid.uuid4().hex)
+        complete = False
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, self.path(revision))
+            complete = True
+        finally:
+            if not complete and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def store_manifest(self, revision, manifest):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, mode=0o700)
+        path = os.path.join(self.directory, revision + MANIFEST_SUFFIX)
+        tmp_path = path + ".{}.tmp".format(uuid.uuid4().hex)
+        with open(tmp_path, "w") as f:
+            f.write(dump_manifest(manifest))
+        os.replace(tmp_path, path)
+
+        manifests = self._entries(MANIFEST_SUFFIX)
+        for _, _, old_path in manifests[self.max_manifests:]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def load_manifest(self, revision):
+        """Manifest of the export of revision, or None if it is not known"""
+        if not _REVISION.match(revision):
+            return None
+        try:
+            with open(os.path.join(self.directory, revision + MANIFEST_SUFFIX), "rb") as f:
+                return load_manifest(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _entries(self, suffix):
+        """(mtime, size, path) of the files with suffix, most recent first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(reverse=True)
+        return entries
+
+    def evict(self):
+        archives = self._entries(EXPORT_SUFFIX)
+
+        total = 0
+        for index, (mtime, size, path) in enumerate(archives):
+            total += size
+            if index and total > self.max_size:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
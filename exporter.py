@@ -2,22 +2,71 @@ from flask import Flask
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import OperationalError
+from werkzeug.utils import secure_filename
 
 # This does in fact rely on being in the CTFd/plugins/*/ folder (3 directories up)
-from tarfile import TarFile, TarInfo
-from tempfile import TemporaryFile
+from tarfile import LNKTYPE, TarFile, TarInfo
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
-import yaml
+import queue
+import threading
 import shutil
 import os
+import posixpath
 import sys
 import argparse
-import gzip
+import logging
+
+
+try:
+    from .compression import CODECS, DEFAULT_CODEC
+    from .formats import DEFAULT_FORMAT, FORMATS
+    from .graph import PrerequisiteGraph
+    from .manifest import (
+        MANIFEST_NAME,
+        build_manifest,
+        dump_manifest,
+        export_fingerprint,
+        load_manifest,
+    )
+    from .profiling import Profile, count_queries, cprofiled
+    from .utils import sha256_files
+except ImportError:  # Running as a script
+    from compression import CODECS, DEFAULT_CODEC
+    from formats import DEFAULT_FORMAT, FORMATS
+    from graph import PrerequisiteGraph
+    from manifest import (
+        MANIFEST_NAME,
+        build_manifest,
+        dump_manifest,
+        export_fingerprint,
+        load_manifest,
+    )
+    from profiling import Profile, count_queries, cprofiled
+    from utils import sha256_files
+
+
+DEFAULT_WORKERS = 4
+# Attachments up to this size are read into memory ahead of the tar writer
+READ_AHEAD_SIZE = 8 * 1024 * 1024
+# Specs up to this size are serialized in memory, larger ones to disk
+SPEC_SPOOL_SIZE = 8 * 1024 * 1024
+# Number of ids in a single IN clause of a partial export
+BATCH_SIZE = 500
+FILTERS = ["category", "tag", "name", "id", "visibility"]
+# Sharded YAML specs hold every challenge in its own file with this name
+SHARD_NAME = FORMATS["yaml"].shard_name
+VISIBILITIES = ["visible", "hidden"]
+
+logger = logging.getLogger(__name__)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
-        description="Export a DB full of CTFd challenges and theirs attachments into a portable YAML formated specification file and an associated attachment directory"
+        description="Export a DB full of CTFd challenges and theirs attachments into a portable YAML, JSON or NDJSON specification file and an associated attachment directory"
     )
     parser.add_argument(
         "--app-root",
@@ -42,8 +91,15 @@ def parse_args():
         "-o",
         dest="out_file",
         type=str,
-        help="name of the output YAML file (default: challenges.yaml)",
-        default="challenges.yaml",
+        help="name of the output spec file (default: challenges.<format>)",
+        default=None,
+    )
+    parser.add_argument(
+        "--format",
+        dest="spec_format",
+        choices=sorted(FORMATS),
+        help="format of the spec: yaml, json or ndjson, a challenge per line (default: %s)" % DEFAULT_FORMAT,
+        default=DEFAULT_FORMAT,
     )
     parser.add_argument(
         "-O",
@@ -58,10 +114,99 @@ def parse_args():
     parser.add_argument(
         "--gz",
         dest="gz",
-        help="if present, compress the tar file (only used if '--tar' is on)",
+        help="if present, compress the tar file with gzip (only used if '--tar' is on)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--compression",
+        dest="compression",
+        choices=sorted(CODECS),
+        help="compression of the tar file (only used if '--tar' is on, default: gzip with '--gz', tar otherwise)",
+        default=None,
+    )
+    parser.add_argument(
+        "--level",
+        dest="level",
+        type=int,
+        help="compression level (default: the default level of the compression)",
+        default=None,
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        dest="workers",
+        type=int,
+        help="number of threads used to copy or read attachments (default: %d)"
+        % DEFAULT_WORKERS,
+        default=DEFAULT_WORKERS,
+    )
+    parser.add_argument(
+        "--category",
+        dest="category",
+        action="append",
+        help="only export the challenges of this category (can be repeated)",
+    )
+    parser.add_argument(
+        "--tag",
+        dest="tag",
+        action="append",
+        help="only export the challenges with this tag (can be repeated)",
+    )
+    parser.add_argument(
+        "--name",
+        dest="name",
+        action="append",
+        help="only export the challenges whose name matches this glob pattern, e.g. 'web-*' (can be repeated)",
+    )
+    parser.add_argument(
+        "--id",
+        dest="id",
+        type=int,
+        action="append",
+        help="only export the challenge with this id (can be repeated)",
+    )
+    parser.add_argument(
+        "--visibility",
+        dest="visibility",
+        choices=VISIBILITIES,
+        help="only export the visible or the hidden challenges",
+    )
+    parser.add_argument(
+        "--with-prerequisites",
+        dest="with_prerequisites",
+        action="store_true",
+        help="if present, also export the prerequisites of the selected challenges, transitively, so that the export can be imported on its own",
+    )
+    parser.add_argument(
+        "--since",
+        dest="since",
+        type=str,
+        help="if given, the %s of a previous export, only the challenges changed since, the new attachments and the names of the deleted challenges are exported" % MANIFEST_NAME,
+        default=None,
+    )
+    parser.add_argument(
+        "--shards",
+        dest="shards",
         action="store_true",
+        help="if present, every challenge is written to its own <category>/<name>/%s (or challenge.json) next to the output file, which only lists them" % SHARD_NAME,
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="if present, print a JSON summary of the time spent in each phase, the SQL queries and the bytes moved once done",
+    )
+    parser.add_argument(
+        "--profile-output",
+        dest="profile_output",
+        type=str,
+        help="if given, the export runs under cProfile and its statistics are written to this file",
+        default=None,
+    )
+    args = parser.parse_args()
+    if not args.out_file:
+        args.out_file = FORMATS[args.spec_format].spec_name
+    return args
 
 
 def process_args(args):
@@ -89,8 +234,51 @@ def process_args(args):
     return args
 
 
-def copy_files(file_map):
-    for src_path, dst_path in file_map.items():
+def _copy_file(src_path, dst_path):
+    """
+    Copy a file with copy_file_range when available, which lets the kernel
+    (or the NFS server) copy the data without passing it through userspace.
+    Otherwise shutil copies it, using sendfile where it can. Returns the
+    number of bytes copied.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            size = os.fstat(src.fileno()).st_size
+            try:
+                while copied < size:
+                    count = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                    if count == 0:
+                        break
+                    copied += count
+            except OSError:
+                # Not supported between these file systems
+                if copied:
+                    raise
+        if copied == size:
+            shutil.copymode(src_path, dst_path)
+            return copied
+    shutil.copy(src_path, dst_path)
+    return os.path.getsize(dst_path)
+
+
+def _link_file(target_path, dst_path):
+    try:
+        os.link(target_path, dst_path)
+    except OSError:
+        # Hard links are not supported by this file system
+        shutil.copy(target_path, dst_path)
+
+
+def copy_files(file_map, workers=DEFAULT_WORKERS, links=None):
+    """
+    Copy the attachments in parallel, then create links, a map from their
+    path to the path of an attachment with the same content, as hard links.
+    Returns the number of bytes copied.
+    """
+    links = links or {}
+    # Create the directories up front, so that the copies do not race
+    for dst_path in list(file_map.values()) + list(links):
         dst_dir = os.path.dirname(dst_path)
         if not os.path.isdir(dst_dir):
             if os.path.exists(dst_dir):
@@ -98,124 +286,632 @@ def copy_files(file_map):
                     "Output directory name exists, but is not a directory: %s" % dst_dir
                 )
             os.makedirs(dst_dir)
-        shutil.copy(src_path, dst_path)
-
 
-def tar_files(file_map, tarfile):
-    for src_path, dst_path in file_map.items():
-        tarfile.add(src_path, dst_path)
-
-
-def export_challenges(out_file, dst_attachments, src_attachments, tarfile=None):
-    from CTFd.models import Challenges, Flags, Tags, ChallengeFiles
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        copied = sum(executor.map(_copy_file, file_map.keys(), file_map.values()))
+    for dst_path, target_path in links.items():
+        _link_file(target_path, dst_path)
+    return copied
+
+
+def _read_ahead(src_path):
+    """
+    Open an attachment ahead of the tar writer. Small files are read into
+    memory, the kernel is asked to prefetch larger ones.
+    """
+    f = open(src_path, "rb")
+    try:
+        if os.fstat(f.fileno()).st_size <= READ_AHEAD_SIZE:
+            data = f.read()
+            f.close()
+            return BytesIO(data)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        return f
+    except Exception:
+        f.close()
+        raise
+
+
+def tar_files(file_map, tarfile, workers=DEFAULT_WORKERS, links=None):
+    """
+    Add the attachments to the tar file, then links, a map from their path
+    to the path of an attachment with the same content, as hard links. The
+    tar file is written by a single thread, while up to twice as many files
+    as workers are read ahead. Returns the number of bytes of attachments
+    added.
+    """
+    items = iter(file_map.items())
+    added = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def read_next():
+            for src_path, dst_path in items:
+                pending.append(
+                    (src_path, dst_path, executor.submit(_read_ahead, src_path))
+                )
+                return
+
+        for _ in range(workers * 2):
+            read_next()
+
+        try:
+            while pending:
+                src_path, dst_path, future = pending.popleft()
+                read_next()
+                with future.result() as f:
+                    tarinfo = tarfile.gettarinfo(src_path, dst_path)
+                    if tarinfo.isreg():
+                        tarfile.addfile(tarinfo, f)
+                        added += tarinfo.size
+                    else:
+                        tarfile.addfile(tarinfo)
+        finally:
+            for _, _, future in pending:
+                if not future.cancel() and future.exception() is None:
+                    future.result().close()
+
+    for dst_path, target_path in (links or {}).items():
+        tarinfo = TarInfo(dst_path)
+        tarinfo.type = LNKTYPE
+        tarinfo.linkname = target_path
+        tarfile.addfile(tarinfo)
+    return added
+
+
+def _group_by_challenge(rows):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row.challenge_id, []).append(row)
+    return grouped
+
+
+def _chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _glob_to_like(pattern):
+    """Translate a glob pattern using * and ? to a LIKE pattern escaped with \\"""
+    like = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return like.replace("*", "%").replace("?", "_")
+
+
+def filter_challenges(query, chal_poly, filters):
+    """
+    Restrict a query of challenges to the ones matching filters, a dict
+    which may hold lists of 'category', 'tag', 'name' (glob patterns) and
+    'id' values, and a 'visibility'. A challenge must match one of the values
+    of every given filter.
+    """
+    from CTFd.models import db, Tags
+
+    if filters.get("category"):
+        query = query.filter(chal_poly.category.in_(filters["category"]))
+    if filters.get("tag"):
+        tagged = db.session.query(Tags.challenge_id).filter(Tags.value.in_(filters["tag"]))
+        query = query.filter(chal_poly.id.in_(tagged))
+    if filters.get("name"):
+        query = query.filter(
+            db.or_(
+                *[
+                    chal_poly.name.like(_glob_to_like(pattern), escape="\\")
+                    for pattern in filters["name"]
+                ]
+            )
+        )
+    if filters.get("id"):
+        query = query.filter(chal_poly.id.in_(filters["id"]))
+    if filters.get("visibility"):
+        query = query.filter(chal_poly.state == filters["visibility"])
+    return query
+
+
+def _select_challenges(chal_poly, filters, with_prerequisites, graph):
+    """
+    Load the challenges matching filters and, if with_prerequisites is set,
+    their prerequisites, transitively, resolved with graph, the
+    PrerequisiteGraph of all challenges by id. The challenges are sorted by
+    value.
+    """
+    from CTFd.models import db
+
+    chals = filter_challenges(db.session.query(chal_poly), chal_poly, filters).all()
+    selected = {chal.id: chal for chal in chals}
+    if with_prerequisites:
+        # Prerequisites which were deleted are not in the graph
+        missing = sorted(graph.closure(selected) - set(selected))
+        for chunk in _chunks(missing):
+            selected.update(
+                (chal.id, chal)
+                for chal in db.session.query(chal_poly).filter(chal_poly.id.in_(chunk))
+            )
 
-    chals = Challenges.query.order_by(Challenges.value).all()
+    return sorted(selected.values(), key=lambda chal: chal.value or 0)
+
+
+def _query_children(model, chal_ids):
+    """Child rows of the challenges chal_ids, or of all challenges if it is None"""
+    if chal_ids is None:
+        return model.query.order_by(model.id).all()
+    rows = []
+    for chunk in _chunks(sorted(chal_ids)):
+        rows.extend(model.query.filter(model.challenge_id.in_(chunk)))
+    rows.sort(key=lambda row: row.id)
+    return rows
+
+
+def challenge_properties(chal, flag_objs, tag_objs, hint_objs, chal_names):
+    """
+    Build the portable representation of a challenge, without its files.
+    chal_names maps challenge ids to names to resolve the prerequisites.
+    """
+    properties = {
+        "name": chal.name,
+        "description": chal.description,
+        "category": chal.category,
+        "type": chal.type
+    }
+
+    flags = []
+    for flag_obj in flag_objs:
+        flag = {}
+        flag["flag"] = flag_obj.content
+        if flag_obj.type != "static":
+            flag["type"] = flag_obj.type
+        flags.append(flag)
+    properties["flags"] = flags
+
+    if chal.state == "hidden":
+        properties["hidden"] = True
+    if chal.max_attempts != 0: 
+        properties["max_attempts"] = chal.max_attempts
+
+    if chal.type =="dynamic":
+        properties["value"] = chal.initial
+        if chal.minimum:
+            properties["minimum"] = chal.minimum
+        if chal.decay:
+            properties["decay"] = chal.decay
+    else:
+        properties["value"] = chal.value
+
+    tags = []
+    for tag_obj in tag_objs:
+        tags.append(tag_obj.value)
+    if tags:
+        properties["tags"] = tags
+
+    prerequisites = []
+    if chal.requirements:
+        for req in chal.requirements['prerequisites']:
+            if req in chal_names:
+                prerequisites.append(chal_names[req])
+    if prerequisites:
+        properties["prerequisites"] = prerequisites
+
+    hints = []
+    for hint_obj in hint_objs:
+        hint = { 
+            "content": hint_obj.content,
+            "cost": hint_obj.cost
+        }
+        hints.append(hint)
+    if hints:
+        properties["hints"] = hints
+
+    return properties
+
+
+def collect_challenges(
+    out_file,
+    dst_attachments,
+    src_attachments,
+    filters=None,
+    with_prerequisites=False,
+    workers=DEFAULT_WORKERS,
+    since=None,
+):
+    """
+    Build the portable representation of the challenges. Returns the list of
+    challenge properties, a map of the attachments to export, from their
+    path in src_attachments to their path in dst_attachments, a map of
+    the attachments to export as hard links, from their path in
+    dst_attachments to the path of the exported attachment they link to, and
+    the manifest of the export (see manifest.py).
+
+    Attachments are exported once per content, as
+    dst_attachments/<sha256>/<filename>, however many challenges they are
+    attached to. The same content attached under another name is linked to
+    the first one.
+
+    Only the challenges matching filters are exported (see
+    filter_challenges), along with their prerequisites if with_prerequisites
+    is set. Otherwise prerequisites which are not exported are still listed,
+    and must exist where the export is imported.
+
+    If since, the manifest of a previous export, is given, only the
+    challenges which changed since are exported, and only the attachments
+    it did not hold with the same name. Attachments it lists are not hashed
+    again, since stored attachments are never modified in place.
+    """
+    from CTFd.models import db, Challenges, Flags, Tags, Hints, ChallengeFiles
+    from sqlalchemy.orm import with_polymorphic
+
+    # Load the columns of every challenge type (e.g. dynamic challenges) in
+    # the same query rather than lazily, one challenge at a time
+    chal_poly = with_polymorphic(Challenges, "*")
     chals_list = []
+    export_map = {}
+    links = {}
+    fingerprints = {}
+    attachments = {}
+    known = since["attachments"] if since is not None else {}
+    # Importers find the attachments of the previous export by name and
+    # content, the ones renamed since are exported again
+    known_files = {
+        (digest, os.path.basename(location)) for location, digest in known.items()
+    }
+
+    if filters and any(filters.get(name) for name in FILTERS):
+        # Prerequisites which are not exported are listed by name as well
+        chal_names = {}
+        graph = PrerequisiteGraph()
+        for chal_id, name, requirements in db.session.query(
+            Challenges.id, Challenges.name, Challenges.requirements
+        ):
+            chal_names[chal_id] = name
+            graph.add(chal_id, (requirements or {}).get("prerequisites", []))
+        chals = _select_challenges(chal_poly, filters, with_prerequisites, graph)
+        chal_ids = {chal.id for chal in chals}
+    else:
+        chals = db.session.query(chal_poly).order_by(chal_poly.value).all()
+        chal_ids = None
+        chal_names = {chal.id: chal.name for chal in chals}
+
+    # Fetch the child rows of all challenges at once, so that the number of
+    # queries does not depend on the number of challenges
+    chal_flags = _group_by_challenge(_query_children(Flags, chal_ids))
+    chal_tags = _group_by_challenge(_query_children(Tags, chal_ids))
+    chal_hints = _group_by_challenge(_query_children(Hints, chal_ids))
+    chal_files = _group_by_challenge(_query_children(ChallengeFiles, chal_ids))
+
+    digests = {
+        os.path.join(src_attachments, location): digest
+        for location, digest in known.items()
+    }
+    digests.update(
+        sha256_files(
+            {
+                os.path.join(src_attachments, file_row.location)
+                for file_rows in chal_files.values()
+                for file_row in file_rows
+                if file_row.location not in known
+            },
+            workers,
+        )
+    )
+    # First exported path of every content
+    exported = {}
 
     for chal in chals:
-        properties = {
-            "name": chal.name,
-            "description": chal.description,
-            "category": chal.category,
-            "type": chal.type
-        }
+        properties = challenge_properties(
+            chal,
+            chal_flags.get(chal.id, []),
+            chal_tags.get(chal.id, []),
+            chal_hints.get(chal.id, []),
+            chal_names,
+        )
 
-        flags = []
-        for flag_obj in Flags.query.filter_by(challenge_id=chal.id):
-            flag = {}
-            flag["flag"] = flag_obj.content
-            if flag_obj.type != "static":
-                flag["type"] = flag_obj.type
-            flags.append(flag)
-        properties["flags"] = flags
-
-        if chal.state == "hidden":
-            properties["hidden"] = True
-        if chal.max_attempts != 0: 
-            properties["max_attempts"] = chal.max_attempts
-
-        if chal.type =="dynamic":
-            properties["value"] = chal.initial
-            if chal.minimum:
-                properties["minimum"] = chal.minimum
-            if chal.decay:
-                properties["decay"] = chal.decay
-        else:
-            properties["value"] = chal.value
-
-        tags = []
-        for tag_obj in Tags.query.filter_by(challenge_id=chal.id):
-            tags.append(tag_obj.value)
-        if tags:
-            properties["tags"] = tags
-
-        prerequisites = []
-        if chal.requirements:
-            for req in chal.requirements['prerequisites']:
-                reqChall = Challenges.query.filter_by(id=req).first()
-                if reqChall != None:
-                    prerequisites.append(reqChall.name)
-        if prerequisites:
-            properties["prerequisites"] = prerequisites
-
-        hints = []
-        if chal.hints:
-            for hint_obj in chal.hints:
-                hint = { 
-                    "content": hint_obj.content,
-                    "cost": hint_obj.cost
-                }
-                hints.append(hint)
-        if hints:
-            properties["hints"] = hints
-
-        src_paths_rel = ChallengeFiles.query.filter_by(challenge_id=chal.id)
-
-        file_map = {}
         file_list = []
-        for src_path_rel in src_paths_rel:
-            dirname, filename = os.path.split(src_path_rel.location)
-            dst_dir = os.path.join(dst_attachments, dirname)
-            src_path = os.path.join(src_attachments, src_path_rel.location)
-            file_map[src_path] = os.path.join(dst_dir, filename)
+        file_paths = []
+        for file_row in chal_files.get(chal.id, []):
+            src_path = os.path.join(src_attachments, file_row.location)
+            digest = digests[src_path]
+            attachments[file_row.location] = digest
+            dst_dir = os.path.join(dst_attachments, digest)
+            filename = os.path.basename(file_row.location)
+            file_paths.append((src_path, os.path.join(dst_dir, filename), digest, filename))
 
             # Create path relative to the output file
             dst_dir_rel = os.path.relpath(dst_dir, start=os.path.dirname(out_file))
             file_list.append(os.path.join(dst_dir_rel, filename))
 
-        if file_map:
+        if file_list:
             properties["files"] = file_list
-            if tarfile:
-                tar_files(file_map, tarfile)
-            else:
-                copy_files(file_map)
 
-        print("Exporting", properties["name"])
+        fingerprint = export_fingerprint(properties)
+        fingerprints[properties["name"]] = fingerprint
+        if since is not None and since["challenges"].get(properties["name"]) == fingerprint:
+            continue
+
+        # Deltas do not hold the attachments of the previous export again
+        for src_path, dst_path, digest, filename in file_paths:
+            if (digest, filename) in known_files:
+                continue
+            if digest not in exported:
+                exported[digest] = dst_path
+                export_map[src_path] = dst_path
+            elif dst_path != exported[digest]:
+                links[dst_path] = exported[digest]
+
+        logger.info("Exporting %s", properties["name"])
         chals_list.append(properties)
 
-    data = { "challs": chals_list }
-    return yaml.safe_dump(
-        data, default_flow_style=False, allow_unicode=True, explicit_start=True
+    # Challenges left out by the filters still exist, they are not deleted
+    manifest = build_manifest(
+        fingerprints, attachments, since, existing=chal_names.values()
     )
+    return chals_list, export_map, links, manifest
+
+
+def iter_dump_challenges(chals, spec_format=DEFAULT_FORMAT):
+    """
+    Serialize the spec of chals in spec_format (see formats.FORMATS) one
+    challenge at a time, generating the text of the document and then of
+    each challenge, so that the text of the whole spec is never held in
+    memory. The text is the same as the one of dump_challenges.
+    """
+    return FORMATS[spec_format].serialize(chals)
+
+
+def dump_challenges(chals_list, spec_format=DEFAULT_FORMAT):
+    return "".join(iter_dump_challenges(chals_list, spec_format))
+
+
+def write_challenges(chals, sink, spec_format=DEFAULT_FORMAT):
+    """Write the spec of chals to the binary file sink, one challenge at a time"""
+    size = 0
+    for text in iter_dump_challenges(chals, spec_format):
+        data = text.encode("utf-8")
+        sink.write(data)
+        size += len(data)
+    return size
+
+
+def spool_challenges(chals, spec_format=DEFAULT_FORMAT):
+    """
+    Spec of chals in a binary file, rewound, which is only written to disk
+    if it is larger than SPEC_SPOOL_SIZE
+    """
+    spec = SpooledTemporaryFile(max_size=SPEC_SPOOL_SIZE)
+    write_challenges(chals, spec, spec_format)
+    spec.seek(0)
+    return spec
+
+
+def _spec_file(data):
+    """File object and size of a spec given as text, bytes or a binary file"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if isinstance(data, bytes):
+        return BytesIO(data), len(data)
+    data.seek(0, os.SEEK_END)
+    size = data.tell()
+    data.seek(0)
+    return data, size
+
+
+def shard_challenges(chals_list, spec_name="challenges.yaml", spec_format=DEFAULT_FORMAT):
+    """
+    Split the spec into a file per challenge, <category>/<name>/challenge.yaml
+    (challenge.json for JSON and NDJSON specs), whose attachment paths are
+    relative to its directory. Returns the list of (path, text) of the
+    files, starting with the index spec_name, which lists the others in
+    'specs'. All paths are relative to the directory of the spec.
+    """
+    spec_format = FORMATS[spec_format]
+    shard_format = FORMATS[spec_format.shard_format]
+    shards = []
+    used = set()
+    for chal in chals_list:
+        base_dir = posixpath.join(
+            secure_filename(chal.get("category") or "") or "uncategorized",
+            secure_filename(chal["name"]) or "challenge",
+        )
+        # Names may only differ by characters secure_filename drops, or by
+        # case on case insensitive file systems
+        shard_dir = base_dir
+        suffix = 1
+        while shard_dir.lower() in used:
+            suffix += 1
+            shard_dir = "{0}-{1}".format(base_dir, suffix)
+        used.add(shard_dir.lower())
+
+        if "files" in chal:
+            chal = dict(chal)
+            chal["files"] = [
+                posixpath.relpath(filename.replace(os.sep, "/"), shard_dir)
+                for filename in chal["files"]
+            ]
+        shards.append(
+            (posixpath.join(shard_dir, spec_format.shard_name), shard_format.dump(chal))
+        )
+
+    index = spec_format.dump({"specs": [name for name, _ in shards]})
+    return [(spec_name, index)] + shards
+
+
+def export_challenges(
+    out_file,
+    dst_attachments,
+    src_attachments,
+    tarfile=None,
+    workers=DEFAULT_WORKERS,
+    filters=None,
+    with_prerequisites=False,
+    profile=None,
+    shards=False,
+    since=None,
+    spec_format=DEFAULT_FORMAT,
+):
+    """
+    Export the challenges, copying their attachments to dst_attachments or
+    adding them to tarfile, and return the spec in spec_format (see
+    formats.FORMATS), as a binary file (see spool_challenges), or its
+    shards if shards is set (see shard_challenges), and the manifest of the
+    export.
+    Only the changes since the export of the manifest since are exported,
+    if given (see collect_challenges). The timings of the export are
+    logged, and recorded in profile if given.
+    """
+    from CTFd.models import db
+
+    profile = profile or Profile("export")
+    count_queries(db.engine)
+    with profile.active():
+        with profile.phase("query"):
+            chals_list, file_map, links, manifest = collect_challenges(
+                out_file,
+                dst_attachments,
+                src_attachments,
+                filters,
+                with_prerequisites,
+                workers,
+                since,
+            )
+        with profile.phase("files"):
+            if tarfile:
+                size = tar_files(file_map, tarfile, workers, links)
+            else:
+                size = copy_files(file_map, workers, links)
+        profile.add_bytes("attachments", size)
+
+        with profile.phase("serialize"):
+            if shards:
+                spec = shard_challenges(
+                    chals_list, os.path.basename(out_file), spec_format
+                )
+            else:
+                spec = spool_challenges(chals_list, spec_format)
+        for _, data in spec if shards else [(out_file, spec)]:
+            profile.add_bytes("spec", _spec_file(data)[1])
+
+    profile.log()
+    return spec, manifest
+
+
+class _QueueWriter(object):
+    """
+    Write-only file object handing the written data over to a bounded queue,
+    blocking the writer while the queue is full
+    """
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.aborted = False
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def write(self, data):
+        if self.aborted:
+            # Data flushed while the aborted archive is cleaned up
+            return len(data)
+        if not self.put(bytes(data)):
+            self.aborted = True
+            raise IOError("Export stream was closed by the reader")
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def stream_export(
+    spec,
+    file_map,
+    links=None,
+    spec_name="challenges.yaml",
+    codec=DEFAULT_CODEC,
+    level=None,
+    max_chunks=64,
+    workers=DEFAULT_WORKERS,
+    profile=None,
+):
+    """
+    Generate a tar archive containing the spec, the exported attachments and
+    their links (see collect_challenges) as a stream of chunks, compressed with codec (see compression.CODECS).
+    spec is either the spec, stored as spec_name, or a list of (path, spec)
+    of a sharded spec, where specs are bytes or binary files (see
+    spool_challenges).
+    The archive is written by a background thread while the chunks are
+    consumed, so that no temporary copy of the archive is needed and memory
+    usage is bounded by max_chunks. The timings of the archive are logged
+    once it is complete, and recorded in profile if given.
+    """
+    profile = profile or Profile("export")
+    spec_files = spec if isinstance(spec, list) else [(spec_name, spec)]
+    chunks = queue.Queue(maxsize=max_chunks)
+    cancelled = threading.Event()
+
+    writer = _QueueWriter(chunks, cancelled)
+
+    def write_archive():
+        try:
+            # Time spent waiting for the reader is not part of the compression
+            compressed = profile.timed_writer(
+                CODECS[codec].writer(profile.timed_writer(writer, "send"), level, workers),
+                "compress",
+            )
+            with profile.phase("files"):
+                tarball = TarFile.open(fileobj=compressed, mode="w|")
+                # The spec comes first, so that it can be read before the
+                # attachments when the archive is processed as a stream
+                for name, data in spec_files:
+                    tarinfo = TarInfo(name)
+                    fileobj, tarinfo.size = _spec_file(data)
+                    with fileobj:
+                        tarball.addfile(tarinfo, fileobj)
+                profile.add_bytes("attachments", tar_files(file_map, tarball, workers, links))
+                tarball.close()
+                compressed.close()
+        except Exception as err:
+            writer.put(err)
+        else:
+            writer.put(None)
+
+    thread = threading.Thread(target=write_archive)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            profile.add_bytes("archive", len(chunk))
+            yield chunk
+        profile.log()
+    finally:
+        cancelled.set()
 
 
 if __name__ == "__main__":
     args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
     app = Flask(__name__)
 
-    tempfile = None
+    profile = Profile("export")
     tarfile = None
-    out_stream = None
     if args.tar:
-        out_stream = TemporaryFile(mode="wb+")
-        if args.gz:
-            tempfile = TemporaryFile(mode="wb+")
-            tarfile = TarFile(fileobj=tempfile, mode="w")
-        else:
-            tarfile = TarFile(name="export.tar", mode="w")
-    else:
-        out_stream = open(args.out_file, "w")
+        codec = CODECS[args.compression or ("gzip" if args.gz else "tar")]
+        # The archive is compressed as it is written, in a single pass
+        archive = open("export" + codec.extension, "wb")
+        compressed = profile.timed_writer(
+            codec.writer(archive, args.level, args.workers), "compress"
+        )
+        tarfile = TarFile.open(fileobj=compressed, mode="w|")
 
     with app.app_context():
         args = process_args(args)
@@ -226,24 +922,53 @@ if __name__ == "__main__":
 
         app.db = db
 
-        out_stream.write(
-            export_challenges(
-                args.out_file, args.dst_attachments, args.src_attachments, tarfile
+        since = None
+        if args.since:
+            with open(args.since, "rb") as f:
+                since = load_manifest(f.read())
+
+        with cprofiled(args.profile_output):
+            spec, manifest = export_challenges(
+                args.out_file,
+                args.dst_attachments,
+                args.src_attachments,
+                tarfile,
+                args.workers,
+                {name: getattr(args, name) for name in FILTERS},
+                args.with_prerequisites,
+                profile,
+                args.shards,
+                since,
+                args.spec_format,
             )
-        )
+
+    # Shards are written next to the output file, which lists them, and so
+    # is the manifest
+    out_dir = os.path.dirname(args.out_file)
+    if args.shards:
+        spec_files = [(os.path.join(out_dir, name), text) for name, text in spec]
+    else:
+        spec_files = [(args.out_file, spec)]
+    spec_files.append((os.path.join(out_dir, MANIFEST_NAME), dump_manifest(manifest)))
 
     if args.tar:
         print("Tarballing exported files")
-        tarinfo = TarInfo(args.out_file)
-        tarinfo.size = out_stream.tell()
-        out_stream.seek(0)
-        tarfile.addfile(tarinfo, out_stream)
-        tarfile.close()
-
-        if args.gz:
-            print("Compressing tarball with gzip")
-            with gzip.open("export.tar.gz", "wb") as gz:
-                tempfile.seek(0)
-                shutil.copyfileobj(tempfile, gz)
-
-    out_stream.close()
+        with profile.phase("files"):
+            for name, data in spec_files:
+                tarinfo = TarInfo(name)
+                fileobj, tarinfo.size = _spec_file(data)
+                with fileobj:
+                    tarfile.addfile(tarinfo, fileobj)
+            tarfile.close()
+            compressed.close()
+        archive.close()
+    else:
+        for name, data in spec_files:
+            if os.path.dirname(name):
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+            fileobj, _ = _spec_file(data)
+            with fileobj, open(name, "wb") as out_stream:
+                shutil.copyfileobj(fileobj, out_stream)
+
+    if args.profile:
+        print(json.dumps(profile.summary(), indent=2))
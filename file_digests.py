@@ -0,0 +1,20 @@
+"""
+Digests of the stored attachments. Uploaders such as S3 store attachments
+where the plugin can not read them back, so the importer keeps the sha256
+and size of every attachment it stores along with its ChallengeFiles row,
+and compares the attachments of a spec against them rather than against
+the stored files. A digest only holds while the row keeps its location.
+"""
+from CTFd.models import db
+
+
+class PortableFileDigest(db.Model):
+    """sha256 and size of the stored attachment of a ChallengeFiles row"""
+
+    __tablename__ = "portable_file_digest"
+    file_id = db.Column(
+        db.Integer, db.ForeignKey("files.id", ondelete="CASCADE"), primary_key=True
+    )
+    location = db.Column(db.Text, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
@@ -0,0 +1,303 @@
+"""
+Formats of the challenge specs. The same schema, documents holding a
+'challs' list of challenges or a 'specs' list of other spec files, is read
+and written as YAML, meant to be written by hand, as JSON, or as
+newline-delimited JSON, which holds a challenge per line and is both the
+fastest to parse and the simplest to stream or split. The format of a spec
+is detected from the extension of its name.
+"""
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.events import (
+    MappingEndEvent,
+    MappingStartEvent,
+    SequenceEndEvent,
+    SequenceStartEvent,
+    StreamEndEvent,
+)
+from yaml.resolver import Resolver
+import json
+import posixpath
+import yaml
+
+try:
+    from yaml.cyaml import CParser
+
+    class _SpecLoader(CParser, Composer, SafeConstructor, Resolver):
+        """
+        libyaml based loader which can also compose single nodes, to parse the
+        challenges one at a time
+        """
+
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+
+
+except ImportError:  # PyYAML was built without libyaml
+    _SpecLoader = yaml.SafeLoader
+
+try:
+    from yaml import CSafeDumper as SpecDumper
+except ImportError:  # PyYAML was built without libyaml
+    from yaml import SafeDumper as SpecDumper
+
+
+DEFAULT_FORMAT = "yaml"
+
+
+def _is_spec_list(specs):
+    return isinstance(specs, list) and all(isinstance(spec, str) for spec in specs)
+
+
+def _load_node(loader):
+    return loader.construct_document(loader.compose_node(None, None))
+
+
+def iter_yaml(in_stream, shards=None):
+    """
+    Parse the challenges of a YAML spec one at a time, so that only a single
+    challenge is held in memory. Every document of the stream must contain a
+    'challs' list; the challenges of all documents are generated in order.
+    If shards is given, documents may list other spec files or directories
+    in 'specs' instead, which are added to shards.
+    """
+    loader = _SpecLoader(in_stream)
+    try:
+        loader.get_event()
+        documents = 0
+        while not loader.check_event(StreamEndEvent):
+            loader.get_event()
+            documents += 1
+            has_challs = False
+            if loader.check_event(MappingStartEvent):
+                loader.get_event()
+                while not loader.check_event(MappingEndEvent):
+                    key = _load_node(loader)
+                    if key == "challs" and loader.check_event(SequenceStartEvent):
+                        has_challs = True
+                        loader.get_event()
+                        while not loader.check_event(SequenceEndEvent):
+                            yield _load_node(loader)
+                        loader.get_event()
+                    elif key == "specs" and shards is not None:
+                        specs = _load_node(loader)
+                        if not _is_spec_list(specs):
+                            raise ValueError("Field 'specs' must be a list of paths.")
+                        has_challs = True
+                        shards.extend(specs)
+                    else:
+                        _load_node(loader)
+                loader.get_event()
+            else:
+                _load_node(loader)
+
+            if not has_challs:
+                raise ValueError("Invalid YAML format. Missing field 'challs'.")
+            loader.get_event()
+            loader.anchors = {}
+
+        if documents == 0:
+            raise ValueError("Invalid YAML format. Missing field 'challs'.")
+    except yaml.YAMLError as err:
+        raise ValueError("Invalid YAML format. {0}".format(err))
+    finally:
+        loader.dispose()
+
+
+def _load_yaml(data):
+    try:
+        return yaml.load(data, Loader=_SpecLoader)
+    except yaml.YAMLError as err:
+        raise ValueError(err)
+
+
+def _dump_yaml(data, explicit_start=True):
+    return yaml.dump(
+        data,
+        Dumper=SpecDumper,
+        default_flow_style=False,
+        allow_unicode=True,
+        explicit_start=explicit_start,
+    )
+
+
+def iter_dump_yaml(chals):
+    """
+    Serialize the spec of chals one challenge at a time, generating the YAML
+    text of the document and then of each challenge, so that the text of
+    the whole spec is never held in memory
+    """
+    yield "---\n"
+    empty = True
+    for chal in chals:
+        if empty:
+            yield "challs:\n"
+            empty = False
+        # Sequences are not indented in mappings, the items of the 'challs'
+        # list are the same as the ones of a list on its own
+        yield _dump_yaml([chal], explicit_start=False)
+    if empty:
+        yield "challs: []\n"
+
+
+def _dump_json(data):
+    return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def iter_json(in_stream, shards=None):
+    """
+    Parse the challenges of a JSON spec, a single object holding the
+    'challs' list, or 'specs' if shards is given (see iter_yaml). The whole
+    document is parsed at once.
+    """
+    try:
+        spec = json.loads(in_stream.read())
+    except ValueError as err:
+        raise ValueError("Invalid JSON format. {0}".format(err))
+    if not isinstance(spec, dict) or not (
+        isinstance(spec.get("challs"), list) or (shards is not None and "specs" in spec)
+    ):
+        raise ValueError("Invalid JSON format. Missing field 'challs'.")
+    if shards is not None and "specs" in spec:
+        if not _is_spec_list(spec["specs"]):
+            raise ValueError("Field 'specs' must be a list of paths.")
+        shards.extend(spec["specs"])
+    for chal in spec.get("challs") or []:
+        yield chal
+
+
+def iter_dump_json(chals):
+    """Serialize the spec of chals as JSON, a challenge per line"""
+    separator = '{"challs":[\n'
+    for chal in chals:
+        yield separator + _dump_json(chal)
+        separator = ",\n"
+    yield "]}\n" if separator == ",\n" else '{"challs":[]}\n'
+
+
+def iter_ndjson(in_stream, shards=None):
+    """
+    Parse the challenges of a newline-delimited JSON spec one line at a time.
+    Every line holds a challenge, or, if shards is given, an object with
+    only a 'specs' list of other spec files (see iter_yaml). Blank lines are
+    skipped.
+    """
+    for number, line in enumerate(in_stream, 1):
+        if not line.strip():
+            continue
+        try:
+            chal = json.loads(line)
+        except ValueError as err:
+            raise ValueError("Invalid NDJSON format on line {0}. {1}".format(number, err))
+        if shards is not None and isinstance(chal, dict) and list(chal) == ["specs"]:
+            if not _is_spec_list(chal["specs"]):
+                raise ValueError("Field 'specs' must be a list of paths.")
+            shards.extend(chal["specs"])
+        else:
+            yield chal
+
+
+def iter_dump_ndjson(chals):
+    """Serialize the spec of chals as newline-delimited JSON, a challenge per line"""
+    for chal in chals:
+        yield _dump_json(chal) + "\n"
+
+
+class SpecFormat(object):
+    """
+    A spec format, named title in messages. Specs are named
+    challenges<extension>, and the shards of a sharded spec shard_name,
+    which hold a single challenge in the format shard_format.
+    parse(stream, shards) generates the challenges of a spec read from a
+    text stream, and serialize(chals) the text of a spec.
+    """
+
+    def __init__(
+        self, name, title, extension, mimetype, parse, serialize, shard_format, load, dump
+    ):
+        self.name = name
+        self.title = title
+        self.extension = extension
+        self.mimetype = mimetype
+        self.parse = parse
+        self.serialize = serialize
+        self.shard_format = shard_format
+        self._load = load
+        self._dump = dump
+
+    @property
+    def spec_name(self):
+        return "challenges" + self.extension
+
+    @property
+    def shard_name(self):
+        return "challenge" + FORMATS[self.shard_format].extension
+
+    def load(self, data):
+        """
+        Single document of the format, e.g. a shard, given as text or bytes.
+        Raises a ValueError if it is invalid.
+        """
+        return self._load(data)
+
+    def dump(self, data):
+        """
+        Text of data as a single document of the format, e.g. a shard, or an
+        index spec listing other specs as {'specs': [...]}
+        """
+        return self._dump(data)
+
+
+FORMATS = {
+    "yaml": SpecFormat(
+        "yaml",
+        "YAML",
+        ".yaml",
+        "application/x-yaml",
+        iter_yaml,
+        iter_dump_yaml,
+        "yaml",
+        _load_yaml,
+        _dump_yaml,
+    ),
+    "json": SpecFormat(
+        "json",
+        "JSON",
+        ".json",
+        "application/json",
+        iter_json,
+        iter_dump_json,
+        "json",
+        json.loads,
+        lambda data: _dump_json(data) + "\n",
+    ),
+    # A shard holds a single challenge, which is the same in JSON
+    "ndjson": SpecFormat(
+        "ndjson",
+        "NDJSON",
+        ".ndjson",
+        "application/x-ndjson",
+        iter_ndjson,
+        iter_dump_ndjson,
+        "json",
+        json.loads,
+        lambda data: _dump_json(data) + "\n",
+    ),
+}
+
+EXTENSIONS = {spec_format.extension: name for name, spec_format in FORMATS.items()}
+EXTENSIONS.update({".yml": "yaml", ".jsonl": "ndjson"})
+
+# Names of the spec files and of the shards of every format, in order of
+# preference when several are found
+SPEC_NAMES = [FORMATS[name].spec_name for name in ["yaml", "json", "ndjson"]]
+SHARD_NAMES = [FORMATS[name].shard_name for name in ["yaml", "json"]]
+
+
+def detect_format(name):
+    """Format of the spec file name, from its extension, YAML if it is unknown"""
+    extension = posixpath.splitext(name)[1].lower()
+    return FORMATS[EXTENSIONS.get(extension, DEFAULT_FORMAT)]
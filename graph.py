@@ -0,0 +1,202 @@
+"""
+Dependency graph of the challenge prerequisites, built once from a spec or
+from the database and then resolved with dictionary lookups. It finds the
+prerequisites which do not exist and the cycles, which would lock their
+challenges forever, and orders the challenges so that every challenge
+comes after its prerequisites.
+"""
+import heapq
+
+
+class PrerequisiteGraph(object):
+    """
+    Prerequisites of challenges, keyed by challenge name or id. Nodes keep
+    the order they were added in, which orderings are stable with.
+    Prerequisites which are not nodes are dangling, and otherwise ignored.
+    """
+
+    def __init__(self):
+        self.prerequisites = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Graph by name of stored challenges, given as (id, name, requirements) rows"""
+        rows = list(rows)
+        names = {chal_id: name for chal_id, name, _ in rows}
+        graph = cls()
+        for _, name, requirements in rows:
+            graph.add(
+                name,
+                [
+                    names[chal_id]
+                    for chal_id in (requirements or {}).get("prerequisites", [])
+                    if chal_id in names
+                ],
+            )
+        return graph
+
+    def add(self, node, prerequisites=()):
+        """Set the prerequisites of node, replacing any previous ones"""
+        self.prerequisites[node] = list(dict.fromkeys(prerequisites))
+
+    def remove(self, node):
+        """Remove node, which becomes a dangling prerequisite of its dependents"""
+        self.prerequisites.pop(node, None)
+
+    def __contains__(self, node):
+        return node in self.prerequisites
+
+    def __iter__(self):
+        return iter(self.prerequisites)
+
+    def __len__(self):
+        return len(self.prerequisites)
+
+    def _edges(self, node):
+        return [prereq for prereq in self.prerequisites[node] if prereq in self.prerequisites]
+
+    def dangling(self, known=()):
+        """(node, prerequisite) pairs whose prerequisite is neither a node nor known"""
+        return [
+            (node, prereq)
+            for node, prereqs in self.prerequisites.items()
+            for prereq in prereqs
+            if prereq not in self.prerequisites and prereq not in known
+        ]
+
+    def cycles(self):
+        """
+        Nodes depending on themselves, grouped by strongly connected
+        component (Tarjan's algorithm, without recursion so that long
+        prerequisite chains do not hit the recursion limit)
+        """
+        position = {node: i for i, node in enumerate(self.prerequisites)}
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+
+        def visit(node):
+            index[node] = low[node] = len(index)
+            stack.append(node)
+            on_stack.add(node)
+            work.append((node, iter(self._edges(node))))
+
+        for root in self.prerequisites:
+            if root in index:
+                continue
+            work = []
+            visit(root)
+            while work:
+                node, edges = work[-1]
+                for prereq in edges:
+                    if prereq not in index:
+                        visit(prereq)
+                        break
+                    if prereq in on_stack:
+                        low[node] = min(low[node], index[prereq])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] != index[node]:
+                        continue
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in self.prerequisites[node]:
+                        cycles.append(sorted(component, key=position.get))
+        cycles.sort(key=lambda cycle: position[cycle[0]])
+        return cycles
+
+    def order(self, nodes=None):
+        """
+        Nodes (all of them by default) sorted so that each one comes after
+        its prerequisites, otherwise in the order they were added. Raises a
+        ValueError if the prerequisites form a cycle.
+        """
+        position = {node: i for i, node in enumerate(self.prerequisites)}
+        nodes = list(self.prerequisites) if nodes is None else list(nodes)
+        selected = set(nodes)
+        waiting = {}
+        dependents = {}
+        for node in nodes:
+            prereqs = [prereq for prereq in self._edges(node) if prereq in selected]
+            waiting[node] = len(prereqs)
+            for prereq in prereqs:
+                dependents.setdefault(prereq, []).append(node)
+
+        ready = [(position[node], node) for node in nodes if not waiting[node]]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            _, node = heapq.heappop(ready)
+            ordered.append(node)
+            for dependent in dependents.get(node, []):
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    heapq.heappush(ready, (position[dependent], dependent))
+
+        if len(ordered) != len(nodes):
+            raise ValueError(*cycle_errors(self.cycles()))
+        return ordered
+
+    def closure(self, nodes):
+        """nodes along with their prerequisites, transitively"""
+        closure = set()
+        pending = [node for node in nodes if node in self.prerequisites]
+        while pending:
+            node = pending.pop()
+            if node in closure:
+                continue
+            closure.add(node)
+            pending.extend(self._edges(node))
+        return closure
+
+    def groups(self, key):
+        """
+        Nodes split into groups which do not depend on each other: nodes with
+        the same key(node) share a group, and so do nodes and their
+        prerequisites. Groups are in the order of their first node, and keep
+        the order of their nodes.
+        """
+        parent = {node: node for node in self.prerequisites}
+
+        def find(node):
+            root = node
+            while parent[root] != root:
+                root = parent[root]
+            while parent[node] != root:
+                parent[node], node = root, parent[node]
+            return root
+
+        def join(node, other):
+            root, other_root = find(node), find(other)
+            if root != other_root:
+                parent[other_root] = root
+
+        first = {}
+        for node in self.prerequisites:
+            join(first.setdefault(key(node), node), node)
+            for prereq in self._edges(node):
+                join(node, prereq)
+
+        groups = {}
+        for node in self.prerequisites:
+            groups.setdefault(find(node), []).append(node)
+        return list(groups.values())
+
+
+def cycle_errors(cycles):
+    return [
+        "Prerequisites form a cycle between challenges {0}.".format(
+            ", ".join("'{0}'".format(node) for node in cycle)
+        )
+        for cycle in cycles
+    ]
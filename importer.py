@@ -2,20 +2,61 @@ from flask import Flask
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import OperationalError
-import yaml
+from werkzeug.utils import secure_filename
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import io
+import json
+import logging
+import multiprocessing
 import os
+import pickle
+import posixpath
+import re
+import shutil
 import sys
+import tarfile
+import tempfile
 import argparse
 
+try:
+    from .attachments import DEFAULT_WORKERS, INLINE_SIZE, BulkUploader
+    from .exporter import challenge_properties
+    from .formats import DEFAULT_FORMAT, FORMATS, SHARD_NAMES, SPEC_NAMES, detect_format
+    from .graph import PrerequisiteGraph, cycle_errors
+    from .manifest import MANIFEST_NAME, load_manifest
+    from .profiling import Profile, count_queries, cprofiled
+    from .utils import challenge_fingerprint, sha256_file, sha256_files, sha256_stream
+except ImportError:  # Running as a script
+    from attachments import DEFAULT_WORKERS, INLINE_SIZE, BulkUploader
+    from exporter import challenge_properties
+    from formats import DEFAULT_FORMAT, FORMATS, SHARD_NAMES, SPEC_NAMES, detect_format
+    from graph import PrerequisiteGraph, cycle_errors
+    from manifest import MANIFEST_NAME, load_manifest
+    from profiling import Profile, count_queries, cprofiled
+    from utils import challenge_fingerprint, sha256_file, sha256_files, sha256_stream
+
 
 REQ_FIELDS = ["name", "description", "value", "category", "flags"]
+CHALLENGE_TYPES = ["standard", "dynamic"]
+FLAG_TYPES = ["static", "regex"]
+BATCH_SIZE = 500
+# Below this number of shards, they are parsed without starting processes
+SHARD_POOL_MIN = 32
+# Below this number of challenges, imports are not split across processes,
+# which take about a second to start and import CTFd
+PARALLEL_IMPORT_MIN = 5000
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+logger = logging.getLogger(__name__)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description=(
             "Import CTFd challenges and their attachments "
-            "to a DB from a YAML formated specification "
+            "to a DB from a YAML, JSON or NDJSON specification "
             "file and an associated attachment directory"
         )
     )
@@ -45,8 +86,12 @@ def parse_args():
         "-i",
         dest="in_file",
         type=str,
-        help="name of the input YAML file (default: challenges.yaml)",
-        default="challenges.yaml",
+        help=(
+            "name of the input spec file, in YAML, JSON or NDJSON as given by "
+            "its extension, or of a directory of %s files (default: the first "
+            "of %s found)" % (" or ".join(SHARD_NAMES), ", ".join(SPEC_NAMES))
+        ),
+        default=None,
     )
     parser.add_argument(
         "--skip-on-error",
@@ -58,6 +103,36 @@ def parse_args():
         ),
         default=True,
     )
+    parser.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        help=(
+            "if set, challenges are rewritten even if they did not change "
+            "since the last import"
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "--validate-only",
+        dest="validate_only",
+        action="store_true",
+        help=(
+            "if set, the spec file and its attachments are only checked and "
+            "all errors are reported, without modifying the database"
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action="store_true",
+        help=(
+            "if set, challenges are parsed and imported in batches as the "
+            "spec file is read, to bound memory usage for very large files"
+        ),
+        default=False,
+    )
     parser.add_argument(
         "--move",
         dest="move",
@@ -65,6 +140,54 @@ def parse_args():
         help=("if set the import proccess will move files rather than " "copy them"),
         default=False,
     )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help=(
+            "number of attachments stored, and of spec shards parsed, in "
+            "parallel (default: %d)" % DEFAULT_WORKERS
+        ),
+        default=DEFAULT_WORKERS,
+    )
+    parser.add_argument(
+        "--processes",
+        dest="processes",
+        type=int,
+        help=(
+            "number of processes importing shards of the spec in parallel, "
+            "each in its own transaction, if it holds at least %d challenges "
+            "and the database is not SQLite (default: 1)" % PARALLEL_IMPORT_MIN
+        ),
+        default=1,
+    )
+    parser.add_argument(
+        "--lock-timeout",
+        dest="lock_timeout",
+        type=float,
+        help=(
+            "seconds to wait for an import running on the same database "
+            "(default: 300)"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help=(
+            "if set, a JSON summary of the time spent in each phase, the SQL "
+            "queries and the bytes moved is printed once done"
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        "--profile-output",
+        dest="profile_output",
+        type=str,
+        help="if given, the import runs under cProfile and its statistics are written to this file",
+        default=None,
+    )
     return parser.parse_args()
 
 
@@ -85,75 +208,1158 @@ def process_args(args):
         app.config["SQLALCHEMY_DATABASE_URI"] = args.db_uri
     if not args.dst_attachments:
         args.dst_attachments = os.path.join(app.root_path, app.config["UPLOAD_FOLDER"])
+    if not args.in_file:
+        args.in_file = next(
+            (name for name in SPEC_NAMES if os.path.exists(name)), SPEC_NAMES[0]
+        )
 
     return args
 
 
-def import_challenges(in_file, dst_attachments, move=False):
-    from CTFd.models import db, Challenges, Flags, Tags, ChallengeFiles, Hints
-    from CTFd.utils import uploads
-    from CTFd.plugins.dynamic_challenges import DynamicChallenge, DynamicValueChallenge
+def iter_challenges(in_stream, shards=None, spec_format=DEFAULT_FORMAT):
+    """
+    Parse the challenges of a spec read from the text stream in_stream, in
+    spec_format (see formats.FORMATS), as they are needed. If shards is
+    given, the spec may list other spec files or directories in 'specs'
+    instead, which are added to shards.
+    """
+    return FORMATS[spec_format].parse(in_stream, shards)
 
-    with open(in_file, "r") as in_stream:
-        data = list(yaml.safe_load_all(in_stream))
-        if len(data) == 0 or data[0] is None or "challs" not in data[0] or data[0]["challs"] is None:
-            raise ValueError("Invalid YAML format. Missing field 'challs'.")
 
-        for chal in data[0]["challs"]:
-            for req_field in REQ_FIELDS:
-                if req_field not in chal:
-                    raise ValueError("Invalid YAML format. Missing field '{0}'.".format(req_field))
+def load_challenges(in_file):
+    with open(in_file, "r", encoding="utf-8") as in_stream:
+        return list(iter_challenges(in_stream, spec_format=detect_format(in_file).name))
 
-            if chal.get("type", "standard") == "dynamic":
-                for req_field in ["minimum", "decay"]:
-                    if req_field not in chal:
-                        raise ValueError("Invalid YAML format. Missing field '{0}'.".format(req_field))
-                
-            if chal["flags"] is None:
-                raise ValueError("Invalid YAML format. Missing field 'flag'.")
 
-            for flag in chal["flags"]:
-                if "flag" not in flag:
-                    raise ValueError("Invalid YAML format. Missing field 'flag'.")
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
 
-                flag["flag"] = flag["flag"].strip()
-                if "type" not in flag:
-                    flag["type"] = "static"
 
-            matching_chal = Challenges.query.filter_by(
-                name=chal["name"].strip()
-            ).first()
-            if matching_chal:
-                print(
-                    ("Updating {}: Duplicate challenge " "found in DB (id: {})").format(
-                        chal["name"].encode("utf8"), matching_chal.id
+def _is_text(value):
+    return isinstance(value, str)
+
+
+def challenge_errors(chal, source):
+    """
+    Check a single challenge spec without modifying it. Returns the list of
+    problems found; attachments are looked up in source.
+    """
+    if not isinstance(chal, dict):
+        return ["Invalid YAML format. A challenge must be a mapping."]
+
+    errors = []
+    for req_field in REQ_FIELDS:
+        if chal.get(req_field) is None:
+            errors.append("Invalid YAML format. Missing field '{0}'.".format(req_field))
+
+    for field in ["name", "description", "category"]:
+        if chal.get(field) is not None and not _is_text(chal[field]):
+            errors.append("Field '{0}' must be text.".format(field))
+
+    chal_type = chal.get("type", "standard")
+    if chal_type not in CHALLENGE_TYPES:
+        errors.append("Unknown type of challenge '{0}'.".format(chal_type))
+
+    int_fields = ["value", "max_attempts"]
+    if chal_type == "dynamic":
+        for req_field in ["minimum", "decay"]:
+            if chal.get(req_field) is None:
+                errors.append("Invalid YAML format. Missing field '{0}'.".format(req_field))
+        int_fields += ["minimum", "decay"]
+    for field in int_fields:
+        if chal.get(field) is not None and not (_is_int(chal[field]) and chal[field] >= 0):
+            errors.append("Field '{0}' must be a non-negative integer.".format(field))
+
+    if chal.get("decay") == 0 and chal_type == "dynamic":
+        errors.append("Field 'decay' must be a positive integer.")
+
+    if "hidden" in chal and not isinstance(chal["hidden"], bool):
+        errors.append("Field 'hidden' must be true or false.")
+
+    flags = chal.get("flags")
+    if flags is not None and not isinstance(flags, list):
+        errors.append("Field 'flags' must be a list.")
+    elif flags:
+        for flag in flags:
+            if not isinstance(flag, dict) or not _is_text(flag.get("flag")):
+                errors.append("Invalid YAML format. Missing field 'flag'.")
+            elif flag.get("type", "static") not in FLAG_TYPES:
+                errors.append("Unknown type of flag '{0}'.".format(flag["type"]))
+
+    hints = chal.get("hints", [])
+    if not isinstance(hints, list):
+        errors.append("Field 'hints' must be a list.")
+    else:
+        for hint in hints:
+            if (
+                not isinstance(hint, dict)
+                or not _is_text(hint.get("content"))
+                or not _is_int(hint.get("cost"))
+            ):
+                errors.append("Hints must have a text 'content' and an integer 'cost'.")
+
+    tags = chal.get("tags", [])
+    if not isinstance(tags, list) or any(isinstance(tag, (dict, list)) for tag in tags):
+        errors.append("Field 'tags' must be a list of single line texts.")
+
+    prerequisites = chal.get("prerequisites", [])
+    if not isinstance(prerequisites, list) or not all(map(_is_text, prerequisites)):
+        errors.append("Field 'prerequisites' must be a list of challenge names.")
+
+    files = chal.get("files", [])
+    if not isinstance(files, list) or not all(map(_is_text, files)):
+        errors.append("Field 'files' must be a list of file paths.")
+    else:
+        for filename in files:
+            filepath = os.path.normpath(filename)
+            if os.path.isabs(filepath) or filepath.split(os.sep)[0] == "..":
+                errors.append("File path outside of the archive: " + filename)
+            elif not source.exists(filename):
+                errors.append("Missing file: " + filename)
+
+    return errors
+
+
+def normalize_challenge(chal):
+    for flag in chal["flags"]:
+        flag["flag"] = flag["flag"].strip()
+        if "type" not in flag:
+            flag["type"] = "static"
+
+
+def validate_challenges(chals, source, known_names=None, seen=None, start=1, stored=None):
+    """
+    Check all challenges of a spec, which can be any iterable of challenges,
+    and return every error found along with the index and name of the
+    challenge. Only names are kept in memory. Prerequisites are checked
+    against the spec and known_names, unless known_names is None, and for
+    cycles, through the prerequisites of the stored challenges as well if
+    stored, their PrerequisiteGraph, is given. seen maps the names of
+    previously validated challenges to their index.
+    """
+    errors = []
+    if seen is None:
+        seen = {}
+    graph = PrerequisiteGraph()
+    for index, chal in enumerate(chals, start):
+        name = chal.get("name") if isinstance(chal, dict) else None
+        name = name.strip() if _is_text(name) else None
+
+        def error(message):
+            errors.append("Challenge #{0} ({1}): {2}".format(index, name, message))
+
+        for message in challenge_errors(chal, source):
+            error(message)
+
+        if name is not None:
+            if name in seen:
+                error("Duplicate challenge, also defined as challenge #{0}.".format(seen[name]))
+            else:
+                seen[name] = index
+            prerequisites = chal.get("prerequisites")
+            if isinstance(prerequisites, list):
+                graph.add(name, [p for p in prerequisites if _is_text(p)])
+            else:
+                graph.add(name)
+
+    if known_names is None:
+        return errors
+    for name, prerequisite in graph.dangling(known_names):
+        errors.append(
+            "Challenge #{0} ({1}): Unknown prerequisite '{2}'.".format(
+                seen[name], name, prerequisite
+            )
+        )
+
+    # The spec replaces the prerequisites of the stored challenges it holds
+    if stored is not None:
+        for name in stored:
+            if name not in graph:
+                graph.add(name, stored.prerequisites[name])
+    errors.extend(cycle_errors(graph.cycles()))
+    return errors
+
+
+def _parse_shard(shard):
+    """
+    Parse a spec shard, given as its name and either its content or, if it
+    is a str, its path. Returns the name, the challenge and an error.
+    """
+    name, data = shard
+    # Shards hold a single challenge, e.g. a single line of NDJSON
+    spec_format = FORMATS[detect_format(name).shard_format]
+    try:
+        if isinstance(data, str):
+            with open(data, "rb") as f:
+                data = f.read()
+        return name, spec_format.load(data), None
+    except (IOError, ValueError) as err:
+        return name, None, "Invalid {0} format in '{1}'. {2}".format(
+            spec_format.title, name, err
+        )
+
+
+def _parse_shards(source, names, workers=DEFAULT_WORKERS):
+    """
+    Parse the challenges of the spec shards names of source, on a pool of
+    workers processes if there are enough of them. The attachment paths of
+    a shard are relative to its directory, and are made relative to the
+    root of source.
+    """
+    if source.concurrent:
+        shards = [(name, source.path(name)) for name in names]
+    else:
+        # Read in archive order, archives are slow to seek back in
+        content = {name: None for name in names}
+        for name in source.in_order(names):
+            with source.open(name) as f:
+                content[name] = f.read()
+        shards = list(content.items())
+
+    if workers > 1 and len(shards) >= SHARD_POOL_MIN:
+        # Spawned rather than forked, web imports run in a thread of a
+        # multi-threaded server, whose locks forked children would inherit
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            parsed = list(
+                executor.map(
+                    _parse_shard, shards, chunksize=max(1, len(shards) // (workers * 4))
+                )
+            )
+    else:
+        parsed = [_parse_shard(shard) for shard in shards]
+
+    errors = [error for _, _, error in parsed if error]
+    if errors:
+        raise ValueError(*errors)
+    for name, chal, _ in parsed:
+        if isinstance(chal, dict) and isinstance(chal.get("files"), list):
+            base_dir = posixpath.dirname(name)
+            chal["files"] = [
+                posixpath.normpath(posixpath.join(base_dir, filename))
+                if _is_text(filename)
+                else filename
+                for filename in chal["files"]
+            ]
+        yield chal
+
+
+def _find_shards(source, name):
+    shards = sorted(
+        shard for shard_name in SHARD_NAMES for shard in source.find(name, shard_name)
+    )
+    if not shards:
+        raise ValueError(
+            "Missing challenge specification, no {0} in '{1}'.".format(
+                " or ".join("'{0}'".format(shard_name) for shard_name in SHARD_NAMES),
+                name or ".",
+            )
+        )
+    return shards
+
+
+def _spec_challenges(in_file, source, workers):
+    if source.isdir(in_file):
+        for chal in _parse_shards(source, _find_shards(source, in_file), workers):
+            yield chal
+        return
+
+    if not source.exists(in_file):
+        raise ValueError("Missing challenge specification '{0}'.".format(in_file))
+    shards = []
+    spec_format = detect_format(in_file).name
+    with io.TextIOWrapper(source.open(in_file), encoding="utf-8") as in_stream:
+        for chal in iter_challenges(in_stream, shards, spec_format):
+            yield chal
+
+    # Specs listed by an index are relative to it
+    names = []
+    for shard in shards:
+        name = posixpath.normpath(posixpath.join(posixpath.dirname(in_file), shard))
+        if posixpath.isabs(name) or name.split("/")[0] == "..":
+            raise ValueError("Specification path outside of the archive: " + shard)
+        if source.isdir(name):
+            names.extend(_find_shards(source, name))
+        elif source.exists(name):
+            names.append(name)
+        else:
+            raise ValueError("Missing challenge specification '{0}'.".format(shard))
+    for chal in _parse_shards(source, names, workers):
+        yield chal
+
+
+def _read_manifest(in_file, source):
+    """Manifest of a delta export next to the spec in_file, or None"""
+    spec_dir = in_file if source.isdir(in_file) else posixpath.dirname(in_file)
+    name = posixpath.join(spec_dir, MANIFEST_NAME)
+    if not source.exists(name):
+        return None
+    with source.open(name) as f:
+        manifest = load_manifest(f.read())
+    return manifest if manifest["delta"] else None
+
+
+def open_spec(in_file, source=None, workers=DEFAULT_WORKERS, dst_attachments=None):
+    """
+    Generate the challenges of the spec in_file, along with the source of
+    their attachments: the directory of in_file, or in_file itself if it is
+    a directory, unless source is given, in which case in_file is the name
+    of the spec within source ("" for its root). If the spec is a delta
+    export and dst_attachments is given, the source is a DeltaSource.
+
+    The spec is a YAML, JSON or NDJSON file, as given by its extension (see
+    formats.detect_format), listing its challenges in 'challs', which are
+    parsed as a stream, and may list other specs in 'specs', or a directory
+    of shards: 'challenge.yaml' or 'challenge.json' files holding a single
+    challenge each, e.g. one per challenge directory. Shards are parsed in
+    parallel, by workers processes.
+    """
+    if source is None:
+        if os.path.isdir(in_file):
+            source = DirectorySource(in_file)
+            in_file = ""
+        else:
+            source = DirectorySource(os.path.dirname(in_file))
+            in_file = os.path.basename(in_file)
+    if dst_attachments is not None:
+        manifest = _read_manifest(in_file, source)
+        if manifest is not None:
+            source = DeltaSource(source, dst_attachments, manifest)
+    return _spec_challenges(in_file, source, workers), source
+
+
+def validate_spec(
+    in_file,
+    known_names=None,
+    source=None,
+    profile=None,
+    workers=DEFAULT_WORKERS,
+    dst_attachments=None,
+):
+    """
+    Validate a spec (see open_spec) without modifying the database, parsing
+    it as a stream. Returns the list of all errors found. Unless given,
+    known_names are the names of the challenges in the database. The
+    attachments which delta exports do not hold are looked up in
+    dst_attachments, if given.
+    """
+    profile = profile or Profile("validation")
+    stored = None
+    try:
+        chals, source = open_spec(in_file, source, workers, dst_attachments)
+        if known_names is None:
+            from CTFd.models import db, Challenges
+
+            count_queries(db.engine)
+            with profile.active(), profile.phase("db"):
+                stored = PrerequisiteGraph.from_rows(
+                    db.session.query(
+                        Challenges.id, Challenges.name, Challenges.requirements
                     )
                 )
-                Tags.query.filter_by(challenge_id=matching_chal.id).delete()
-                ChallengeFiles.query.filter_by(challenge_id=matching_chal.id).delete()
-                Flags.query.filter_by(challenge_id=matching_chal.id).delete()
-                Hints.query.filter_by(challenge_id=matching_chal.id).delete()
+            known_names = set(stored)
+        # Challenges deleted by a delta can not be prerequisites anymore
+        if isinstance(source, DeltaSource):
+            known_names = set(known_names) - set(source.manifest["deleted"])
+
+        with profile.phase("validate"):
+            return validate_challenges(
+                _timed(chals, profile, "parse"), source, known_names, stored=stored
+            )
+    except ValueError as err:
+        return list(err.args)
+    finally:
+        profile.log()
+
+
+def _chunks(items, size=500):
+    # Keep IN clauses below the bound parameter limits of the DB backends
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _dynamic_values(challenges):
+    """
+    Compute the current value of dynamic challenges in one query. This
+    mirrors DynamicValueChallenge.calculate_value, which commits the session
+    and can therefore not be used inside the import transaction.
+    """
+    from CTFd.models import db, Solves
+    from CTFd.utils.modes import get_model
+    from sqlalchemy import func
+    import math
+
+    Model = get_model()
+    solve_counts = {}
+    ids = [chal.id for chal in challenges]
+    for ids_chunk in _chunks(ids):
+        solve_counts.update(
+            db.session.query(Solves.challenge_id, func.count(Solves.id))
+            .join(Model, Solves.account_id == Model.id)
+            .filter(
+                Solves.challenge_id.in_(ids_chunk),
+                Model.hidden == False,
+                Model.banned == False,
+            )
+            .group_by(Solves.challenge_id)
+            .all()
+        )
+
+    for chal in challenges:
+        solve_count = solve_counts.get(chal.id, 0)
+        # The first solve does not decrease the value
+        if solve_count != 0:
+            solve_count -= 1
+
+        value = (
+            ((chal.minimum - chal.initial) / (chal.decay ** 2)) * (solve_count ** 2)
+        ) + chal.initial
+        chal.value = max(math.ceil(value), chal.minimum)
+
+
+def spec_properties(chal, known_names=None):
+    """
+    Build the portable representation of a validated challenge spec the way
+    the exporter would after importing it, so that both can be compared.
+    If given, known_names are the names of the challenges which will exist
+    after the import, since prerequisites on other challenges are skipped.
+    """
+    properties = {
+        "name": chal["name"].strip(),
+        "description": chal["description"].strip(),
+        "category": chal["category"].strip(),
+        "type": chal.get("type", "standard"),
+    }
+
+    flags = []
+    for flag in chal["flags"]:
+        flag_properties = {"flag": flag["flag"]}
+        if flag["type"] != "static":
+            flag_properties["type"] = flag["type"]
+        flags.append(flag_properties)
+    properties["flags"] = flags
+
+    if chal.get("hidden") == True:
+        properties["hidden"] = True
+    if chal.get("max_attempts", 0) != 0:
+        properties["max_attempts"] = chal["max_attempts"]
+
+    properties["value"] = int(chal["value"])
+    if properties["type"] == "dynamic":
+        if chal["minimum"]:
+            properties["minimum"] = int(chal["minimum"])
+        if chal["decay"]:
+            properties["decay"] = int(chal["decay"])
+
+    tags = [str(tag) for tag in chal.get("tags", [])]
+    if tags:
+        properties["tags"] = tags
+
+    prerequisites = [
+        name
+        for name in chal.get("prerequisites", [])
+        if known_names is None or name in known_names
+    ]
+    if prerequisites:
+        properties["prerequisites"] = prerequisites
+
+    hints = [
+        {"content": hint["content"], "cost": hint["cost"]}
+        for hint in chal.get("hints", [])
+    ]
+    if hints:
+        properties["hints"] = hints
+
+    return properties
+
+
+class _Source(object):
+    """
+    Attachments of a spec, which are looked up by their path in the spec.
+    Exports store every content once and link the other paths to it (e.g.
+    files/<sha256>/<filename>), linked paths are only hashed once.
+    Attachments can be opened from several threads if concurrent is set.
+    """
+
+    concurrent = False
+    # Sources can be sent to the processes of a parallel import, which open
+    # them again
+    reopenable = True
+
+    def __init__(self):
+        self.digests = {}
+
+    def content(self, name):
+        """Key shared by the paths of the same stored content"""
+        return name
+
+    def digest(self, name):
+        key = self.content(name)
+        if key not in self.digests:
+            with self.open(name) as f:
+                self.digests[key] = sha256_stream(f)
+        return self.digests[key]
+
+    def hash_all(self, names):
+        for name in names:
+            self.digest(name)
+
+    def in_order(self, names):
+        """names in the order they are best read in"""
+        return names
+
+
+class DirectorySource(_Source):
+    """Attachments stored in a directory, e.g. the one of the spec file"""
+
+    concurrent = True
+
+    def __init__(self, base_dir):
+        super(DirectorySource, self).__init__()
+        self.base_dir = base_dir
+
+    def path(self, name):
+        return os.path.join(self.base_dir, name)
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def isdir(self, name):
+        return os.path.isdir(self.path(name))
+
+    def find(self, directory, basename):
+        """Paths of the files named basename within directory, sorted"""
+        found = []
+        for root, dirs, files in os.walk(self.path(directory)):
+            if basename in files:
+                path = os.path.relpath(os.path.join(root, basename), self.base_dir)
+                found.append(path.replace(os.sep, "/"))
+        return sorted(found)
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def open(self, name):
+        return open(self.path(name), "rb")
+
+    def content(self, name):
+        stat = os.stat(self.path(name))
+        return stat.st_dev, stat.st_ino
+
+    def hash_all(self, names):
+        paths = {}
+        for name in names:
+            key = self.content(name)
+            if key not in self.digests:
+                paths[key] = self.path(name)
+        digests = sha256_files(paths.values())
+        for key, path in paths.items():
+            self.digests[key] = digests[path]
+
+
+class TarSource(_Source):
+    """
+    Attachments read straight from a tar archive opened for random access,
+    without extracting it. Only regular files and hard links to them can be
+    read. Members are best read in archive order, since seeking back in a
+    compressed archive decompresses it again from the start. members, all
+    the members of archive by default, are indexed by name.
+    """
+
+    def __init__(self, archive, members=None):
+        super(TarSource, self).__init__()
+        self.archive = archive
+        self.members = {}
+        self.dirs = {"."}
+        # members may be read as the archive is scanned, in a single pass
+        for member in archive.getmembers() if members is None else members:
+            name = os.path.normpath(member.name)
+            if member.isfile():
+                self.members[name] = member
+            elif member.islnk():
+                target = self.members.get(os.path.normpath(member.linkname))
+                if target is not None:
+                    self.members[name] = target
+            elif member.isdir():
+                self.dirs.add(name)
+            # Archives do not need to hold the directories of their files
+            parent = os.path.dirname(name)
+            while parent and parent not in self.dirs:
+                self.dirs.add(parent)
+                parent = os.path.dirname(parent)
+
+    def exists(self, name):
+        return os.path.normpath(name) in self.members
+
+    def isdir(self, name):
+        return os.path.normpath(name or ".") in self.dirs
+
+    def find(self, directory, basename):
+        """Paths of the files named basename within directory, sorted"""
+        directory = os.path.normpath(directory or ".")
+        prefix = "" if directory == "." else directory + os.sep
+        return sorted(
+            name.replace(os.sep, "/")
+            for name in self.members
+            if name.startswith(prefix) and os.path.basename(name) == basename
+        )
+
+    def in_order(self, names):
+        # Seeking back in a compressed archive decompresses it again
+        return sorted(names, key=lambda name: self.members[os.path.normpath(name)].offset)
+
+    def size(self, name):
+        return self.members[os.path.normpath(name)].size
+
+    def content(self, name):
+        # Hard links resolve to the member holding the data
+        return self.members[os.path.normpath(name)].name
+
+    def open(self, name):
+        return self.archive.extractfile(self.members[os.path.normpath(name)])
+
+    @property
+    def reopenable(self):
+        # Archives decompressed to an anonymous temporary file have no name
+        return self.archive.name is not None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["archive"] = self.archive.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.archive = tarfile.open(self.archive)
+
+
+class DeltaSource(_Source):
+    """
+    Attachments of a delta export (see manifest.py). The attachments which
+    were exported before are not in the delta, and are found among the
+    stored attachments instead: the ones with the same name and the sha256
+    in their exported path (e.g. files/<sha256>/<filename>), by their
+    recorded digest or from dst_attachments. Their content can only be read
+    from dst_attachments, which is only needed if they are attached to
+    another challenge than before.
+    """
+
+    def __init__(self, source, dst_attachments, manifest):
+        super(DeltaSource, self).__init__()
+        self.source = source
+        self.concurrent = source.concurrent
+        self.dst_attachments = dst_attachments
+        self.manifest = manifest
+        self.stored = {}
+        self.stored_digests = {}
+        self.locations = None
+
+    def _load_locations(self):
+        from CTFd.models import db, ChallengeFiles
+        from sqlalchemy import and_
+
+        try:
+            from .file_digests import PortableFileDigest
+        except ImportError:  # Running as a script
+            from file_digests import PortableFileDigest
 
+        # Stored attachments by name, with their recorded digests, loaded once
+        self.locations = {}
+        query = db.session.query(
+            ChallengeFiles.location, PortableFileDigest.sha256, PortableFileDigest.size
+        ).outerjoin(
+            PortableFileDigest,
+            and_(
+                PortableFileDigest.file_id == ChallengeFiles.id,
+                PortableFileDigest.location == ChallengeFiles.location,
+            ),
+        )
+        for location, sha256, size in query:
+            self.locations.setdefault(os.path.basename(location), []).append(
+                (location, sha256, size)
+            )
+
+    def _find_stored(self, name):
+        digest = posixpath.basename(posixpath.dirname(name))
+        if not _SHA256.match(digest):
+            return None
+        if self.locations is None:
+            self._load_locations()
+        for location, sha256, size in self.locations.get(
+            secure_filename(posixpath.basename(name)), []
+        ):
+            path = os.path.join(self.dst_attachments, location)
+            if sha256 is None:
+                if not os.path.isfile(path):
+                    continue
+                sha256, size = _digest(path, self.stored_digests), os.path.getsize(path)
+            if sha256 == digest:
+                return path, sha256, size
+        return None
+
+    def _stored_file(self, name):
+        """
+        (path in dst_attachments, sha256, size) of the stored attachment
+        read instead of name, if any
+        """
+        if self.source.exists(name):
+            return None
+        name = posixpath.normpath(name)
+        if name not in self.stored:
+            self.stored[name] = self._find_stored(name)
+        return self.stored[name]
+
+    @property
+    def reopenable(self):
+        return self.source.reopenable
+
+    def path(self, name):
+        return self.source.path(name)
+
+    def exists(self, name):
+        return self.source.exists(name) or self._stored_file(name) is not None
+
+    def isdir(self, name):
+        return self.source.isdir(name)
+
+    def find(self, directory, basename):
+        return self.source.find(directory, basename)
+
+    def in_order(self, names):
+        # Stored attachments are not in the source
+        stored = [name for name in names if self._stored_file(name) is not None]
+        return stored + self.source.in_order(
+            [name for name in names if self._stored_file(name) is None]
+        )
+
+    def size(self, name):
+        stored = self._stored_file(name)
+        return self.source.size(name) if stored is None else stored[2]
+
+    def open(self, name):
+        stored = self._stored_file(name)
+        if stored is None:
+            return self.source.open(name)
+        if not os.path.isfile(stored[0]):
+            # e.g. stored by the S3 uploader
+            raise ValueError(
+                "Unable to import challenges. The attachment {0} of the previous "
+                "export is not in the delta, and can not be read from the "
+                "uploader. Import a full export instead.".format(name)
+            )
+        return open(stored[0], "rb")
+
+    def content(self, name):
+        stored = self._stored_file(name)
+        return self.source.content(name) if stored is None else stored[0]
+
+    def digest(self, name):
+        stored = self._stored_file(name)
+        return self.source.digest(name) if stored is None else stored[1]
+
+    def hash_all(self, names):
+        self.source.hash_all([name for name in names if self._stored_file(name) is None])
+
+
+def _digest(path, digests):
+    if path not in digests:
+        digests[path] = sha256_file(path)
+    return digests[path]
+
+
+def _may_be_stored_as(source, filename, file_row, dst_attachments, file_digests):
+    # Stored attachments can only match files with the same name and size.
+    # Their size is recorded with their digest, otherwise they are read from
+    # dst_attachments, e.g. if they were stored before digests were kept.
+    if os.path.basename(file_row.location) != secure_filename(os.path.basename(filename)):
+        return False
+    if file_row.id in file_digests:
+        return file_digests[file_row.id][1] == source.size(filename)
+    stored_path = os.path.join(dst_attachments, file_row.location)
+    return os.path.isfile(stored_path) and (
+        os.path.getsize(stored_path) == source.size(filename)
+    )
+
+
+def _stored_digest(file_row, dst_attachments, file_digests, digests):
+    if file_row.id in file_digests:
+        return file_digests[file_row.id][0]
+    return _digest(os.path.join(dst_attachments, file_row.location), digests)
+
+
+def _find_stored_file(
+    source, filename, stored_files, dst_attachments, file_digests, digests
+):
+    """
+    Look for an already stored attachment with the same name and content as
+    the attachment filename of the spec. Only files which can be identical
+    get hashed, and stored files only if their digest is not recorded.
+    """
+    for file_row in stored_files:
+        if not _may_be_stored_as(source, filename, file_row, dst_attachments, file_digests):
+            continue
+        stored_digest = _stored_digest(file_row, dst_attachments, file_digests, digests)
+        if stored_digest == source.digest(filename):
+            return file_row
+    return None
+
+
+def _files_unchanged(
+    source, filenames, stored_files, dst_attachments, file_digests, digests
+):
+    if len(filenames) != len(stored_files):
+        return False
+    remaining = list(stored_files)
+    for filename in filenames:
+        if not source.exists(filename):
+            return False
+        file_row = _find_stored_file(
+            source, filename, remaining, dst_attachments, file_digests, digests
+        )
+        if file_row is None:
+            return False
+        remaining.remove(file_row)
+    return True
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _timed(items, profile, phase):
+    """Generate items, timing the generation of each one as phase"""
+    items = iter(items)
+    while True:
+        with profile.phase(phase):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+
+def _no_progress(phase, processed=0, total=None):
+    pass
+
+
+class _ChallengeImport(object):
+    """
+    State of an import, which writes the challenges in batches within a
+    single transaction. The prerequisites of a challenge are set in the
+    batch of the challenge when they are imported in earlier batches, or
+    already exist, otherwise once all the challenges are written, which is
+    always the case if defer_prerequisites is set.
+    """
+
+    def __init__(
+        self,
+        source,
+        dst_attachments,
+        force=False,
+        progress=None,
+        profile=None,
+        workers=DEFAULT_WORKERS,
+        defer_prerequisites=False,
+    ):
+        from CTFd.utils.uploads import get_uploader
+
+        self.source = source
+        self.profile = profile or Profile("import")
+        self.dst_attachments = dst_attachments
+        self.force = force
+        self.defer_prerequisites = defer_prerequisites
+        self.progress = progress or _no_progress
+        # Totals are unknown while streaming
+        self.total = None
+        self.total_files = None
+        self.processed = 0
+        self.processed_files = 0
+        self.uploader = get_uploader()
+        self.bulk = BulkUploader(self.uploader, workers)
+        self.obsolete_locations = []
+        self.digests = {}
+        # Recorded digests of the stored attachments of the batch, by file id
+        self.file_digests = {}
+        self.chal_ids = {}
+        self.chal_requirements = {}
+        # Prerequisites of the stored challenges, replaced by the ones of the
+        # spec as the challenges are imported
+        self.graph = PrerequisiteGraph()
+        # Challenges whose prerequisites are imported in later batches
+        self.pending = []
+        self.summary = {
+            "challenges": {},
+            "files": {"uploaded": 0, "uploaded_bytes": 0, "skipped": 0, "skipped_bytes": 0},
+        }
+
+    def load_index(self):
+        from CTFd.models import db, Challenges
+
+        # Index all existing challenges by name with a single query, without
+        # loading their descriptions
+        rows = db.session.query(
+            Challenges.id, Challenges.name, Challenges.requirements
+        ).all()
+        for chal_id, name, requirements in rows:
+            self.chal_ids[name] = chal_id
+            self.chal_requirements[chal_id] = requirements
+        self.graph = PrerequisiteGraph.from_rows(rows)
+
+    def _load_stored(self, chals):
+        from CTFd.models import db, Challenges, Flags, Tags, ChallengeFiles, Hints
+        from sqlalchemy.orm import with_polymorphic
+
+        try:
+            from .file_digests import PortableFileDigest
+        except ImportError:  # Running as a script
+            from file_digests import PortableFileDigest
+
+        matched_ids = [
+            self.chal_ids[chal["name"].strip()]
+            for chal in chals
+            if chal["name"].strip() in self.chal_ids
+        ]
+        chal_poly = with_polymorphic(Challenges, "*")
+        stored = {
+            "challenges": {},
+            Flags: {},
+            Tags: {},
+            Hints: {},
+            ChallengeFiles: {},
+        }
+        for ids_chunk in _chunks(matched_ids):
+            for chal in db.session.query(chal_poly).filter(chal_poly.id.in_(ids_chunk)):
+                stored["challenges"][chal.name] = chal
+            for model in (Flags, Tags, Hints, ChallengeFiles):
+                for row in model.query.filter(
+                    model.challenge_id.in_(ids_chunk)
+                ).order_by(model.id):
+                    stored[model].setdefault(row.challenge_id, []).append(row)
+
+        file_locations = {
+            file_row.id: file_row.location
+            for file_rows in stored[ChallengeFiles].values()
+            for file_row in file_rows
+        }
+        self.file_digests = {}
+        for ids_chunk in _chunks(list(file_locations)):
+            for row in PortableFileDigest.query.filter(
+                PortableFileDigest.file_id.in_(ids_chunk)
+            ):
+                # Digests of rows whose location changed do not hold anymore
+                if row.location == file_locations[row.file_id]:
+                    self.file_digests[row.file_id] = (row.sha256, row.size)
+        return stored
+
+    def _hash_candidates(self, chals, stored_chals, stored_files):
+        # Hash the attachments which may match a stored file up front, so
+        # that stored files are hashed in parallel
+        candidates = []
+        stored_candidates = set()
+        for chal in chals:
+            matching_chal = stored_chals.get(chal["name"].strip())
+            if matching_chal is None:
+                continue
+            for filename in chal.get("files", []):
+                for file_row in stored_files.get(matching_chal.id, []):
+                    if not _may_be_stored_as(
+                        self.source,
+                        filename,
+                        file_row,
+                        self.dst_attachments,
+                        self.file_digests,
+                    ):
+                        continue
+                    candidates.append(filename)
+                    if file_row.id not in self.file_digests:
+                        stored_candidates.add(
+                            os.path.join(self.dst_attachments, file_row.location)
+                        )
+        self.source.hash_all(candidates)
+        stored_candidates.difference_update(self.digests)
+        self.digests.update(sha256_files(stored_candidates))
+
+    def _unchanged(self, chal, matching_chal, stored):
+        from CTFd.models import Flags, Tags, ChallengeFiles, Hints
+
+        # Prerequisites are compared once all the challenges are imported
+        stored_properties = challenge_properties(
+            matching_chal,
+            stored[Flags].get(matching_chal.id, []),
+            stored[Tags].get(matching_chal.id, []),
+            stored[Hints].get(matching_chal.id, []),
+            {},
+        )
+        properties = spec_properties(chal)
+        properties.pop("prerequisites", None)
+        if challenge_fingerprint(stored_properties) != challenge_fingerprint(properties):
+            return False
+
+        return _files_unchanged(
+            self.source,
+            chal.get("files", []),
+            stored[ChallengeFiles].get(matching_chal.id, []),
+            self.dst_attachments,
+            self.file_digests,
+            self.digests,
+        )
+
+    def _store_files(self, uploads):
+        """
+        Store the attachments of the (filename, size, file_row) uploads,
+        setting the Future of the location of each file_row. Sources which
+        can not be read concurrently are read in order, and the attachments
+        sharing their content, e.g. the hard links of an exported archive,
+        are read once. Returns the paths of the temporary copies of the
+        larger shared attachments, to remove once they are stored.
+        """
+        if self.source.concurrent:
+            for filename, size, file_row in uploads:
+                file_row["location"] = self.bulk.add(
+                    partial(self.source.open, filename), os.path.basename(filename), size
+                )
+            return []
+
+        shared = {}
+        for upload in uploads:
+            shared.setdefault(self.source.content(upload[0]), []).append(upload)
+        groups = {group[0][0]: group for group in shared.values()}
+        spooled = []
+        for filename in self.source.in_order(list(groups)):
+            group = groups[filename]
+            size = group[0][1]
+            if len(group) == 1:
+                open_file = partial(self.source.open, filename)
+                concurrent = False
+            elif size <= INLINE_SIZE:
+                with self.source.open(filename) as f:
+                    open_file = partial(io.BytesIO, f.read())
+                concurrent = True
+            else:
+                fd, path = tempfile.mkstemp(prefix="portable-")
+                spooled.append(path)
+                with os.fdopen(fd, "wb") as dst, self.source.open(filename) as f:
+                    shutil.copyfileobj(f, dst)
+                open_file = partial(open, path, "rb")
+                concurrent = True
+            for name, size, file_row in group:
+                file_row["location"] = self.bulk.add(
+                    open_file, os.path.basename(name), size, concurrent
+                )
+        return spooled
+
+    def _stored_digest_row(self, file_row):
+        """
+        Digest to record of a stored attachment which was hashed from
+        dst_attachments, since it was stored before digests were kept
+        """
+        stored_path = os.path.join(self.dst_attachments, file_row.location)
+        return {
+            "file_id": file_row.id,
+            "location": file_row.location,
+            "sha256": self.digests[stored_path],
+            "size": os.path.getsize(stored_path),
+        }
+
+    def import_batch(self, chals):
+        # Hashing and attachments are timed as their own nested phases
+        with self.profile.phase("db"):
+            self._import_batch(chals)
+
+    def _import_batch(self, chals):
+        from CTFd.models import db, Challenges, Flags, Tags, ChallengeFiles, Hints
+        from CTFd.plugins.dynamic_challenges import DynamicChallenge
+
+        try:
+            from .file_digests import PortableFileDigest
+        except ImportError:  # Running as a script
+            from file_digests import PortableFileDigest
+
+        self.progress("db", self.processed, self.total)
+        batch_size = len(chals)
+        for chal in chals:
+            normalize_challenge(chal)
+            self.graph.add(chal["name"].strip(), chal.get("prerequisites", []))
+        batch_names = [chal["name"].strip() for chal in chals]
+
+        stored = self._load_stored(chals)
+        stored_chals = stored["challenges"]
+        stored_files = stored[ChallengeFiles]
+        with self.profile.phase("hash"):
+            self._hash_candidates(chals, stored_chals, stored_files)
+
+        # Challenges whose spec matches what is already stored are skipped
+        changed_chals = []
+        digest_rows = []
+        for chal in chals:
+            matching_chal = stored_chals.get(chal["name"].strip())
+            if matching_chal and not self.force:
+                with self.profile.challenge(matching_chal.name):
+                    unchanged = self._unchanged(chal, matching_chal, stored)
+            else:
+                unchanged = False
+            if unchanged:
+                logger.info("Skipping %s: unchanged", matching_chal.name)
+                self.summary["challenges"][matching_chal.name] = "unchanged"
+                self.processed_files += len(chal.get("files", []))
+                digest_rows.extend(
+                    self._stored_digest_row(file_row)
+                    for file_row in stored_files.get(matching_chal.id, [])
+                    if file_row.id not in self.file_digests
+                )
+                continue
+            changed_chals.append(chal)
+        chals = changed_chals
+
+        updated_ids = [
+            stored_chals[chal["name"].strip()].id
+            for chal in chals
+            if chal["name"].strip() in stored_chals
+        ]
+        for ids_chunk in _chunks(updated_ids):
+            for model in (Tags, Flags, Hints):
+                model.query.filter(model.challenge_id.in_(ids_chunk)).delete(
+                    synchronize_session=False
+                )
+
+        chal_dbobjs = []
+        dynamic_dbobjs = []
+        for chal in chals:
+            chal_type = chal.get("type", "standard")
+            matching_chal = stored_chals.get(chal["name"].strip())
+            if matching_chal:
+                logger.info(
+                    "Updating %s: Duplicate challenge found in DB (id: %s)",
+                    chal["name"].strip(),
+                    matching_chal.id,
+                )
                 matching_chal.name = chal["name"].strip()
                 matching_chal.description = chal["description"].strip()
                 matching_chal.category = chal["category"].strip()
-                
-                if chal.get("type", "standard") == "standard":
+
+                if chal_type == "standard":
                     matching_chal.value = chal["value"]
-                
-                if chal.get("type", "standard") == "dynamic":
+
+                if chal_type == "dynamic":
                     matching_chal.minimum = chal["minimum"]
                     matching_chal.decay = chal["decay"]
                     matching_chal.initial = chal["value"]
-                    DynamicValueChallenge.calculate_value(matching_chal)
+                    dynamic_dbobjs.append(matching_chal)
 
-                db.session.commit()
                 chal_dbobj = matching_chal
+                self.summary["challenges"][chal_dbobj.name] = "updated"
 
             else:
-                print("Adding {}".format(chal["name"].encode("utf8")))
+                logger.info("Adding %s", chal["name"].strip())
 
-                chal_type = chal.get("type", "standard")
                 if chal_type == "standard":
                     # We ignore traling and leading whitespace when
                     # importing challenges
@@ -174,70 +1380,568 @@ def import_challenges(in_file, dst_attachments, move=False):
                         minimum=int(chal["minimum"]),
                         decay=int(chal["decay"]),
                     )
-                else:
-                    raise ValueError("Unknown type of challenge")
 
                 db.session.add(chal_dbobj)
-                db.session.commit()
+                self.summary["challenges"][chal_dbobj.name] = "added"
+
+            chal_dbobj.state = "hidden" if ("hidden" in chal and chal["hidden"] == True) else "visible"
+            chal_dbobj.max_attempts = chal["max_attempts"] if "max_attempts" in chal else 0
+            chal_dbobjs.append(chal_dbobj)
+
+        if dynamic_dbobjs:
+            _dynamic_values(dynamic_dbobjs)
+
+        # A single flush assigns ids to all the new challenges of the batch
+        db.session.flush()
+
+        for chal_dbobj in chal_dbobjs:
+            if chal_dbobj.name not in self.chal_ids:
+                self.chal_ids[chal_dbobj.name] = chal_dbobj.id
+                self.chal_requirements[chal_dbobj.id] = None
+
+        # The ids of the whole batch are known, the prerequisites are written
+        # along with the rest of the batch
+        chal_dbobjs_by_name = {chal_dbobj.name: chal_dbobj for chal_dbobj in chal_dbobjs}
+        for name in batch_names:
+            prerequisites = None if self.defer_prerequisites else self._resolve(name)
+            if prerequisites is None:
+                self.pending.append(name)
+                continue
+            chal_dbobj = chal_dbobjs_by_name.get(name)
+            if chal_dbobj is not None:
+                chal_dbobj.requirements = {"prerequisites": prerequisites}
+            elif self._requirements_changed(name, prerequisites):
+                stored_chals[name].requirements = {"prerequisites": prerequisites}
+                self.summary["challenges"][name] = "updated"
+
+        tag_rows = []
+        flag_rows = []
+        hint_rows = []
+        file_rows = []
+        uploads = []
+        obsolete_files = []
+        for chal, chal_dbobj in zip(chals, chal_dbobjs):
 
             for tag in chal.get("tags", []):
-                tag_dbobj = Tags(challenge_id=chal_dbobj.id, value=tag)
-                db.session.add(tag_dbobj)
+                tag_rows.append({"challenge_id": chal_dbobj.id, "value": tag})
 
             for flag in chal["flags"]:
-                flag_db = Flags(
-                    challenge_id=chal_dbobj.id, content=flag["flag"], type=flag["type"]
+                flag_rows.append(
+                    {
+                        "challenge_id": chal_dbobj.id,
+                        "content": flag["flag"],
+                        "type": flag["type"],
+                    }
                 )
-                db.session.add(flag_db)
 
             for hint in chal.get("hints", []):
-                hint_dbobj = Hints(challenge_id=chal_dbobj.id, content=hint["content"], cost=hint["cost"])
-                db.session.add(hint_dbobj)
+                hint_rows.append(
+                    {
+                        "challenge_id": chal_dbobj.id,
+                        "content": hint["content"],
+                        "cost": hint["cost"],
+                    }
+                )
 
-            chal_dbobj.state = "hidden" if ("hidden" in chal and chal["hidden"] == True) else "visible"
-            chal_dbobj.max_attempts = chal["max_attempts"] if "max_attempts" in chal else 0
+            with self.profile.phase("files"), self.profile.challenge(chal_dbobj.name):
+                chal_stored_files = list(stored_files.get(chal_dbobj.id, []))
+                for filename in chal.get("files", []):
+                    if not self.source.exists(filename):
+                        raise ValueError("Unable to import challenges. Missing file: " + filename)
+
+                    size = self.source.size(filename)
+                    file_row = _find_stored_file(
+                        self.source,
+                        filename,
+                        chal_stored_files,
+                        self.dst_attachments,
+                        self.file_digests,
+                        self.digests,
+                    )
+                    self.processed_files += 1
+                    self.progress("files", self.processed_files, self.total_files)
+                    if file_row is not None:
+                        chal_stored_files.remove(file_row)
+                        if file_row.id not in self.file_digests:
+                            digest_rows.append(self._stored_digest_row(file_row))
+                        self.summary["files"]["skipped"] += 1
+                        self.summary["files"]["skipped_bytes"] += size
+                        self.profile.add_bytes("skipped", size)
+                        continue
+
+                    self.summary["files"]["uploaded"] += 1
+                    self.summary["files"]["uploaded_bytes"] += size
+                    self.profile.add_bytes("uploaded", size)
+                    file_row = {"challenge_id": chal_dbobj.id, "type": "challenge"}
+                    uploads.append((filename, size, file_row))
+                    file_rows.append(file_row)
+                obsolete_files.extend(chal_stored_files)
+
+        # The attachments are stored in the background, and their locations
+        # resolved once the whole batch is submitted
+        with self.profile.phase("files"):
+            spooled = self._store_files(uploads)
+            try:
+                for file_row in file_rows:
+                    file_row["location"] = file_row["location"].result()
+            finally:
+                for path in spooled:
+                    os.remove(path)
 
-            if "files" in chal:
-                from io import FileIO
-
-                for filename in chal["files"]:
-                    try:
-                        # upload_file takes a werkzeug.FileStorage object, but we
-                        # can get close enough with a file object with a
-                        # filename property added
-                        filepath = os.path.join(os.path.dirname(in_file), filename)
-                        with FileIO(filepath, mode="rb") as f:
-                            f.filename = os.path.basename(f.name)
-                            uploads.upload_file(
-                                file=f, challenge=chal_dbobj.id, type="challenge"
-                            )
-                    except FileNotFoundError:
-                        raise ValueError("Unable to import challenges. Missing file: " + filename)                    
-
-    db.session.commit()
-
-    # update challenge prerequisites after all the challenges were created
-    with open(in_file, "r") as in_stream:
-        data = list(yaml.safe_load_all(in_stream))
-        for chal in data[0]["challs"]:
-
-            chal_dbobj = Challenges.query.filter_by(
-                name=chal["name"].strip()
-            ).first()
-
-            prerequisites = set()
-            for prerequisite in chal.get("prerequisites", []):
-                prerequisites.update(
-                    [c.id for c in Challenges.query.filter_by(name=prerequisite).all()]
+        db.session.bulk_insert_mappings(Tags, tag_rows)
+        db.session.bulk_insert_mappings(Flags, flag_rows)
+        db.session.bulk_insert_mappings(Hints, hint_rows)
+        db.session.bulk_insert_mappings(ChallengeFiles, file_rows)
+
+        # Bulk inserts do not fetch the ids of the rows, which the digests of
+        # the stored attachments are keyed by
+        locations = [file_row["location"] for file_row in file_rows]
+        for locations_chunk in _chunks(locations):
+            for file_id, location in db.session.query(
+                ChallengeFiles.id, ChallengeFiles.location
+            ).filter(ChallengeFiles.location.in_(locations_chunk)):
+                sha256, size = self.bulk.digests[location]
+                digest_rows.append(
+                    {"file_id": file_id, "location": location, "sha256": sha256, "size": size}
                 )
-            chal_dbobj.requirements = {"prerequisites": list(prerequisites)}
+        # Digests left behind by deleted rows whose ids were reused, e.g. on
+        # SQLite, which does not cascade the deletions of CTFd
+        for ids_chunk in _chunks([digest_row["file_id"] for digest_row in digest_rows]):
+            PortableFileDigest.query.filter(PortableFileDigest.file_id.in_(ids_chunk)).delete(
+                synchronize_session=False
+            )
+        db.session.bulk_insert_mappings(PortableFileDigest, digest_rows)
+
+        obsolete_ids = [file_row.id for file_row in obsolete_files]
+        self.obsolete_locations.extend(file_row.location for file_row in obsolete_files)
+        for ids_chunk in _chunks(obsolete_ids):
+            PortableFileDigest.query.filter(PortableFileDigest.file_id.in_(ids_chunk)).delete(
+                synchronize_session=False
+            )
+            ChallengeFiles.query.filter(ChallengeFiles.id.in_(ids_chunk)).delete(
+                synchronize_session=False
+            )
+
+        # Everything is flushed, so that the batch can be released from memory
+        db.session.flush()
+        db.session.expunge_all()
+
+        self.processed += batch_size
+        self.progress("db", self.processed, self.total)
+
+    def _resolve(self, name):
+        """
+        Ids of the prerequisites of the challenge name, or None if some of
+        them are not imported yet
+        """
+        prerequisites = []
+        for prerequisite in self.graph.prerequisites[name]:
+            if prerequisite not in self.chal_ids:
+                return None
+            prerequisites.append(self.chal_ids[prerequisite])
+        return prerequisites
+
+    def _requirements_changed(self, name, prerequisites):
+        requirements = self.chal_requirements[self.chal_ids[name]] or {}
+        return set(requirements.get("prerequisites", [])) != set(prerequisites)
+
+    def delete_challenges(self, names):
+        """
+        Delete the stored challenges names, e.g. the ones deleted since the
+        previous export of a delta, along with their flags, tags, hints,
+        attachments and submissions, the way CTFd deletes challenges. Their
+        attachments are removed once the import is committed.
+        """
+        from CTFd.models import db, Challenges, Flags, Tags, ChallengeFiles, Hints
+        from CTFd.models import Fails, Solves
+        from CTFd.plugins.dynamic_challenges import DynamicChallenge
+
+        try:
+            from .file_digests import PortableFileDigest
+        except ImportError:  # Running as a script
+            from file_digests import PortableFileDigest
+
+        deleted_ids = []
+        for name in names:
+            if name in self.chal_ids:
+                deleted_ids.append(self.chal_ids.pop(name))
+                self.graph.remove(name)
+                self.summary["challenges"][name] = "deleted"
+                logger.info("Deleting %s: deleted since the previous export", name)
+
+        for ids_chunk in _chunks(deleted_ids):
+            self.obsolete_locations.extend(
+                location
+                for (location,) in db.session.query(ChallengeFiles.location).filter(
+                    ChallengeFiles.challenge_id.in_(ids_chunk)
+                )
+            )
+            file_ids = db.session.query(ChallengeFiles.id).filter(
+                ChallengeFiles.challenge_id.in_(ids_chunk)
+            )
+            PortableFileDigest.query.filter(
+                PortableFileDigest.file_id.in_(file_ids.subquery())
+            ).delete(synchronize_session=False)
+            for model in (Fails, Solves, Flags, ChallengeFiles, Tags, Hints):
+                model.query.filter(model.challenge_id.in_(ids_chunk)).delete(
+                    synchronize_session=False
+                )
+            DynamicChallenge.query.filter(DynamicChallenge.id.in_(ids_chunk)).delete(
+                synchronize_session=False
+            )
+            Challenges.query.filter(Challenges.id.in_(ids_chunk)).delete(
+                synchronize_session=False
+            )
+
+    def import_shards(self, shards, batch_size=BATCH_SIZE):
+        """
+        Import shards of the challenges (see _split_import) in parallel, each
+        in its own process, database session and transaction. Shards are
+        committed as soon as they are imported, whether the others fail or
+        not, and their prerequisites are left to link_prerequisites.
+        """
+        from flask import current_app
+
+        app = current_app._get_current_object()
+        for chals in shards:
+            for chal in chals:
+                name = chal["name"].strip()
+                self.graph.add(name, chal.get("prerequisites", []))
+                self.pending.append(name)
+
+        errors = []
+        imported = 0
+        # Processes are spawned rather than forked, so that they do not share
+        # the database connections of this one
+        with ProcessPoolExecutor(
+            max_workers=len(shards),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_import_process,
+            initargs=(app.import_name, app.root_path, _picklable_config(app.config)),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _import_shard,
+                    self.source,
+                    chals,
+                    self.dst_attachments,
+                    self.force,
+                    batch_size,
+                    self.bulk.workers,
+                ): len(chals)
+                for chals in shards
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except ValueError as err:
+                    errors.extend(err.args)
+                    continue
+                except Exception as err:
+                    errors.append("Unexpected error in an import process: {0}".format(err))
+                    continue
+                imported += 1
+                self.summary["challenges"].update(result["challenges"])
+                for key, value in result["files"].items():
+                    self.summary["files"][key] += value
+                for key, value in result["bytes"].items():
+                    self.profile.add_bytes(key, value)
+                self.chal_ids.update(result["chal_ids"])
+                self.chal_requirements.update(result["requirements"])
+                self.obsolete_locations.extend(result["obsolete"])
+                self.processed += futures[future]
+                self.progress("db", self.processed, self.total)
+
+        if errors:
+            # Nothing references the attachments replaced by the shards which
+            # were committed anymore
+            self.bulk.delete(self.obsolete_locations)
+            self.obsolete_locations = []
+            raise ValueError(
+                "Only {0} of the {1} shards of the import were imported.".format(
+                    imported, len(shards)
+                ),
+                *errors
+            )
+
+    def link_prerequisites(self):
+        """
+        Check the prerequisites of all imported challenges for cycles, and set
+        the ones which were imported after the challenges requiring them
+        """
+        from CTFd.models import db, Challenges
+
+        errors = cycle_errors(self.graph.cycles())
+        requirement_rows = []
+        for name in self.pending:
+            prerequisites = self._resolve(name)
+            if prerequisites is None:
+                errors.extend(
+                    "Challenge ({0}): Unknown prerequisite '{1}'.".format(name, prerequisite)
+                    for prerequisite in self.graph.prerequisites[name]
+                    if prerequisite not in self.chal_ids
+                )
+                continue
+
+            if self.summary["challenges"][name] == "unchanged":
+                if not self._requirements_changed(name, prerequisites):
+                    continue
+                self.summary["challenges"][name] = "updated"
+            requirement_rows.append(
+                {"id": self.chal_ids[name], "requirements": {"prerequisites": prerequisites}}
+            )
 
-    db.session.commit()
-    db.session.close()
+        if errors:
+            raise ValueError(*errors)
+        db.session.bulk_update_mappings(Challenges, requirement_rows)
+
+
+def _split_import(chals, graph, count):
+    """
+    Split the challenges, sorted after their prerequisites by graph, into
+    at most count shards of about the same size. Categories, and challenges
+    depending on each other, are not split, so that the shards can be
+    imported independently. Shards keep the order of chals.
+    """
+    by_name = {chal["name"].strip(): chal for chal in chals}
+    groups = graph.groups(lambda name: by_name[name]["category"].strip())
+    shards = [[] for _ in range(min(count, len(groups)))]
+    for group in sorted(groups, key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    position = {chal["name"].strip(): i for i, chal in enumerate(chals)}
+    return [
+        [by_name[name] for name in sorted(shard, key=position.get)] for shard in shards
+    ]
+
+
+def _picklable_config(config):
+    picklable = {}
+    for key, value in config.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        picklable[key] = value
+    return picklable
+
+
+# App of the processes of a parallel import
+_process_app = None
+
+
+def _init_import_process(import_name, root_path, config):
+    """Create the app, and thus the database engine, of an import process"""
+    global _process_app
+    from CTFd.models import db
+
+    _process_app = Flask(import_name, root_path=root_path)
+    _process_app.config.update(config)
+    db.init_app(_process_app)
+
+
+def _import_shard(source, chals, dst_attachments, force, batch_size, workers):
+    """
+    Import a shard of a parallel import in its own transaction (see
+    _ChallengeImport.import_shards), and return its summary along with the
+    ids and requirements of its challenges and the attachments it replaced
+    """
+    with _process_app.app_context():
+        from CTFd.models import db
+
+        importer = _ChallengeImport(
+            source, dst_attachments, force, workers=workers, defer_prerequisites=True
+        )
+        try:
+            importer.load_index()
+            for batch in _batched(chals, batch_size):
+                importer.import_batch(batch)
+            db.session.commit()
+        except Exception as err:
+            db.session.rollback()
+            importer.bulk.delete(importer.bulk.stored())
+            if isinstance(err, ValueError):
+                raise
+            # Database errors can not always be sent to the importing process
+            logger.exception("Import of a shard failed")
+            raise ValueError("Unexpected error in an import process: {0}".format(err))
+        finally:
+            importer.bulk.close()
+            db.session.remove()
+
+    chal_ids = {chal["name"].strip(): importer.chal_ids[chal["name"].strip()] for chal in chals}
+    return {
+        "challenges": importer.summary["challenges"],
+        "files": importer.summary["files"],
+        "bytes": dict(importer.profile.bytes),
+        "chal_ids": chal_ids,
+        "requirements": {
+            chal_id: importer.chal_requirements[chal_id] for chal_id in chal_ids.values()
+        },
+        "obsolete": importer.obsolete_locations,
+    }
+
+
+def import_challenges(
+    in_file,
+    dst_attachments,
+    move=False,
+    force=False,
+    stream=False,
+    batch_size=BATCH_SIZE,
+    progress=None,
+    source=None,
+    profile=None,
+    workers=DEFAULT_WORKERS,
+    processes=1,
+    lock_timeout=None,
+):
+    """
+    Import the challenges of the spec in_file (see open_spec) in a
+    single transaction. Attachments are read from the directory of in_file,
+    unless source is given, e.g. a TarSource, in which case in_file is the
+    name of the spec within source.
+    Unless stream is set, the whole spec is parsed and validated before the
+    database is modified, and the challenges are written batch_size at a
+    time after their prerequisites; otherwise the challenges are validated
+    and written batch_size at a time as they are parsed. Raises a ValueError
+    holding all the errors found if the spec is invalid, e.g. when its
+    prerequisites form a cycle.
+
+    If given, progress is called with the current phase ("validate", "db" or
+    "files"), the number of items processed in this phase and their total,
+    which is None when it is not known yet. The timings of the import are
+    logged, and recorded in profile if given. The attachments are stored by
+    workers threads.
+
+    Delta exports (see manifest.py) are applied on top of the stored
+    challenges: the challenges deleted since the previous export are deleted
+    as well, and the attachments of the previous export, which the delta
+    does not hold, are read from dst_attachments.
+
+    Imports hold a database lock (see locking.py), so that the imports of
+    other processes, or nodes, wait for this one, at most lock_timeout
+    seconds. Unless stream is set, the challenges of specs of at least
+    PARALLEL_IMPORT_MIN challenges are split into shards, imported in
+    parallel by the given number of processes, each in its own
+    transaction, and their prerequisites are then set at once. The import
+    is then not atomic anymore: if a shard fails, the others are still
+    imported. SQLite databases, which have a single writer, are always
+    imported by this process.
+    """
+    from CTFd.models import db
+
+    try:
+        from .export_cache import bump_revision
+        from .locking import import_lock
+    except ImportError:  # Running as a script
+        from export_cache import bump_revision
+        from locking import import_lock
+
+    profile = profile or Profile("import")
+    count_queries(db.engine)
+    chals, source = open_spec(in_file, source, workers, dst_attachments)
+    importer = _ChallengeImport(
+        source, dst_attachments, force, progress, profile, workers
+    )
+    importer.progress("lock")
+    with profile.active(), import_lock(lock_timeout):
+        try:
+            with profile.phase("db"):
+                importer.load_index()
+                if isinstance(source, DeltaSource):
+                    importer.delete_challenges(source.manifest["deleted"])
+            if stream:
+                seen = {}
+                chals = _timed(chals, profile, "parse")
+                for batch in _batched(chals, batch_size):
+                    importer.progress("validate", len(seen), None)
+                    with profile.phase("validate"):
+                        errors = validate_challenges(
+                            batch, source, seen=seen, start=len(seen) + 1
+                        )
+                    if errors:
+                        raise ValueError(*errors)
+                    importer.import_batch(batch)
+            else:
+                with profile.phase("parse"):
+                    chals = list(chals)
+                importer.progress("validate", 0, len(chals))
+                with profile.phase("validate"):
+                    errors = validate_challenges(
+                        chals, source, set(importer.chal_ids), stored=importer.graph
+                    )
+                    if errors:
+                        raise ValueError(*errors)
+                    # Prerequisites come first, so that they already exist
+                    # when the challenges requiring them are written
+                    by_name = {chal["name"].strip(): chal for chal in chals}
+                    spec_graph = PrerequisiteGraph()
+                    for name, chal in by_name.items():
+                        spec_graph.add(name, chal.get("prerequisites", []))
+                    chals = [by_name[name] for name in spec_graph.order()]
+                importer.progress("validate", len(chals), len(chals))
+
+                importer.total = len(chals)
+                importer.total_files = sum(len(chal.get("files", [])) for chal in chals)
+                shards = []
+                if processes > 1 and len(chals) >= PARALLEL_IMPORT_MIN:
+                    if db.engine.dialect.name == "sqlite" or not source.reopenable:
+                        logger.info(
+                            "Importing in a single process, the database or the "
+                            "archive can not be shared with other processes"
+                        )
+                    else:
+                        shards = _split_import(chals, spec_graph, processes)
+                if len(shards) > 1:
+                    with profile.phase("db"):
+                        importer.import_shards(shards, batch_size)
+                else:
+                    for batch in _batched(chals, batch_size):
+                        importer.import_batch(batch)
+
+            with profile.phase("db"):
+                importer.link_prerequisites()
+                # Bulk operations do not trigger the revision tracking of the
+                # exports
+                if set(importer.summary["challenges"].values()) - {"unchanged"}:
+                    bump_revision(db.session.connection())
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Nothing references the stored attachments anymore
+            importer.bulk.delete(importer.bulk.stored())
+            importer.bulk.close()
+            raise
+        finally:
+            db.session.close()
+
+    # Only remove the replaced attachments once the import is committed
+    with profile.phase("files"):
+        importer.bulk.delete(importer.obsolete_locations)
+        importer.bulk.close()
+
+    summary = importer.summary
+    statuses = list(summary["challenges"].values())
+    logger.info(
+        "Challenges: %d added, %d updated, %d unchanged",
+        statuses.count("added"),
+        statuses.count("updated"),
+        statuses.count("unchanged"),
+    )
+    logger.info(
+        "Attachments: %d uploaded (%d bytes), %d unchanged and skipped (%d bytes)",
+        summary["files"]["uploaded"],
+        summary["files"]["uploaded_bytes"],
+        summary["files"]["skipped"],
+        summary["files"]["skipped_bytes"],
+    )
+    profile.log()
+    return summary
 
 
 if __name__ == "__main__":
     args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
     app = Flask(__name__)
 
@@ -251,6 +1955,10 @@ if __name__ == "__main__":
             url.drivername = "postgresql"
 
         db.init_app(app)
+        # Register the export revision and import lock tables
+        import export_cache  # noqa: F401
+        import file_digests  # noqa: F401
+        import locking  # noqa: F401
 
         from CTFd.cache import cache
 
@@ -267,7 +1975,33 @@ if __name__ == "__main__":
             db.create_all()
 
         app.db = db
-        import_challenges(
-            args.in_file, args.dst_attachments, move=args.move
-        )
+        profile = Profile("validation" if args.validate_only else "import")
+        with cprofiled(args.profile_output):
+            if args.validate_only:
+                errors = validate_spec(
+                    args.in_file,
+                    profile=profile,
+                    workers=args.workers,
+                    dst_attachments=args.dst_attachments,
+                )
+            else:
+                import_challenges(
+                    args.in_file,
+                    args.dst_attachments,
+                    move=args.move,
+                    force=args.force,
+                    stream=args.stream,
+                    profile=profile,
+                    workers=args.workers,
+                    processes=args.processes,
+                    lock_timeout=args.lock_timeout,
+                )
+        if args.profile:
+            print(json.dumps(profile.summary(), indent=2))
+
+        if args.validate_only:
+            for error in errors:
+                print(error)
+            print("{} error(s) found".format(len(errors)))
+            sys.exit(1 if errors else 0)
 
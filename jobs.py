@@ -0,0 +1,148 @@
+"""
+Background jobs for the challenge transfers. Jobs run on a thread of the
+process which received them and their state is kept in a local job table,
+so that any worker can report their progress.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import OperationalError
+from CTFd.models import db
+import datetime
+import threading
+import time
+import traceback
+import uuid
+
+
+# Imports are run one at a time in each process
+_executor = ThreadPoolExecutor(max_workers=1)
+# State of the jobs running in this process, which is more recent than the
+# job table while an import transaction is open
+_running = {}
+_lock = threading.Lock()
+
+JOB_RETENTION = datetime.timedelta(days=7)
+PROGRESS_INTERVAL = 1.0
+
+
+class PortableJobs(db.Model):
+    __tablename__ = "portable_jobs"
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), default="queued")
+    phase = db.Column(db.String(16))
+    processed = db.Column(db.Integer, default=0)
+    total = db.Column(db.Integer)
+    errors = db.Column(db.JSON)
+    summary = db.Column(db.JSON)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "phase": self.phase,
+            "processed": self.processed,
+            "total": self.total,
+            "errors": self.errors or [],
+            "summary": self.summary,
+        }
+
+
+class JobProgress(object):
+    """
+    Progress callback of a job. The state is updated in memory on every
+    call and written to the job table on phase changes and at most every
+    PROGRESS_INTERVAL seconds otherwise.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.last_saved = 0
+
+    def __call__(self, phase, processed=0, total=None):
+        with _lock:
+            state = _running[self.job_id]
+            phase_changed = state["phase"] != phase
+            state.update(phase=phase, processed=processed, total=total)
+        if phase_changed or time.time() - self.last_saved >= PROGRESS_INTERVAL:
+            self.save()
+
+    def save(self, final=False):
+        # SQLite locks the whole database during the import transaction, the
+        # progress is then only available in memory until the job finishes
+        if not final and db.engine.dialect.name == "sqlite":
+            return
+
+        with _lock:
+            state = dict(_running[self.job_id])
+        state.pop("id")
+        state["updated"] = datetime.datetime.utcnow()
+        # Use a separate connection, since the import runs in a transaction
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    PortableJobs.__table__.update()
+                    .where(PortableJobs.id == self.job_id)
+                    .values(**state)
+                )
+        except OperationalError:
+            if final:
+                raise
+        self.last_saved = time.time()
+
+    def finish(self, status, errors=None, summary=None):
+        with _lock:
+            _running[self.job_id].update(status=status, errors=errors or [], summary=summary)
+        try:
+            self.save(final=True)
+        finally:
+            with _lock:
+                del _running[self.job_id]
+
+
+def _run_job(app, job_id, target, args, kwargs):
+    with app.app_context():
+        progress = JobProgress(job_id)
+        with _lock:
+            _running[job_id]["status"] = "running"
+        progress.save()
+        try:
+            summary = target(progress, *args, **kwargs)
+        except ValueError as err:
+            progress.finish("failed", errors=[str(arg) for arg in err.args])
+        except Exception as err:
+            traceback.print_exc()
+            progress.finish("failed", errors=["Unexpected error: {}".format(err)])
+        else:
+            progress.finish("succeeded", summary=summary)
+        finally:
+            db.session.remove()
+
+
+def submit_job(app, target, *args, **kwargs):
+    """
+    Run target(progress, *args, **kwargs) in the background and return the
+    id of the job. target should raise ValueError to report errors, and
+    return a JSON serializable summary.
+    """
+    job_id = uuid.uuid4().hex
+    job = PortableJobs(id=job_id, status="queued", processed=0)
+    with _lock:
+        _running[job_id] = job.to_dict()
+
+    db.session.add(job)
+    PortableJobs.query.filter(
+        PortableJobs.created < datetime.datetime.utcnow() - JOB_RETENTION
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+    _executor.submit(_run_job, app, job_id, target, args, kwargs)
+    return job_id
+
+
+def get_job(job_id):
+    with _lock:
+        if job_id in _running:
+            return dict(_running[job_id])
+    job = PortableJobs.query.filter_by(id=job_id).first()
+    return job.to_dict() if job else None
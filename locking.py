@@ -0,0 +1,105 @@
+"""
+Database lock serializing the imports of all the workers and nodes sharing
+a database, so that concurrent imports never upsert the same challenges at
+once. Postgres provides advisory locks, which are released if the process
+holding them dies. Other databases hold the single row of the
+portable_import_lock table instead, which expires after LOCK_EXPIRY in
+case its holder died. The lock is held on its own connection, around the
+transaction of the import.
+"""
+from contextlib import contextmanager
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from CTFd.models import db
+import datetime
+import logging
+import time
+import uuid
+
+
+# Key of the Postgres advisory lock, shared by all the imports
+ADVISORY_LOCK_KEY = 0x706F727461626C65
+# Seconds an import waits for the one holding the lock
+LOCK_TIMEOUT = 300
+LOCK_EXPIRY = datetime.timedelta(hours=6)
+POLL_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class PortableImportLock(db.Model):
+    """Row held by the running import, on databases without advisory locks"""
+
+    __tablename__ = "portable_import_lock"
+    id = db.Column(db.Integer, primary_key=True)
+    holder = db.Column(db.String(32), nullable=False)
+    acquired = db.Column(db.DateTime, nullable=False)
+
+
+def _advisory(connection, function):
+    # Committed right away, the lock is held by the session, not a transaction
+    return connection.execute(
+        select([function(ADVISORY_LOCK_KEY)]).execution_options(autocommit=True)
+    ).scalar()
+
+
+def _try_row_lock(holder, expiry):
+    table = PortableImportLock.__table__
+    now = datetime.datetime.utcnow()
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.acquired < now - expiry))
+            connection.execute(table.insert().values(id=1, holder=holder, acquired=now))
+    except IntegrityError:
+        return False
+    except OperationalError:
+        # SQLite locks the whole database while another import writes to it
+        if db.engine.dialect.name != "sqlite":
+            raise
+        return False
+    return True
+
+
+def _wait(deadline, attempt):
+    """Wait before trying to take the lock again, unless deadline passed"""
+    if attempt == 1:
+        logger.info("Waiting for another import to finish")
+    if time.time() >= deadline:
+        raise ValueError("Another import is running, try again once it is done.")
+    time.sleep(POLL_INTERVAL)
+
+
+@contextmanager
+def import_lock(timeout=None, expiry=LOCK_EXPIRY):
+    """
+    Hold the import lock, waiting at most timeout seconds (LOCK_TIMEOUT by
+    default) for the import holding it. Raises a ValueError if it is still
+    held then. The lock has to be taken before the transaction of the
+    import starts, so that the transaction sees the challenges of the
+    previous import.
+    """
+    deadline = time.time() + (LOCK_TIMEOUT if timeout is None else timeout)
+    attempt = 0
+    if db.engine.dialect.name == "postgresql":
+        connection = db.engine.connect()
+        try:
+            while not _advisory(connection, func.pg_try_advisory_lock):
+                attempt += 1
+                _wait(deadline, attempt)
+            try:
+                yield
+            finally:
+                _advisory(connection, func.pg_advisory_unlock)
+        finally:
+            connection.close()
+    else:
+        holder = uuid.uuid4().hex
+        while not _try_row_lock(holder, expiry):
+            attempt += 1
+            _wait(deadline, attempt)
+        try:
+            yield
+        finally:
+            table = PortableImportLock.__table__
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.holder == holder))
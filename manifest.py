@@ -0,0 +1,82 @@
+"""
+Manifests of the exports, shipped in every export as manifest.json. A
+manifest lists the fingerprint of every exported challenge and the sha256
+of every stored attachment, by location in the upload folder, so that a
+later export given it as "since" only holds the challenges which changed
+since, the attachments which were not exported yet and the names of the
+challenges which were deleted, as a delta export.
+"""
+import hashlib
+import json
+
+try:
+    from .utils import challenge_fingerprint
+except ImportError:  # Running as a script
+    from utils import challenge_fingerprint
+
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_FORMAT = 1
+
+
+def export_fingerprint(properties):
+    """
+    Fingerprint of an exported challenge, including its attachments, whose
+    exported paths hold the sha256 of their content
+    """
+    digest = hashlib.sha256(challenge_fingerprint(properties).encode("utf-8"))
+    for filename in properties.get("files", []):
+        digest.update(b"\0" + filename.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_manifest(fingerprints, attachments, since=None, revision=None, existing=()):
+    """
+    Manifest of an export of the challenges whose fingerprints are given by
+    name, with the sha256 of their attachments by location. Exports made
+    since the manifest since are deltas, which list the challenges it has
+    and which do not exist anymore as deleted. The names of the stored
+    challenges which are not exported, e.g. since the export is filtered,
+    are given as existing: they are not deleted.
+    """
+    deleted = []
+    if since is not None:
+        existing = set(existing)
+        deleted = [
+            name
+            for name in since["challenges"]
+            if name not in fingerprints and name not in existing
+        ]
+    return {
+        "format": MANIFEST_FORMAT,
+        "revision": revision,
+        "delta": since is not None,
+        "challenges": fingerprints,
+        "attachments": attachments,
+        "deleted": deleted,
+    }
+
+
+def dump_manifest(manifest):
+    return json.dumps(manifest, sort_keys=True, indent=1)
+
+
+def load_manifest(data):
+    """Parse and check a manifest, raising a ValueError if it is invalid"""
+    try:
+        manifest = json.loads(data)
+    except ValueError as err:
+        raise ValueError("Invalid manifest. {}".format(err))
+    if not isinstance(manifest, dict) or manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError("Invalid manifest. Unknown format.")
+    for key in ["challenges", "attachments"]:
+        if not isinstance(manifest.get(key), dict) or not all(
+            isinstance(value, str) for value in manifest[key].values()
+        ):
+            raise ValueError("Invalid manifest. '{}' must be a mapping.".format(key))
+    deleted = manifest.get("deleted", [])
+    if not isinstance(deleted, list) or not all(isinstance(name, str) for name in deleted):
+        raise ValueError("Invalid manifest. 'deleted' must be a list of names.")
+    manifest["deleted"] = deleted
+    manifest["delta"] = bool(manifest.get("delta"))
+    return manifest
@@ -1,18 +1,268 @@
-from flask import Blueprint, send_file, request, abort, render_template_string, jsonify
-from werkzeug.utils import secure_filename
-from .exporter import export_challenges
-from .importer import import_challenges
-from tempfile import TemporaryFile, mkdtemp
-from gzip import GzipFile
+from flask import (
+    Blueprint,
+    Response,
+    request,
+    session,
+    abort,
+    render_template_string,
+    jsonify,
+    send_file,
+)
+from .exporter import (
+    FILTERS,
+    VISIBILITIES,
+    collect_challenges,
+    shard_challenges,
+    spool_challenges,
+    stream_export,
+)
+from .compression import CODECS, DEFAULT_CODEC, open_tar
+from .formats import DEFAULT_FORMAT, FORMATS, SHARD_NAMES, SPEC_NAMES
+from .export_cache import (
+    DEFAULT_CACHE_SIZE,
+    ExportCache,
+    export_revision,
+    init_revision,
+    track_revisions,
+)
+from .manifest import MANIFEST_NAME, dump_manifest
+from .importer import TarSource, import_challenges, validate_spec
+from .profiling import Profile, count_queries
+from .jobs import get_job, submit_job
+from .file_digests import PortableFileDigest  # noqa: F401
+from .locking import LOCK_TIMEOUT
+from .uploads import (
+    DEFAULT_CHUNK_SIZE,
+    archive_checksum,
+    finalize_upload,
+    init_upload,
+    upload_status,
+    write_chunk,
+)
+from tempfile import mkdtemp
 from CTFd.utils.decorators import admins_only
-from CTFd.plugins import register_plugin_assets_directory
+from CTFd.plugins import bypass_csrf_protection, register_plugin_assets_directory
+import json
 import tarfile
-import gzip
 import os
 import shutil
 
 
+# Limits of uploaded archives, which are checked as they are decompressed
+MAX_ARCHIVE_SIZE = 8 * 1024 * 1024 * 1024
+MAX_ARCHIVE_MEMBERS = 100000
+
+
+def _outside(path):
+    return path.startswith("/") or ".." in path.split("/")
+
+
+def _checked_members(archive, max_size, max_members):
+    """
+    Members of archive, read in a single pass and checked as they are read,
+    so that an archive decompressing to more than max_size bytes or holding
+    more than max_members members is rejected without reading it all
+    """
+    for count, member in enumerate(archive, 1):
+        if count > max_members:
+            raise ValueError(
+                "Invalid archive. More than {} members.".format(max_members)
+            )
+        if member.offset_data + member.size > max_size:
+            raise ValueError(
+                "Invalid archive. Larger than {} bytes once decompressed.".format(
+                    max_size
+                )
+            )
+
+        # Check for atttempts to escape to higher dirs
+        memberpath = os.path.normpath(member.name)
+        if _outside(memberpath):
+            raise ValueError(
+                "Invalid archive. Path outside of the archive: " + member.name
+            )
+        if member.ischr() or member.isblk() or member.isfifo():
+            raise ValueError("Invalid archive. Device file: " + member.name)
+
+        # Symbolic links are relative to their directory, hard links to the
+        # root of the archive
+        if member.issym():
+            linkpath = os.path.normpath(
+                os.path.join(os.path.dirname(memberpath), member.linkname)
+            )
+        else:
+            linkpath = os.path.normpath(member.linkname or ".")
+        if _outside(linkpath):
+            raise ValueError(
+                "Invalid archive. Link outside of the archive: " + member.name
+            )
+        yield member
+
+
+def open_archive(
+    archive_path, max_size=MAX_ARCHIVE_SIZE, max_members=MAX_ARCHIVE_MEMBERS
+):
+    """
+    Open and check an uploaded archive, and return its TarSource. The
+    archive is decompressed once to index its members. The caller closes
+    the archive of the source.
+    """
+    archive = open_tar(archive_path, max_size)
+    try:
+        source = TarSource(archive, _checked_members(archive, max_size, max_members))
+        # Sharded archives hold a spec file per challenge instead
+        if not any(map(source.exists, SPEC_NAMES)) and not any(
+            source.find("", shard_name) for shard_name in SHARD_NAMES
+        ):
+            raise ValueError(
+                "Invalid archive. Missing {0}.".format(
+                    " or ".join("'{0}'".format(name) for name in SPEC_NAMES)
+                )
+            )
+    except Exception:
+        archive.close()
+        raise
+    return source
+
+
+def run_import(
+    progress,
+    archive_dir,
+    archive_path,
+    upload_folder,
+    force=False,
+    dry_run=False,
+    profile=None,
+    include_profile=False,
+    checksum=None,
+    chunk_size=None,
+    max_size=MAX_ARCHIVE_SIZE,
+    max_members=MAX_ARCHIVE_MEMBERS,
+    processes=1,
+    lock_timeout=LOCK_TIMEOUT,
+):
+    """
+    Background job importing (or only validating) the challenges of an
+    uploaded archive. The attachments are read straight from the archive,
+    without extracting it. The profile of the job is added to its summary if
+    include_profile is set. Archives uploaded in chunks are first checked
+    against the checksum of the client, if given. Archives larger than
+    max_size bytes once decompressed, or with more than max_members
+    members, are rejected. Imports wait at most lock_timeout seconds for
+    the import of another worker, and are split across the given number
+    of processes if they are large enough (see import_challenges).
+    """
+    profile = profile or Profile("import")
+    try:
+        if checksum:
+            progress("verify")
+            with profile.phase("verify"):
+                if archive_checksum(archive_path, chunk_size) != checksum.lower():
+                    raise ValueError("Checksum mismatch, the archive is corrupted.")
+
+        progress("extract")
+        with profile.phase("scan"):
+            try:
+                source = open_archive(archive_path, max_size, max_members)
+            except tarfile.TarError as err:
+                raise ValueError("Invalid archive. {}".format(err))
+
+        with source.archive:
+            spec = next((name for name in SPEC_NAMES if source.exists(name)), "")
+
+            # A dry run reports all the errors without modifying anything
+            if dry_run:
+                progress("validate")
+                errors = validate_spec(
+                    spec, source=source, profile=profile, dst_attachments=upload_folder
+                )
+                if errors:
+                    raise ValueError(*errors)
+                summary = {}
+            else:
+                summary = import_challenges(
+                    spec,
+                    upload_folder,
+                    move=True,
+                    force=force,
+                    progress=progress,
+                    source=source,
+                    profile=profile,
+                    processes=processes,
+                    lock_timeout=lock_timeout,
+                )
+    finally:
+        shutil.rmtree(archive_dir)
+
+    if include_profile:
+        summary["profile"] = profile.summary()
+    return summary or None
+
+
+def export_filters(args):
+    """
+    Read the filters of a partial export from the query parameters, which
+    may be repeated, e.g. ?category=web&category=crypto&visibility=visible
+    """
+    filters = {name: args.getlist(name) for name in FILTERS if name != "visibility"}
+    try:
+        filters["id"] = [int(chal_id) for chal_id in filters["id"]]
+    except ValueError:
+        abort(400)
+    filters["visibility"] = args.get("visibility")
+    if filters["visibility"] not in VISIBILITIES + [None]:
+        abort(400)
+    return filters
+
+
+def export_compression(args):
+    """Read the codec and the compression level of an export from the query parameters"""
+    codec = args.get("compression", DEFAULT_CODEC)
+    if codec not in CODECS:
+        abort(400)
+    level = args.get("level")
+    if level is not None:
+        try:
+            level = int(level)
+        except ValueError:
+            abort(400)
+        if level not in CODECS[codec].levels:
+            abort(400)
+    return codec, level
+
+
+def export_format(args):
+    """Read the spec format of an export from the query parameters"""
+    spec_format = args.get("format", DEFAULT_FORMAT)
+    if spec_format not in FORMATS:
+        abort(400)
+    return spec_format
+
+
 def load(app):
+    app.db.create_all()
+    init_revision()
+    track_revisions()
+    # Kept next to the attachments rather than in the shared temporary
+    # directory, since uploads and exports hold the flags of the challenges
+    upload_folder = os.path.join(app.root_path, app.config["UPLOAD_FOLDER"])
+    upload_dir = app.config.get(
+        "PORTABLE_UPLOAD_DIR", os.path.join(upload_folder, "portable-uploads")
+    )
+    upload_chunk_size = app.config.get("PORTABLE_UPLOAD_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+    max_archive_size = app.config.get("PORTABLE_MAX_ARCHIVE_SIZE", MAX_ARCHIVE_SIZE)
+    max_archive_members = app.config.get(
+        "PORTABLE_MAX_ARCHIVE_MEMBERS", MAX_ARCHIVE_MEMBERS
+    )
+    import_processes = app.config.get("PORTABLE_IMPORT_PROCESSES", 1)
+    import_lock_timeout = app.config.get("PORTABLE_IMPORT_LOCK_TIMEOUT", LOCK_TIMEOUT)
+    export_cache = ExportCache(
+        app.config.get(
+            "PORTABLE_EXPORT_CACHE",
+            os.path.join(upload_folder, "portable-exports"),
+        ),
+        app.config.get("PORTABLE_EXPORT_CACHE_SIZE", DEFAULT_CACHE_SIZE),
+    )
     portable = Blueprint("portable", __name__)
 
     @portable.route("/admin/yaml", methods=["GET", "POST"])
@@ -20,87 +270,224 @@ def load(app):
     def transfer_yaml():
         upload_folder = os.path.join(app.root_path, app.config["UPLOAD_FOLDER"])
         if request.method == "GET":
-            tarfile_backend = TemporaryFile(mode="wb+")
-            yamlfile = TemporaryFile(mode="wb+")
-            tarball = tarfile.open(fileobj=tarfile_backend, mode="w")
-            print(upload_folder)
-
-            res = export_challenges("challenges.yaml", "files", upload_folder, tarball)
-            
-            yamlfile.write(bytes(res, encoding='utf-8'))
-
-            tarinfo = tarfile.TarInfo("challenges.yaml")
-            tarinfo.size = yamlfile.tell()
-            yamlfile.seek(0)
-            tarball.addfile(tarinfo, yamlfile)
-            tarball.close()
-            yamlfile.close()
-
-            gzipfile_backend = TemporaryFile(mode="wb+")
-            gzipfile = GzipFile(fileobj=gzipfile_backend, mode='wb+')
-
-            tarfile_backend.seek(0)
-            shutil.copyfileobj(tarfile_backend, gzipfile)
-
-            tarfile_backend.close()
-            gzipfile.close()
-            gzipfile_backend.seek(0)
-            return send_file(
-                gzipfile_backend,
-                as_attachment=True,
-                attachment_filename="export.tar.gz",
-            )
+            profile = Profile("export")
+            count_queries(app.db.engine)
+
+            # Unchanged challenges are served from the cache, or not at all
+            # if the client already has them
+            filters = export_filters(request.args)
+            with_prerequisites = "prerequisites" in request.args
+            shards = "shards" in request.args
+            spec_format = export_format(request.args)
+            codec, level = export_compression(request.args)
+            # Deltas since an export whose manifest is not kept anymore are
+            # full exports
+            since = export_cache.load_manifest(request.args.get("since", ""))
+            with profile.active(), profile.phase("revision"):
+                revision = export_revision(
+                    upload_folder,
+                    filters,
+                    with_prerequisites,
+                    codec,
+                    level,
+                    shards,
+                    spec_format,
+                    request.args["since"] if since else None,
+                )
+            if revision in request.if_none_match:
+                response = Response(status=304)
+                profile.log()
+            else:
+                cached = export_cache.open(revision)
+                if cached is not None:
+                    response = send_file(
+                        cached,
+                        mimetype=CODECS[codec].mimetype,
+                        as_attachment=True,
+                        attachment_filename="export" + CODECS[codec].extension,
+                        add_etags=False,
+                    )
+                    profile.add_bytes("archive", os.fstat(cached.fileno()).st_size)
+                    profile.log()
+                else:
+                    with profile.active():
+                        with profile.phase("query"):
+                            chals_list, file_map, links, manifest = collect_challenges(
+                                FORMATS[spec_format].spec_name,
+                                "files",
+                                upload_folder,
+                                filters,
+                                with_prerequisites,
+                                since=since,
+                            )
+                        with profile.phase("serialize"):
+                            if shards:
+                                spec = [
+                                    (name, text.encode("utf-8"))
+                                    for name, text in shard_challenges(
+                                        chals_list,
+                                        FORMATS[spec_format].spec_name,
+                                        spec_format,
+                                    )
+                                ]
+                            else:
+                                spec = [
+                                    (
+                                        FORMATS[spec_format].spec_name,
+                                        spool_challenges(chals_list, spec_format),
+                                    )
+                                ]
+                            # The revision of the archive is the marker of
+                            # the deltas since it
+                            manifest["revision"] = revision
+                            export_cache.store_manifest(revision, manifest)
+                            spec.append(
+                                (MANIFEST_NAME, dump_manifest(manifest).encode("utf-8"))
+                            )
+
+                    # The archive is compressed and sent while it is being
+                    # built, and cached once complete
+                    response = Response(
+                        export_cache.store(
+                            revision,
+                            stream_export(
+                                spec,
+                                file_map,
+                                links,
+                                codec=codec,
+                                level=level,
+                                profile=profile,
+                            ),
+                        ),
+                        mimetype=CODECS[codec].mimetype,
+                        headers={
+                            "Content-Disposition": "attachment; filename=export"
+                            + CODECS[codec].extension
+                        },
+                    )
+            response.set_etag(revision)
+            response.headers["Cache-Control"] = "private, no-cache"
+            # The archive is still being built, the profile only covers what
+            # happened before it is sent
+            if "profile" in request.args:
+                response.headers["X-Portable-Profile"] = json.dumps(profile.summary())
+            return response
 
         if request.method == "POST":
             if "file" not in request.files:
                 abort(400)
 
-            file = request.files["file"]
+            profile = Profile("import")
+            with profile.phase("receive"):
+                file = request.files["file"]
+
+                # The upload only lives as long as the request, keep a copy
+                # for the background job
+                archive_dir = mkdtemp()
+                archive_path = os.path.join(archive_dir, "archive")
+                file.save(archive_path)
+            profile.add_bytes("received", os.path.getsize(archive_path))
 
-            readmode = "r:gz"
-            if file.filename.endswith(".tar"):
-                readmode = "r"
-            if file.filename.endswith(".bz2"):
-                readmode = "r:bz2"
+            dry_run = "dry_run" in request.args
+            job_id = submit_job(
+                app,
+                run_import,
+                archive_dir,
+                archive_path,
+                upload_folder,
+                force="force" in request.args,
+                dry_run=dry_run,
+                profile=profile,
+                include_profile="profile" in request.args,
+                max_size=max_archive_size,
+                max_members=max_archive_members,
+                processes=import_processes,
+                lock_timeout=import_lock_timeout,
+            )
+            return jsonify({"success": True, "job": job_id, "dry_run": dry_run})
 
-            tempdir = mkdtemp()
+    @portable.route("/admin/yaml/uploads", methods=["POST"])
+    @admins_only
+    def start_upload():
+        size = (request.get_json(silent=True) or {}).get("size")
+        try:
+            upload_id = init_upload(upload_dir, size, upload_chunk_size)
+        except ValueError as err:
+            return jsonify({"success": False, "errors": [str(err)]}), 400
+        return jsonify(
+            {"success": True, "upload": upload_id, "chunk_size": upload_chunk_size}
+        )
+
+    @portable.route("/admin/yaml/uploads/<upload_id>", methods=["GET", "PUT"])
+    @admins_only
+    @bypass_csrf_protection
+    def upload_chunk(upload_id):
+        try:
+            if request.method == "GET":
+                return jsonify(dict(upload_status(upload_dir, upload_id), success=True))
+
+            # Chunks are sent as raw bodies, which CTFd does not look for the
+            # nonce in
+            if request.headers.get("CSRF-Token") != session.get("nonce"):
+                abort(403)
             try:
-                archive = tarfile.open(fileobj=file.stream, mode=readmode)
-
-                if "challenges.yaml" not in archive.getnames():
-                    shutil.rmtree(tempdir)
-                    abort(400)
-
-                # Check for atttempts to escape to higher dirs
-                for member in archive.getmembers():
-                    memberpath = os.path.normpath(member.name)
-                    if memberpath.startswith("/") or ".." in memberpath.split("/"):
-                        shutil.rmtree(tempdir)
-                        abort(400)
-
-                    if member.linkname:
-                        linkpath = os.path.normpath(member.linkname)
-                        if linkpath.startswith("/") or ".." in linkpath.split("/"):
-                            shutil.rmtree(tempdir)
-                            abort(400)
-
-                archive.extractall(path=tempdir)
-
-            except tarfile.TarError:
-                shutil.rmtree(tempdir)
-                print("b")
+                offset = int(request.args["offset"])
+            except (KeyError, ValueError):
                 abort(400)
-
-            in_file = os.path.join(tempdir, "challenges.yaml")
-            
             try:
-                import_challenges(in_file, upload_folder, move=True)
+                index = write_chunk(
+                    upload_dir,
+                    upload_id,
+                    offset,
+                    request.stream,
+                    request.headers.get("X-Chunk-Sha256"),
+                )
             except ValueError as err:
-                return jsonify({"success": False, "errors": err.args})
-               
-            shutil.rmtree(tempdir)
-            
-            return jsonify({"success": True})
+                return jsonify({"success": False, "errors": [str(err)]}), 400
+        except KeyError:
+            abort(404)
+        return jsonify({"success": True, "chunk": index})
+
+    @portable.route("/admin/yaml/uploads/<upload_id>/finalize", methods=["POST"])
+    @admins_only
+    def finalize(upload_id):
+        upload_folder = os.path.join(app.root_path, app.config["UPLOAD_FOLDER"])
+        profile = Profile("import")
+        try:
+            archive_dir, archive_path, chunk_size = finalize_upload(upload_dir, upload_id)
+        except KeyError:
+            abort(404)
+        except ValueError as err:
+            return jsonify({"success": False, "errors": [str(err)]}), 400
+        profile.add_bytes("received", os.path.getsize(archive_path))
+
+        dry_run = "dry_run" in request.args
+        job_id = submit_job(
+            app,
+            run_import,
+            archive_dir,
+            archive_path,
+            upload_folder,
+            force="force" in request.args,
+            dry_run=dry_run,
+            profile=profile,
+            include_profile="profile" in request.args,
+            checksum=(request.get_json(silent=True) or {}).get("sha256"),
+            chunk_size=chunk_size,
+            max_size=max_archive_size,
+            max_members=max_archive_members,
+            processes=import_processes,
+            lock_timeout=import_lock_timeout,
+        )
+        return jsonify({"success": True, "job": job_id, "dry_run": dry_run})
+
+    @portable.route("/admin/yaml/jobs/<job_id>", methods=["GET"])
+    @admins_only
+    def import_status(job_id):
+        job = get_job(job_id)
+        if job is None:
+            abort(404)
+        return jsonify(job)
 
     @portable.route("/admin/transfer", methods=["GET"])
     @admins_only
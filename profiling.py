@@ -0,0 +1,170 @@
+"""
+Instrumentation of the transfers. A Profile measures the time spent in each
+phase of an import or export, the SQL queries it runs, the bytes it moves
+and the slowest challenges. It is logged once the transfer is done and can
+be returned as a JSON summary.
+"""
+from contextlib import contextmanager
+import cProfile
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Number of challenges listed in the summary, slowest first
+SLOWEST_CHALLENGES = 20
+
+# Profile receiving the queries of the current thread
+_current = threading.local()
+
+
+class Profile(object):
+    """
+    Timers of the phases of a transfer. Phases can be nested, the time of a
+    phase excludes the time of the phases nested in it. Phases can run on
+    several threads, e.g. to compress an archive while it is sent.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.bytes = {}
+        self.challenges = {}
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._stacks = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._stacks, "phases"):
+            self._stacks.phases = []
+        return self._stacks.phases
+
+    @contextmanager
+    def phase(self, name):
+        stack = self._stack()
+        # Time spent in the phases nested in this one
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add_time(name, elapsed - nested)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_bytes(self, name, count):
+        with self._lock:
+            self.bytes[name] = self.bytes.get(name, 0) + count
+
+    @contextmanager
+    def challenge(self, name):
+        """Add the time of the block to the duration of the challenge name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.challenges[name] = (
+                    self.challenges.get(name, 0.0) + time.perf_counter() - start
+                )
+
+    def timed_writer(self, fileobj, name):
+        """File object timing the writes to fileobj as the phase name"""
+        return _TimedWriter(self, fileobj, name)
+
+    @contextmanager
+    def active(self):
+        """Count the queries run by the current thread in this profile"""
+        previous = getattr(_current, "profile", None)
+        _current.profile = self
+        try:
+            yield self
+        finally:
+            _current.profile = previous
+
+    def summary(self):
+        slowest = sorted(self.challenges.items(), key=lambda item: item[1], reverse=True)
+        return {
+            "name": self.name,
+            "seconds": round(time.perf_counter() - self.start, 6),
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "queries": self.queries,
+            "bytes": dict(self.bytes),
+            "slowest_challenges": [
+                {"name": name, "seconds": round(seconds, 6)}
+                for name, seconds in slowest[:SLOWEST_CHALLENGES]
+            ],
+        }
+
+    def log(self):
+        summary = self.summary()
+        logger.info(
+            "%s done in %.3f s, %d queries, phases: %s, bytes: %s",
+            self.name,
+            summary["seconds"],
+            summary["queries"],
+            ", ".join(
+                "{} {:.3f} s".format(name, seconds)
+                for name, seconds in summary["phases"].items()
+            ),
+            ", ".join("{} {}".format(name, count) for name, count in self.bytes.items())
+            or "none",
+        )
+
+
+class _TimedWriter(object):
+    def __init__(self, profile, fileobj, name):
+        self.profile = profile
+        self.fileobj = fileobj
+        self.name = name
+
+    def write(self, data):
+        with self.profile.phase(self.name):
+            return self.fileobj.write(data)
+
+    def flush(self):
+        with self.profile.phase(self.name):
+            self.fileobj.flush()
+
+    def close(self):
+        with self.profile.phase(self.name):
+            self.fileobj.close()
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_current, "profile", None)
+    if profile is not None:
+        profile.queries += 1
+
+
+def count_queries(engine):
+    """Count the queries run on engine in the active profile of their thread"""
+    from sqlalchemy import event
+
+    if not event.contains(engine, "before_cursor_execute", _count_query):
+        event.listen(engine, "before_cursor_execute", _count_query)
+
+
+@contextmanager
+def cprofiled(path):
+    """Run the block under cProfile and dump the statistics to path, if given"""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info("cProfile statistics written to %s", path)
@@ -0,0 +1,58 @@
+"""
+Fixtures of the tests, which run the plugin on top of the CTFd stand-in of
+the benchmark_stub directory, like the pipeline benchmark, with a new SQLite
+database for every test.
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark  # noqa: E402
+
+# The plugin is imported as a package, the way CTFd loads it, under the name
+# pytest gives it too since the root of the repository is a package
+sys.path.insert(0, benchmark.STUB_PATH)
+sys.path.insert(0, os.path.dirname(ROOT))
+PLUGIN = importlib.import_module(os.path.basename(ROOT))
+
+
+@pytest.fixture(scope="session")
+def plugin():
+    return PLUGIN
+
+
+def _make_app(workdir, upload_provider):
+    os.makedirs(workdir)
+    app = benchmark.make_app(workdir, None, upload_provider)
+    # Imports and exports are given the upload folder as a path
+    app.config["UPLOAD_FOLDER"] = os.path.join(workdir, "uploads")
+    with app.app_context():
+        PLUGIN.load(app)
+    return app
+
+
+# The fixtures do not push the contexts of the apps, since the apps would
+# then share the scoped session of the first one: tests push them in turn
+
+@pytest.fixture
+def app(tmp_path):
+    return _make_app(str(tmp_path / "ctfd"), "filesystem")
+
+
+@pytest.fixture
+def other_app(tmp_path):
+    """A second CTFd instance, e.g. to import the exports of app into"""
+    return _make_app(str(tmp_path / "other"), "filesystem")
+
+
+@pytest.fixture
+def s3_app(tmp_path):
+    """An instance storing its attachments in the S3 stand-in"""
+    app = _make_app(str(tmp_path / "s3"), "s3")
+    app.config["STUB_S3_LATENCY"] = 0
+    return app
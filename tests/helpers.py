@@ -0,0 +1,66 @@
+"""Helpers of the tests, building specs and going through the web endpoints"""
+from io import BytesIO
+import os
+import tarfile
+import time
+
+import yaml
+
+# Seconds an import job of the tests may take
+JOB_TIMEOUT = 60
+
+
+def write_spec(directory, chals, files=None):
+    """
+    Write the spec of chals, and the attachments given by path as files, to
+    directory. Returns the path of the spec.
+    """
+    for filename, content in (files or {}).items():
+        path = os.path.join(directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+    os.makedirs(directory, exist_ok=True)
+    spec_path = os.path.join(directory, "challenges.yaml")
+    with open(spec_path, "w") as f:
+        yaml.safe_dump({"challs": chals}, f)
+    return spec_path
+
+
+def make_challenge(i, **properties):
+    chal = {
+        "name": "chall%d" % i,
+        "category": "category%d" % (i % 2),
+        "description": "Description of challenge %d" % i,
+        "value": 100 + i,
+        "flags": [{"flag": "flag{%d}" % i}],
+    }
+    chal.update(properties)
+    return chal
+
+
+def web_export(client, query=""):
+    """Archive and revision of an export through /admin/yaml"""
+    response = client.get("/admin/yaml" + query)
+    assert response.status_code == 200
+    return response.data, response.headers["ETag"].strip('"')
+
+
+def read_member(archive, name):
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        return tar.extractfile(name).read()
+
+
+def web_import(client, archive):
+    """Import archive through /admin/yaml, returns the finished job"""
+    response = client.post(
+        "/admin/yaml", data={"file": (BytesIO(archive), "export.tar.gz")}
+    )
+    job_id = response.get_json()["job"]
+    deadline = time.time() + JOB_TIMEOUT
+    while time.time() < deadline:
+        job = client.get("/admin/yaml/jobs/" + job_id).get_json()
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError("Import job {0} did not finish: {1}".format(job_id, job))
@@ -0,0 +1,93 @@
+"""Checks of the members of uploaded archives"""
+from io import BytesIO
+import tarfile
+
+import pytest
+
+SPEC = b"challs: []\n"
+
+
+def _member(name, **attributes):
+    member = tarfile.TarInfo(name)
+    for attribute, value in attributes.items():
+        setattr(member, attribute, value)
+    return member
+
+
+def _archive(path, members):
+    """Write a tar.gz of the spec and of the (TarInfo, content) members"""
+    with tarfile.open(path, "w:gz") as tar:
+        spec = _member("challenges.yaml", size=len(SPEC))
+        tar.addfile(spec, BytesIO(SPEC))
+        for member, content in members:
+            member.size = len(content)
+            tar.addfile(member, BytesIO(content))
+    return path
+
+
+def _open(plugin, path, **limits):
+    source = plugin.portable.open_archive(path, **limits)
+    source.archive.close()
+    return source
+
+
+@pytest.mark.parametrize(
+    "member, error",
+    [
+        (_member("/etc/passwd"), "Path outside of the archive: /etc/passwd"),
+        (_member("files/../../passwd"), "Path outside of the archive: files/../../passwd"),
+        (
+            _member("files/link", type=tarfile.SYMTYPE, linkname="../../etc/passwd"),
+            "Link outside of the archive: files/link",
+        ),
+        (
+            _member("files/link", type=tarfile.LNKTYPE, linkname="/etc/passwd"),
+            "Link outside of the archive: files/link",
+        ),
+        (_member("files/tty", type=tarfile.CHRTYPE), "Device file: files/tty"),
+        (_member("files/disk", type=tarfile.BLKTYPE), "Device file: files/disk"),
+        (_member("files/fifo", type=tarfile.FIFOTYPE), "Device file: files/fifo"),
+    ],
+)
+def test_unsafe_members_are_rejected(plugin, tmp_path, member, error):
+    path = _archive(str(tmp_path / "archive.tar.gz"), [(member, b"")])
+    with pytest.raises(ValueError) as info:
+        _open(plugin, path)
+    assert info.value.args == ("Invalid archive. " + error,)
+
+
+def test_archive_limits(plugin, tmp_path):
+    members = [(_member("files/%d.bin" % i), b"x" * 1024) for i in range(5)]
+    path = _archive(str(tmp_path / "archive.tar.gz"), members)
+    with pytest.raises(ValueError) as info:
+        _open(plugin, path, max_members=4)
+    assert info.value.args == ("Invalid archive. More than 4 members.",)
+    with pytest.raises(ValueError) as info:
+        _open(plugin, path, max_size=4096)
+    assert info.value.args == ("Invalid archive. Larger than 4096 bytes once decompressed.",)
+    assert _open(plugin, path, max_members=6, max_size=65536).exists("files/4.bin")
+
+
+def test_links_within_the_archive_are_read(plugin, tmp_path):
+    members = [
+        (_member("files/a.txt"), b"a"),
+        (_member("files/b.txt", type=tarfile.LNKTYPE, linkname="files/a.txt"), b""),
+        (_member("files/c.txt", type=tarfile.SYMTYPE, linkname="a.txt"), b""),
+    ]
+    source = plugin.portable.open_archive(_archive(str(tmp_path / "a.tar.gz"), members))
+    try:
+        with source.open("files/b.txt") as f:
+            assert f.read() == b"a"
+        # Only regular files and hard links to them are attachments
+        assert not source.exists("files/c.txt")
+    finally:
+        source.archive.close()
+
+
+def test_archive_without_spec_is_rejected(plugin, tmp_path):
+    path = str(tmp_path / "archive.tar.gz")
+    with tarfile.open(path, "w:gz") as tar:
+        tar.addfile(_member("files/a.txt", size=1), BytesIO(b"a"))
+    with pytest.raises(ValueError) as info:
+        _open(plugin, path)
+    assert info.value.args[0].startswith("Invalid archive. Missing 'challenges.yaml'")
@@ -0,0 +1,111 @@
+"""Delta exports, made since the manifest of a previous export"""
+import json
+
+from helpers import make_challenge, read_member, web_export, web_import, write_spec
+
+
+def _delete_challenge(name):
+    from CTFd.models import db, Challenges, Flags
+
+    chal = Challenges.query.filter_by(name=name).one()
+    Flags.query.filter_by(challenge_id=chal.id).delete()
+    db.session.delete(chal)
+    db.session.commit()
+
+
+def _change_challenge(name):
+    from CTFd.models import db, Challenges
+
+    Challenges.query.filter_by(name=name).one().description += " (changed)"
+    db.session.commit()
+
+
+def test_filtered_delta_keeps_challenges_left_out(plugin, app, other_app, tmp_path):
+    from CTFd.models import Challenges
+
+    spec = write_spec(str(tmp_path / "spec"), [make_challenge(i) for i in range(6)])
+    with app.app_context():
+        plugin.importer.import_challenges(spec, app.config["UPLOAD_FOLDER"])
+        archive, revision = web_export(app.test_client())
+    with other_app.app_context():
+        assert web_import(other_app.test_client(), archive)["status"] == "succeeded"
+
+    with app.app_context():
+        _change_challenge("chall1")
+        delta, _ = web_export(
+            app.test_client(), "?since=%s&category=category1" % revision
+        )
+    manifest = json.loads(read_member(delta, "manifest.json"))
+    assert manifest["delta"]
+    assert manifest["deleted"] == []
+
+    with other_app.app_context():
+        job = web_import(other_app.test_client(), delta)
+        assert job["status"] == "succeeded", job["errors"]
+        assert job["summary"]["challenges"] == {"chall1": "updated"}
+        assert Challenges.query.count() == 6
+
+
+def test_filtered_delta_lists_deleted_challenges(plugin, app, tmp_path):
+    spec = write_spec(str(tmp_path / "spec"), [make_challenge(i) for i in range(6)])
+    out = str(tmp_path / "export")
+    uploads = app.config["UPLOAD_FOLDER"]
+    with app.app_context():
+        plugin.importer.import_challenges(spec, uploads)
+        since = plugin.exporter.collect_challenges(
+            out + "/challenges.yaml", out + "/files", uploads
+        )[3]
+
+        # Deleted challenges are listed whether the filters match them or not
+        _delete_challenge("chall2")
+        _change_challenge("chall1")
+        chals, _, _, manifest = plugin.exporter.collect_challenges(
+            out + "/challenges.yaml",
+            out + "/files",
+            uploads,
+            filters={"category": ["category1"]},
+            since=since,
+        )
+    assert [chal["name"] for chal in chals] == ["chall1"]
+    assert manifest["deleted"] == ["chall2"]
+    assert sorted(manifest["challenges"]) == ["chall1", "chall3", "chall5"]
+
+
+def _s3_delta(plugin, app, s3_app, tmp_path, change):
+    """Import a full export of app into s3_app, and a delta once changed"""
+    files = {"files/a.txt": b"a" * 10}
+    chals = [make_challenge(0, files=["files/a.txt"]), make_challenge(1)]
+    spec = write_spec(str(tmp_path / "spec"), chals, files)
+    with app.app_context():
+        plugin.importer.import_challenges(spec, app.config["UPLOAD_FOLDER"])
+        archive, revision = web_export(app.test_client())
+    with s3_app.app_context():
+        assert web_import(s3_app.test_client(), archive)["status"] == "succeeded"
+    with app.app_context():
+        change()
+        delta, _ = web_export(app.test_client(), "?since=" + revision)
+    with s3_app.app_context():
+        return web_import(s3_app.test_client(), delta)
+
+
+def test_delta_on_s3_skips_stored_attachments(plugin, app, s3_app, tmp_path):
+    job = _s3_delta(plugin, app, s3_app, tmp_path, lambda: _change_challenge("chall0"))
+    assert job["status"] == "succeeded", job["errors"]
+    assert job["summary"]["challenges"] == {"chall0": "updated"}
+    assert job["summary"]["files"]["skipped"] == 1
+    assert job["summary"]["files"]["uploaded"] == 0
+
+
+def test_delta_on_s3_rejects_unreadable_attachments(plugin, app, s3_app, tmp_path):
+    from CTFd.models import db, ChallengeFiles, Challenges
+
+    def move_attachment():
+        chal = Challenges.query.filter_by(name="chall1").one()
+        ChallengeFiles.query.one().challenge_id = chal.id
+        db.session.commit()
+
+    # The attachment of the previous export is now attached to another
+    # challenge, and would have to be read from the S3 stand-in
+    job = _s3_delta(plugin, app, s3_app, tmp_path, move_attachment)
+    assert job["status"] == "failed"
+    assert any("Import a full export instead." in error for error in job["errors"])
@@ -0,0 +1,104 @@
+"""Exports of the stored challenges"""
+import os
+import stat
+
+from sqlalchemy import event
+
+from helpers import make_challenge, write_spec
+
+
+def _import(plugin, app, directory, count):
+    files = {}
+    chals = []
+    for i in range(count):
+        files["files/%d.txt" % i] = b"content %d" % i
+        chals.append(
+            make_challenge(
+                i,
+                tags=["tag%d" % (i % 3)],
+                hints=[{"content": "hint", "cost": 0}],
+                files=["files/%d.txt" % i],
+                prerequisites=["chall%d" % (i - 1)] if i else [],
+            )
+        )
+    spec = write_spec(directory, chals, files)
+    plugin.importer.import_challenges(spec, app.config["UPLOAD_FOLDER"])
+
+
+def _export_queries(plugin, app, out, **options):
+    """Number of challenges exported to out, and of queries made"""
+    queries = []
+
+    def count_query(*args):
+        queries.append(args[2])
+
+    event.listen(app.db.engine, "before_cursor_execute", count_query)
+    try:
+        chals = plugin.exporter.collect_challenges(
+            out + "/challenges.yaml", out + "/files", app.config["UPLOAD_FOLDER"], **options
+        )[0]
+    finally:
+        event.remove(app.db.engine, "before_cursor_execute", count_query)
+    return len(chals), len(queries)
+
+
+def _export_queries_by_count(plugin, app, tmp_path, **options):
+    counts = []
+    with app.app_context():
+        for count in (10, 100):
+            _import(plugin, app, str(tmp_path / ("spec%d" % count)), count)
+            app.db.session.remove()
+            counts.append(
+                _export_queries(plugin, app, str(tmp_path / ("export%d" % count)), **options)
+            )
+    return counts
+
+
+def test_export_queries_do_not_depend_on_challenge_count(plugin, app, tmp_path):
+    (chals_10, queries_10), (chals_100, queries_100) = _export_queries_by_count(
+        plugin, app, tmp_path
+    )
+    assert (chals_10, chals_100) == (10, 100)
+    assert queries_10 == queries_100
+
+
+def test_filtered_export_queries_do_not_depend_on_challenge_count(plugin, app, tmp_path):
+    # The prerequisites of the challenges chain all of them
+    (chals_10, queries_10), (chals_100, queries_100) = _export_queries_by_count(
+        plugin, app, tmp_path, filters={"category": ["category1"]}, with_prerequisites=True
+    )
+    assert (chals_10, chals_100) == (10, 100)
+    assert queries_10 == queries_100
+
+
+def test_init_revision_tolerates_concurrent_workers(plugin, app, monkeypatch):
+    PortableRevision = plugin.export_cache.PortableRevision
+
+    class RaceLost(object):
+        # Another worker inserted the row after this one checked for it
+        def get(self, id):
+            return None
+
+    with app.app_context():
+        monkeypatch.setattr(PortableRevision, "query", RaceLost())
+        plugin.export_cache.init_revision()
+        monkeypatch.undo()
+        assert PortableRevision.query.count() == 1
+        assert plugin.export_cache.export_revision()
+
+
+def test_export_cache_directory_is_private(plugin, tmp_path):
+    directory = str(tmp_path / "exports")
+    cache = plugin.export_cache.ExportCache(directory, 1024)
+    assert list(cache.store("0" * 32, [b"archive"])) == [b"archive"]
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+
+def test_upload_directory_is_private(app):
+    response = app.test_client().post("/admin/yaml/uploads", json={"size": 10})
+    assert response.status_code == 200
+    upload_id = response.get_json()["upload"]
+    # By default next to the attachments
+    directory = os.path.join(app.config["UPLOAD_FOLDER"], "portable-uploads")
+    for path in (directory, os.path.join(directory, upload_id)):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
@@ -0,0 +1,114 @@
+"""YAML, JSON and NDJSON specs, serialized and parsed back"""
+from io import StringIO
+
+import pytest
+import yaml
+
+from helpers import make_challenge
+
+FORMAT_NAMES = ["yaml", "json", "ndjson"]
+
+CHALLENGES = [
+    make_challenge(0, description="Line one\nline two: «unicode» é\n"),
+    make_challenge(
+        1,
+        type="dynamic",
+        minimum=10,
+        decay=5,
+        tags=["web", "easy"],
+        hints=[{"content": "Look closer", "cost": 10}],
+        files=["files/a b.txt"],
+        prerequisites=["chall0"],
+    ),
+    make_challenge(2, description="x" * 300, hidden=True, max_attempts=3),
+]
+
+
+def _round_trip(spec_format, chals, shards=None):
+    text = "".join(spec_format.serialize(iter(chals)))
+    return list(spec_format.parse(StringIO(text), shards))
+
+
+@pytest.mark.parametrize("name", FORMAT_NAMES)
+def test_round_trip(plugin, name):
+    assert _round_trip(plugin.formats.FORMATS[name], CHALLENGES) == CHALLENGES
+
+
+@pytest.mark.parametrize("dumper", ["SafeDumper", "CSafeDumper"])
+def test_yaml_dumpers_agree_on_values(plugin, monkeypatch, dumper):
+    # libyaml folds long quoted strings differently, the values are the same
+    if not hasattr(yaml, dumper):
+        pytest.skip("PyYAML was built without libyaml")
+    monkeypatch.setattr(plugin.formats, "SpecDumper", getattr(yaml, dumper))
+    chals = [
+        make_challenge(i, description=" \\'\"#: \t\u00e9\U0001f600\n" * (i + 1) * 10)
+        for i in range(3)
+    ]
+    assert _round_trip(plugin.formats.FORMATS["yaml"], chals) == chals
+
+
+@pytest.mark.parametrize("name", FORMAT_NAMES)
+def test_round_trip_without_challenges(plugin, name):
+    assert _round_trip(plugin.formats.FORMATS[name], []) == []
+
+
+@pytest.mark.parametrize("name", FORMAT_NAMES)
+def test_shard_round_trip(plugin, name):
+    spec_format = plugin.formats.FORMATS[name]
+    shard_format = plugin.formats.FORMATS[spec_format.shard_format]
+    assert shard_format.load(shard_format.dump(CHALLENGES[1])) == CHALLENGES[1]
+
+    # Index specs list the other specs of a sharded spec
+    shards = []
+    index = spec_format.dump({"specs": ["web/a", "pwn/b"]})
+    assert list(spec_format.parse(StringIO(index), shards)) == []
+    assert shards == ["web/a", "pwn/b"]
+
+
+@pytest.mark.parametrize(
+    "name, text, error",
+    [
+        ("yaml", "challs: [", "Invalid YAML format."),
+        ("yaml", "name: x\n", "Invalid YAML format. Missing field 'challs'."),
+        ("json", '{"challs": [', "Invalid JSON format."),
+        ("json", '{"specs": []}', "Invalid JSON format. Missing field 'challs'."),
+        ("ndjson", '{"name": "a"}\n{"name"\n', "Invalid NDJSON format on line 2."),
+    ],
+)
+def test_invalid_specs(plugin, name, text, error):
+    with pytest.raises(ValueError) as info:
+        list(plugin.formats.FORMATS[name].parse(StringIO(text)))
+    assert str(info.value).startswith(error)
+
+
+@pytest.mark.parametrize(
+    "filename, name",
+    [
+        ("challenges.yaml", "yaml"),
+        ("challenges.yml", "yaml"),
+        ("spec/challenges.JSON", "json"),
+        ("challenges.jsonl", "ndjson"),
+        ("challenges.ndjson", "ndjson"),
+        ("challenges", "yaml"),
+    ],
+)
+def test_detect_format(plugin, filename, name):
+    assert plugin.formats.detect_format(filename).name == name
+
+
+@pytest.mark.parametrize("name", FORMAT_NAMES)
+def test_import_and_export_round_trip(plugin, app, tmp_path, name):
+    spec_format = plugin.formats.FORMATS[name]
+    spec = str(tmp_path / spec_format.spec_name)
+    chals = [make_challenge(i, tags=["tag"]) for i in range(3)]
+    with open(spec, "w") as f:
+        f.writelines(spec_format.serialize(iter(chals)))
+    out = str(tmp_path / "export")
+    with app.app_context():
+        summary = plugin.importer.import_challenges(spec, app.config["UPLOAD_FOLDER"])
+        assert set(summary["challenges"].values()) == {"added"}
+        exported = plugin.exporter.collect_challenges(
+            out + "/" + spec_format.spec_name, out + "/files", app.config["UPLOAD_FOLDER"]
+        )[0]
+    assert _round_trip(spec_format, exported) == exported
+    assert [chal["name"] for chal in exported] == ["chall0", "chall1", "chall2"]
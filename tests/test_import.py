@@ -0,0 +1,112 @@
+"""Imports of specs and archives, and re-imports of unchanged challenges"""
+from io import BytesIO
+import os
+import tarfile
+
+import pytest
+
+from helpers import make_challenge, web_export, web_import, write_spec
+
+
+def _spec(tmp_path, changed=False):
+    files = {
+        "files/a.txt": b"a" * 10,
+        "files/b.txt": (b"c" if changed else b"b") * 20,
+    }
+    chals = [
+        make_challenge(0, files=["files/a.txt"]),
+        make_challenge(1, files=["files/b.txt"]),
+        make_challenge(2),
+    ]
+    return write_spec(str(tmp_path / ("changed" if changed else "spec")), chals, files)
+
+
+@pytest.mark.parametrize("instance", ["app", "s3_app"])
+def test_reimport_skips_unchanged_challenges(plugin, instance, request, tmp_path):
+    app = request.getfixturevalue(instance)
+    uploads = app.config["UPLOAD_FOLDER"]
+    with app.app_context():
+        summary = plugin.importer.import_challenges(_spec(tmp_path), uploads)
+        assert set(summary["challenges"].values()) == {"added"}
+        assert summary["files"]["uploaded"] == 2
+        assert summary["files"]["uploaded_bytes"] == 30
+
+        # Stored attachments are compared by digest, without reading them
+        # back from the uploader
+        summary = plugin.importer.import_challenges(_spec(tmp_path), uploads)
+        assert set(summary["challenges"].values()) == {"unchanged"}
+        assert summary["files"]["uploaded"] == 0
+
+        summary = plugin.importer.import_challenges(_spec(tmp_path, changed=True), uploads)
+        assert summary["challenges"] == {
+            "chall0": "unchanged",
+            "chall1": "updated",
+            "chall2": "unchanged",
+        }
+        assert summary["files"]["uploaded"] == 1
+        assert summary["files"]["uploaded_bytes"] == 20
+
+
+def test_reimport_records_digests_of_older_attachments(plugin, app, tmp_path):
+    from CTFd.models import db
+
+    PortableFileDigest = plugin.file_digests.PortableFileDigest
+    uploads = app.config["UPLOAD_FOLDER"]
+    with app.app_context():
+        plugin.importer.import_challenges(_spec(tmp_path), uploads)
+        # Attachments stored before digests were kept are hashed once
+        PortableFileDigest.query.delete()
+        db.session.commit()
+        summary = plugin.importer.import_challenges(_spec(tmp_path), uploads)
+        assert set(summary["challenges"].values()) == {"unchanged"}
+        assert PortableFileDigest.query.count() == 2
+
+
+def test_force_rewrites_unchanged_challenges(plugin, app, tmp_path):
+    uploads = app.config["UPLOAD_FOLDER"]
+    with app.app_context():
+        plugin.importer.import_challenges(_spec(tmp_path), uploads)
+        summary = plugin.importer.import_challenges(_spec(tmp_path), uploads, force=True)
+        assert set(summary["challenges"].values()) == {"updated"}
+        # Identical attachments are not stored again
+        assert summary["files"]["skipped"] == 2
+
+
+@pytest.mark.parametrize("inline_size", [8 * 1024 * 1024, 4])
+def test_archive_links_are_stored(
+    plugin, app, other_app, tmp_path, monkeypatch, inline_size
+):
+    from CTFd.models import ChallengeFiles
+
+    # Exports store the same content attached under other names as hard links
+    files = {"files/a.txt": b"shared", "files/b.txt": b"shared", "files/c.txt": b"c"}
+    chals = [
+        make_challenge(0, files=["files/a.txt", "files/c.txt"]),
+        make_challenge(1, files=["files/b.txt"]),
+        make_challenge(2, files=["files/a.txt"]),
+    ]
+    spec = write_spec(str(tmp_path / "spec"), chals, files)
+    with app.app_context():
+        plugin.importer.import_challenges(spec, app.config["UPLOAD_FOLDER"])
+        archive, _ = web_export(app.test_client())
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        assert sum(member.islnk() for member in tar.getmembers()) == 1
+
+    # Larger shared attachments are copied to a temporary file once
+    monkeypatch.setattr(plugin.importer, "INLINE_SIZE", inline_size)
+    with other_app.app_context():
+        job = web_import(other_app.test_client(), archive)
+        assert job["status"] == "succeeded", job["errors"]
+        assert job["summary"]["files"]["uploaded"] == 4
+        stored = {}
+        for file_row in ChallengeFiles.query:
+            path = os.path.join(other_app.config["UPLOAD_FOLDER"], file_row.location)
+            with open(path, "rb") as f:
+                stored.setdefault(file_row.challenge_id, []).append(
+                    (os.path.basename(path), f.read())
+                )
+    assert sorted(stored.values()) == [
+        [("a.txt", b"shared")],
+        [("a.txt", b"shared"), ("c.txt", b"c")],
+        [("b.txt", b"shared")],
+    ]
@@ -0,0 +1,106 @@
+"""Import lock serializing the imports sharing a database"""
+import datetime
+import threading
+import time
+
+import pytest
+
+from helpers import make_challenge, write_spec
+
+
+def _import_in_thread(plugin, app, spec, results, **options):
+    def run():
+        with app.app_context():
+            try:
+                results.append(
+                    plugin.importer.import_challenges(
+                        spec, app.config["UPLOAD_FOLDER"], **options
+                    )
+                )
+            except ValueError as err:
+                results.append(err)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_import_is_refused_while_the_lock_is_held(plugin, app, tmp_path):
+    from CTFd.models import Challenges
+
+    spec = write_spec(str(tmp_path / "spec"), [make_challenge(0)])
+    results = []
+    with app.app_context():
+        with plugin.locking.import_lock():
+            _import_in_thread(plugin, app, spec, results, lock_timeout=0.5).join()
+        assert Challenges.query.count() == 0
+    assert len(results) == 1
+    assert isinstance(results[0], ValueError)
+    assert results[0].args == ("Another import is running, try again once it is done.",)
+
+
+def test_import_waits_for_the_lock(plugin, app, tmp_path):
+    from CTFd.models import Challenges
+
+    spec = write_spec(str(tmp_path / "spec"), [make_challenge(0)])
+    results = []
+    with app.app_context():
+        with plugin.locking.import_lock():
+            thread = _import_in_thread(plugin, app, spec, results, lock_timeout=30)
+            time.sleep(1)
+            assert results == []
+        thread.join()
+        assert results[0]["challenges"] == {"chall0": "added"}
+        assert Challenges.query.count() == 1
+        assert plugin.locking.PortableImportLock.query.count() == 0
+
+
+def test_concurrent_imports_do_not_duplicate_challenges(plugin, app, tmp_path):
+    from CTFd.models import Challenges
+
+    spec = write_spec(str(tmp_path / "spec"), [make_challenge(i) for i in range(50)])
+    results = []
+    threads = [_import_in_thread(plugin, app, spec, results) for _ in range(3)]
+    for thread in threads:
+        thread.join()
+    assert not [result for result in results if isinstance(result, Exception)]
+    summaries = sorted(set(result["challenges"].values()) for result in results)
+    assert summaries == [{"added"}, {"unchanged"}, {"unchanged"}]
+    with app.app_context():
+        assert Challenges.query.count() == 50
+
+
+def test_expired_lock_is_taken_over(plugin, app, tmp_path):
+    PortableImportLock = plugin.locking.PortableImportLock
+    spec = write_spec(str(tmp_path / "spec"), [make_challenge(0)])
+    with app.app_context():
+        # Left behind by an import which died
+        acquired = datetime.datetime.utcnow() - plugin.locking.LOCK_EXPIRY * 2
+        app.db.session.add(PortableImportLock(id=1, holder="dead", acquired=acquired))
+        app.db.session.commit()
+        summary = plugin.importer.import_challenges(
+            spec, app.config["UPLOAD_FOLDER"], lock_timeout=0.5
+        )
+        assert summary["challenges"] == {"chall0": "added"}
+
+
+@pytest.mark.parametrize("timeout", [0, 0.5])
+def test_lock_timeout(plugin, app, timeout):
+    with app.app_context():
+        with plugin.locking.import_lock():
+            errors = []
+
+            def take():
+                with app.app_context():
+                    try:
+                        with plugin.locking.import_lock(timeout):
+                            pass
+                    except ValueError as err:
+                        errors.append(err)
+
+            start = time.time()
+            thread = threading.Thread(target=take)
+            thread.start()
+            thread.join()
+            assert len(errors) == 1
+            assert time.time() - start >= timeout
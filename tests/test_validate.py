@@ -0,0 +1,49 @@
+"""Validation of specs, which reports all the errors of a spec at once"""
+import pytest
+
+from helpers import make_challenge, write_spec
+
+INVALID_CHALLENGES = [
+    make_challenge(0),
+    make_challenge(0),
+    make_challenge(1, prerequisites=["missing"]),
+    make_challenge(2, files=["missing.txt"]),
+    make_challenge(3, value="x"),
+    {"name": "incomplete"},
+]
+
+EXPECTED_ERRORS = [
+    "Challenge #2 (chall0): Duplicate challenge, also defined as challenge #1.",
+    "Challenge #3 (chall1): Unknown prerequisite 'missing'.",
+    "Challenge #4 (chall2): Missing file: missing.txt",
+    "Challenge #5 (chall3): Field 'value' must be a non-negative integer.",
+    "Challenge #6 (incomplete): Invalid YAML format. Missing field 'description'.",
+    "Challenge #6 (incomplete): Invalid YAML format. Missing field 'flags'.",
+]
+
+
+def test_validation_reports_all_errors(plugin, app, tmp_path):
+    spec = write_spec(str(tmp_path / "spec"), INVALID_CHALLENGES)
+    with app.app_context():
+        errors = plugin.importer.validate_spec(spec)
+    for error in EXPECTED_ERRORS:
+        assert error in errors
+    assert len(errors) == 8
+
+
+def test_invalid_spec_is_not_imported(plugin, app, tmp_path):
+    from CTFd.models import Challenges
+
+    spec = write_spec(str(tmp_path / "spec"), INVALID_CHALLENGES)
+    with app.app_context():
+        with pytest.raises(ValueError) as info:
+            plugin.importer.import_challenges(spec, app.config["UPLOAD_FOLDER"])
+        assert len(info.value.args) == 8
+        assert Challenges.query.count() == 0
+
+
+def test_valid_spec_has_no_errors(plugin, app, tmp_path):
+    chals = [make_challenge(0), make_challenge(1, prerequisites=["chall0"])]
+    spec = write_spec(str(tmp_path / "spec"), chals)
+    with app.app_context():
+        assert plugin.importer.validate_spec(spec) == []
@@ -0,0 +1,169 @@
+"""
+Resumable chunked uploads of import archives. An upload is a directory
+holding the preallocated archive, which chunks of a fixed size are written
+to at their offset, in any order and from any worker, and a marker for
+every chunk received. Once all chunks are received, the archive is checked
+against the checksum of the client before it is imported.
+
+The checksum of an archive is the sha256 of the concatenated sha256 digests
+of its chunks, so that clients can compute it one chunk at a time.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Uploads which are not finalized are removed after a day
+UPLOAD_RETENTION = 24 * 60 * 60
+ARCHIVE_NAME = "archive"
+MANIFEST_NAME = "upload.json"
+FINALIZED_NAME = "finalized"
+COPY_SIZE = 1024 * 1024
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _upload_dir(directory, upload_id):
+    if not _UPLOAD_ID.match(upload_id):
+        raise KeyError(upload_id)
+    upload_dir = os.path.join(directory, upload_id)
+    if not os.path.isfile(os.path.join(upload_dir, MANIFEST_NAME)):
+        raise KeyError(upload_id)
+    return upload_dir
+
+
+def _chunk_marker(upload_dir, index):
+    return os.path.join(upload_dir, "chunk-%d" % index)
+
+
+def _load_manifest(upload_dir):
+    with open(os.path.join(upload_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def remove_stale_uploads(directory, retention=UPLOAD_RETENTION):
+    if not os.path.isdir(directory):
+        return
+    limit = time.time() - retention
+    for upload_id in os.listdir(directory):
+        upload_dir = os.path.join(directory, upload_id)
+        try:
+            if _UPLOAD_ID.match(upload_id) and os.path.getmtime(upload_dir) < limit:
+                shutil.rmtree(upload_dir)
+        except OSError:
+            pass
+
+
+def init_upload(directory, size, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Start an upload of size bytes and return its id"""
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise ValueError("The size of the archive must be a positive integer.")
+    remove_stale_uploads(directory)
+
+    upload_id = uuid.uuid4().hex
+    upload_dir = os.path.join(directory, upload_id)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.makedirs(upload_dir, mode=0o700)
+    with open(os.path.join(upload_dir, ARCHIVE_NAME), "wb") as f:
+        f.truncate(size)
+    with open(os.path.join(upload_dir, MANIFEST_NAME), "w") as f:
+        json.dump({"size": size, "chunk_size": chunk_size}, f)
+    return upload_id
+
+
+def _chunk_length(manifest, index):
+    return min(manifest["chunk_size"], manifest["size"] - index * manifest["chunk_size"])
+
+
+def upload_status(directory, upload_id):
+    """
+    State of an upload: its size, chunk size and the digests of the chunks
+    received so far, by chunk index, so that clients can resume it
+    """
+    upload_dir = _upload_dir(directory, upload_id)
+    manifest = _load_manifest(upload_dir)
+    chunks = (manifest["size"] + manifest["chunk_size"] - 1) // manifest["chunk_size"]
+    received = {}
+    for index in range(chunks):
+        try:
+            with open(_chunk_marker(upload_dir, index)) as f:
+                received[index] = f.read()
+        except IOError:
+            pass
+    return {
+        "size": manifest["size"],
+        "chunk_size": manifest["chunk_size"],
+        "chunks": chunks,
+        "received": received,
+    }
+
+
+def write_chunk(directory, upload_id, offset, stream, digest=None):
+    """
+    Write the chunk starting at offset, read from stream, into the archive.
+    If given, digest is the sha256 of the chunk, which is checked before the
+    chunk is marked as received.
+    """
+    upload_dir = _upload_dir(directory, upload_id)
+    manifest = _load_manifest(upload_dir)
+    if os.path.exists(os.path.join(upload_dir, FINALIZED_NAME)):
+        raise ValueError("The upload is already finalized.")
+    if offset < 0 or offset >= manifest["size"] or offset % manifest["chunk_size"]:
+        raise ValueError("Invalid chunk offset {}.".format(offset))
+    index = offset // manifest["chunk_size"]
+    length = _chunk_length(manifest, index)
+
+    sha256 = hashlib.sha256()
+    written = 0
+    with open(os.path.join(upload_dir, ARCHIVE_NAME), "r+b") as f:
+        f.seek(offset)
+        while written < length:
+            data = stream.read(min(COPY_SIZE, length - written))
+            if not data:
+                break
+            f.write(data)
+            sha256.update(data)
+            written += len(data)
+        if written < length or stream.read(1):
+            raise ValueError(
+                "Chunk at offset {} must be {} bytes long.".format(offset, length)
+            )
+
+    if digest is not None and digest.lower() != sha256.hexdigest():
+        raise ValueError("Checksum mismatch for the chunk at offset {}.".format(offset))
+    with open(_chunk_marker(upload_dir, index), "w") as f:
+        f.write(sha256.hexdigest())
+    return index
+
+
+def finalize_upload(directory, upload_id):
+    """
+    Close an upload once all its chunks are received. Returns the directory
+    of the upload, which the caller removes once done, the path of the
+    archive and the chunk size. Finalizing an upload twice is an error.
+    """
+    upload_dir = _upload_dir(directory, upload_id)
+    status = upload_status(directory, upload_id)
+    missing = status["chunks"] - len(status["received"])
+    if missing:
+        raise ValueError("The upload is missing {} chunk(s).".format(missing))
+    try:
+        # Only one request can create the marker
+        os.close(os.open(os.path.join(upload_dir, FINALIZED_NAME), os.O_CREAT | os.O_EXCL))
+    except OSError:
+        raise ValueError("The upload is already finalized.")
+    return upload_dir, os.path.join(upload_dir, ARCHIVE_NAME), status["chunk_size"]
+
+
+def archive_checksum(archive_path, chunk_size):
+    """Checksum of an archive: the sha256 of the sha256 digests of its chunks"""
+    digests = hashlib.sha256()
+    with open(archive_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digests.update(hashlib.sha256(chunk).digest())
+    return digests.hexdigest()
@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_stream(stream, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sha256_file(path):
+    with open(path, "rb") as f:
+        return sha256_stream(f)
+
+
+def sha256_files(paths, workers=4):
+    """
+    Hash several files in parallel, hashlib releases the GIL while hashing.
+    Returns a map from the paths to their digests.
+    """
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(sha256_file, paths)))
+
+
+def challenge_fingerprint(properties):
+    """
+    Hash the portable representation of a challenge (as built by the
+    exporter) in a canonical form. Attachments are not part of the
+    fingerprint and prerequisites are compared regardless of their order.
+    """
+    canonical = dict(properties)
+    canonical.pop("files", None)
+    if "prerequisites" in canonical:
+        canonical["prerequisites"] = sorted(set(canonical["prerequisites"]))
+    data = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()